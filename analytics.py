@@ -0,0 +1,274 @@
+"""Streaming Firewall Log Analytics"""
+import heapq
+import threading
+from collections import Counter, deque
+from operator import attrgetter, itemgetter
+
+def event_time(entry):
+    """Seconds since the epoch of a log entry's timestamp."""
+    return int(entry.timestamp.timestamp())
+
+class SlidingWindowCounter:
+    """
+    Counts keys over the last `window` seconds of event time.
+
+    Events are counted in buckets of `bucket` seconds, and a bucket's counts are subtracted from the totals
+    once it falls out of the window, so adding an event and reading a key's count are both O(1).
+    """
+    def __init__(self, window=300, bucket=10):
+        self.window = window
+        self.bucket = bucket
+        self.counts = Counter()
+        self.total = 0
+        self._buckets = deque()  # (bucket start, Counter)
+
+    def add(self, key, timestamp, count=1):
+        """Count `key` at `timestamp` (seconds). Returns the key's count in the window."""
+        counter = self._get_bucket(timestamp)
+        if counter is None:
+            return self.counts.get(key, 0)
+        counter[key] += count
+        self.counts[key] += count
+        self.total += count
+        return self.counts[key]
+
+    def get(self, key):
+        return self.counts.get(key, 0)
+
+    def top(self, n=10):
+        """The `n` keys with the highest counts, as (key, count) tuples."""
+        return heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+
+    def over(self, threshold):
+        """The keys counted at least `threshold` times, as a {key: count} dictionary."""
+        return {key: count for key, count in self.counts.items() if count >= threshold}
+
+    def advance(self, now):
+        """Expire the buckets that are entirely before the window ending at `now`."""
+        cutoff = now - self.window
+        buckets, counts = self._buckets, self.counts
+        while buckets and buckets[0][0] + self.bucket <= cutoff:
+            _, expired = buckets.popleft()
+            for key, count in expired.items():
+                remaining = counts[key] - count
+                if remaining:
+                    counts[key] = remaining
+                else:
+                    del counts[key]
+                self.total -= count
+
+    def clear(self):
+        self.counts.clear()
+        self._buckets.clear()
+        self.total = 0
+
+    def _get_bucket(self, timestamp):
+        """The bucket for an event, or None if the event is older than the window."""
+        start = timestamp - timestamp % self.bucket
+        buckets = self._buckets
+        if not buckets or start > buckets[-1][0]:
+            buckets.append((start, self._new_bucket()))
+            self.advance(timestamp)
+            return buckets[-1][1]
+        # Late events go to their own bucket if it is still in the window, searching back from the newest
+        for index in range(len(buckets) - 1, -1, -1):
+            if buckets[index][0] <= start:
+                return buckets[index][1]
+        return None
+
+    def _new_bucket(self):
+        return Counter()
+
+    def __len__(self):
+        return len(self.counts)
+
+class SlidingWindowDistinct(SlidingWindowCounter):
+    """
+    Counts the distinct values seen with each key over the last `window` seconds, e.g. the ports hit by a source.
+
+    Each bucket holds the set of values of each key, and `values` keeps, for each key, the number of buckets
+    holding each value, so the distinct count of a key is the size of its entry.
+    """
+    def __init__(self, window=300, bucket=10):
+        super().__init__(window, bucket)
+        self.values = {}
+
+    def add(self, key, value, timestamp):
+        """Record `value` for `key` at `timestamp` (seconds). Returns the key's distinct count in the window."""
+        bucket = self._get_bucket(timestamp)
+        values = self.values.get(key)
+        if bucket is None:
+            return len(values) if values else 0
+        seen = bucket.get(key)
+        if seen is None:
+            seen = bucket[key] = set()
+        if value not in seen:
+            seen.add(value)
+            if values is None:
+                values = self.values[key] = Counter()
+            values[value] += 1
+        return len(values)
+
+    def get(self, key):
+        values = self.values.get(key)
+        return len(values) if values else 0
+
+    def top(self, n=10):
+        """The `n` keys with the most distinct values, as (key, distinct count) tuples."""
+        return heapq.nlargest(n, ((key, len(values)) for key, values in self.values.items()), key=itemgetter(1))
+
+    def over(self, threshold):
+        """The keys with at least `threshold` distinct values, as a {key: distinct count} dictionary."""
+        return {key: len(values) for key, values in self.values.items() if len(values) >= threshold}
+
+    def advance(self, now):
+        cutoff = now - self.window
+        buckets, all_values = self._buckets, self.values
+        while buckets and buckets[0][0] + self.bucket <= cutoff:
+            _, expired = buckets.popleft()
+            for key, seen in expired.items():
+                values = all_values[key]
+                for value in seen:
+                    remaining = values[value] - 1
+                    if remaining:
+                        values[value] = remaining
+                    else:
+                        del values[value]
+                if not values:
+                    del all_values[key]
+
+    def clear(self):
+        super().clear()
+        self.values.clear()
+
+    def _new_bucket(self):
+        return {}
+
+    def __len__(self):
+        return len(self.values)
+
+class Aggregate:
+    """A windowed aggregate of the log entries that match `where`, grouped by the `key` field."""
+    __slots__ = ('name', 'counter', 'key', 'value', 'where')
+
+    def __init__(self, name, key, value=None, where=None, window=300, bucket=10):
+        self.name = name
+        self.key = attrgetter(key)
+        # Counting distinct values of a second field, or counting the entries
+        self.value = attrgetter(value) if value else None
+        self.counter = SlidingWindowDistinct(window, bucket) if value else SlidingWindowCounter(window, bucket)
+        self.where = tuple((attrgetter(field), expected) for field, expected in (where or {}).items())
+
+    def observe(self, entry, timestamp):
+        """Add an entry to the aggregate. Returns (key, value before, value after), or None if it doesn't match."""
+        for field, expected in self.where:
+            if field(entry) != expected:
+                return None
+        key = self.key(entry)
+        if key is None:
+            return None
+        counter = self.counter
+        before = counter.get(key)
+        if self.value is None:
+            return key, before, counter.add(key, timestamp)
+        value = self.value(entry)
+        if value is None:
+            return None
+        return key, before, counter.add(key, value, timestamp)
+
+class FirewallLogAnalytics:
+    """
+    Maintains windowed aggregates of firewall log entries as they are ingested.
+
+    Every aggregate is updated in constant time per entry, so playbooks can read results such as the top blocked
+    sources without scanning the logs. Threshold callbacks run when an aggregate's value for a key reaches the
+    threshold, and again if it falls back below it and then reaches it again.
+    """
+    WINDOW = 300
+    BUCKET = 10
+    # name: (key field, distinct value field, entry filter)
+    DEFAULT_AGGREGATES = {
+        'blocked_sources': ('src_ip', None, {'action': 'block'}),
+        'blocked_ports': ('dest_port', None, {'action': 'block'}),
+        'source_ports': ('src_ip', 'dest_port', None),
+        'source_destinations': ('src_ip', 'dest_ip', None),
+    }
+
+    def __init__(self, window=WINDOW, bucket=BUCKET):
+        self.window = window
+        self.bucket = bucket
+        self.aggregates = {}
+        self._thresholds = {}  # aggregate name -> list of (threshold, callback)
+        self._lock = threading.RLock()
+        for name, (key, value, where) in self.DEFAULT_AGGREGATES.items():
+            self.add_aggregate(name, key, value, where)
+
+    def add_aggregate(self, name, key, value=None, where=None, window=None):
+        """
+        Add an aggregate counting the entries matching `where` (a {field: value} dictionary) by their `key` field,
+        or counting the distinct values of the `value` field for each key.
+        """
+        with self._lock:
+            self.aggregates[name] = Aggregate(name, key, value, where, window or self.window, self.bucket)
+        return self.aggregates[name]
+
+    def add_threshold(self, name, threshold, callback):
+        """Call `callback(name, key, value, entry)` when a key's value in the `name` aggregate reaches `threshold`."""
+        if name not in self.aggregates:
+            raise KeyError(f"Unknown aggregate: {name}")
+        with self._lock:
+            self._thresholds.setdefault(name, []).append((threshold, callback))
+
+    def remove_threshold(self, name, callback):
+        with self._lock:
+            self._thresholds[name] = [item for item in self._thresholds.get(name, []) if item[1] is not callback]
+
+    def observe(self, entry):
+        self.observe_many((entry,))
+
+    def observe_many(self, entries):
+        """Add log entries to every aggregate and run the callbacks of the thresholds they reach."""
+        fired = []
+        with self._lock:
+            aggregates = list(self.aggregates.values())
+            thresholds = self._thresholds
+            for entry in entries:
+                timestamp = event_time(entry)
+                for aggregate in aggregates:
+                    result = aggregate.observe(entry, timestamp)
+                    if result is None or aggregate.name not in thresholds:
+                        continue
+                    key, before, after = result
+                    for threshold, callback in thresholds[aggregate.name]:
+                        if before < threshold <= after:
+                            fired.append((callback, aggregate.name, key, after, entry))
+        # Callbacks run outside the lock, so they can query the aggregates
+        for callback, name, key, value, entry in fired:
+            callback(name, key, value, entry)
+        return len(fired)
+
+    def advance(self, now):
+        """Expire the events before the window ending at `now` (seconds), e.g. when no events arrived for a while."""
+        with self._lock:
+            for aggregate in self.aggregates.values():
+                aggregate.counter.advance(now)
+
+    def top(self, name, n=10):
+        """The `n` keys with the highest values in an aggregate, as (key, value) tuples."""
+        with self._lock:
+            return self.aggregates[name].counter.top(n)
+
+    def over(self, name, threshold):
+        """The keys whose value in an aggregate is at least `threshold`, as a {key: value} dictionary."""
+        with self._lock:
+            return self.aggregates[name].counter.over(threshold)
+
+    def get(self, name, key):
+        with self._lock:
+            return self.aggregates[name].counter.get(key)
+
+    def reset(self):
+        """Clear every aggregate, e.g. when the logs are read again from the start."""
+        with self._lock:
+            for aggregate in self.aggregates.values():
+                aggregate.counter.clear()
@@ -1,5 +1,10 @@
 import yaml
 import os
+import atexit
+import copy
+import hashlib
+import stat
+import tempfile
 from integrations import *
 import logging
 from logging.handlers import RotatingFileHandler
@@ -9,12 +14,16 @@ from importlib import import_module
 from urllib3.exceptions import InsecureRequestWarning
 import traceback
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 # Globally disable SSL warnings (for self-signed certs)
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 class ConfigurationManager:
     """This class is used to manage the configuration of all different functions the application."""
     CONFIG_PATH ='./config'
+    # Integrations are initialized concurrently in the background by this many worker threads
+    INTEGRATION_INIT_WORKERS = 4
 
     def __init__(self):
         self._integration_mgr = None
@@ -33,16 +42,20 @@ class ConfigurationManager:
         self._enabled_playbooks_by_integration = None
         self._enabled_playbook_functions_by_integration = None
         self._running_playbooks = None
+        self._ioc_store = None
+        self._playbook_triggers = None
+        # Readiness futures for integrations that are being initialized in the background
+        self._integration_futures = {}
+        self._integration_executor = None
+        self._integration_lock = threading.Lock()
         self.log = Log.get_instance()
         
     def initialize_misp(self):
         # Store the passed-in MISP object as a MISPFunction object
         try:
-            
-            if self._integration_mgr is None:
-                self._integration_mgr = self.integration_mgr  # Ensure the Integration Manager is instantiated
             if self.misp is None:  # Only create a new MISP object if it is None
-                self.misp = self._integration_mgr.initialize_integration('misp')
+                # Waits on the background initialization if it has already been started
+                self.misp = self.wait_for_integration('misp', timeout=PlaybookManager.INTEGRATION_READY_TIMEOUT)
             return self.misp
         except Exception as e:
             self.log.error(f"Error initializing MISP: {e}")
@@ -53,11 +66,94 @@ class ConfigurationManager:
         self._enabled_integrations = self.integration_mgr.get_enabled_integrations()
         self._enabled_playbooks = self.playbook_mgr.list_enabled_playbooks()
         self._enabled_playbook_functions = self._get_enabled_playbook_functions()
-        # Now we make sure to initialize MISP if it's not already before fetching feeds
-        if self.misp is None:
-            self.misp = self.initialize_misp()
-        self._enabled_feeds = self.misp.get_enabled_feeds()
+        # Initialize the enabled integrations in the background instead of blocking on MISP here,
+        # the enabled feeds are fetched again the next time they are requested
+        self.start_integrations([integration.name for integration in self._enabled_integrations])
+        self._enabled_feeds = None
+
+    def start_integrations(self, integration_names=None):
+        """
+        Starts initializing the given integrations concurrently in the background.
+
+        Args:
+            integration_names (list): Names of the integrations to initialize. Defaults to all enabled integrations.
+
+        Returns:
+            A dictionary of integration names to their readiness futures.
+        """
+        if integration_names is None:
+            integration_names = self.enabled_integrations_list
+        futures = {}
+        with self._integration_lock:
+            for integration_name in integration_names:
+                if integration_name not in self._integration_futures:
+                    self.log.debug(f"Initializing the {integration_name} integration in the background.")
+                    self._integration_futures[integration_name] = self.integration_executor.submit(
+                        self._initialize_integration, integration_name)
+                futures[integration_name] = self._integration_futures[integration_name]
+        return futures
+
+    def wait_for_integration(self, integration_name, timeout=None):
+        """
+        Returns the initialized integration, waiting for its background initialization if needed.
+
+        Raises:
+            concurrent.futures.TimeoutError: If the integration is not ready within `timeout` seconds.
+            Exception: If the integration failed to initialize.
+        """
+        future = self.start_integrations([integration_name])[integration_name]
+        try:
+            return future.result(timeout=timeout)
+        except Exception:
+            # Forget failed initializations so that the next request can retry them
+            if future.done() and future.exception() is not None:
+                with self._integration_lock:
+                    if self._integration_futures.get(integration_name) is future:
+                        del self._integration_futures[integration_name]
+            raise
+
+    def wait_for_integrations(self, integration_names, timeout=None):
+        """Waits for every integration in `integration_names` and returns them by name, all within `timeout` seconds."""
+        self.start_integrations(integration_names)  # Make sure all of them are initializing concurrently
+        deadline = None if timeout is None else time.monotonic() + timeout
+        integrations = {}
+        for name in integration_names:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            integrations[name] = self.wait_for_integration(name, remaining)
+        return integrations
+
+    def is_integration_ready(self, integration_name):
+        """Returns True if the integration has finished initializing successfully."""
+        future = self._integration_futures.get(integration_name)
+        return future is not None and future.done() and future.exception() is None
+
+    def shutdown(self):
+        """Stops the background initialization workers without waiting for pending integrations."""
+        if self._integration_executor is not None:
+            self._integration_executor.shutdown(wait=False, cancel_futures=True)
+            self._integration_executor = None
     
+    def start_playbook_triggers(self):
+        """
+        Arms the event and threshold triggers of the enabled playbooks.
+
+        The integrations the triggered playbooks depend on are attached as they finish initializing, so this
+        doesn't wait for them.
+        """
+        triggers = self.playbook_triggers
+        armed = triggers.arm_playbooks(self.playbook_mgr.list_enabled_playbooks())
+        integration_names = {name for playbook in armed for name in playbook.integration_deps or []}
+        for integration_name, future in self.start_integrations(sorted(integration_names)).items():
+            future.add_done_callback(lambda future, name=integration_name: self._attach_playbook_triggers(name, future))
+        return armed
+
+    def _attach_playbook_triggers(self, integration_name, future):
+        if future.cancelled() or future.exception() is not None:
+            self.log.error(f"Playbook triggers cannot receive events from {integration_name}, it failed to initialize.")
+            return
+        self.playbook_triggers.attach(future.result())
+        self.log.debug(f"Playbook triggers are receiving events from {integration_name}.")
+
     def resolve_function(self, function_name):
         """Returns a function object for the given function name."""
         try:
@@ -74,6 +170,11 @@ class ConfigurationManager:
     def _add_integration(self, integration_name):
         # Calls the IntegrationManager's add_integration method
         # Check if MISP Object is enabled
+        if not self.misp:
+            try:
+                self.initialize_misp()
+            except Exception as e:
+                self.log.error(f"Error initializing MISP to add the {integration_name} integration: {e}\n{traceback.format_exc()}")
         if not self.misp:
             self.log.error("MISP is not initialized.")
             return
@@ -82,6 +183,7 @@ class ConfigurationManager:
             self.misp,
             self.enabled_feeds,
             self.enabled_playbook_functions,
+            progress=self._log_feed_progress,
             )
         if functions_to_enable:
             for function in functions_to_enable:
@@ -121,7 +223,7 @@ class ConfigurationManager:
                 The initialized integration.
             """
             if integration_name not in self._initialized_integrations:
-                integration = IntegrationManager().initialize_integration(integration_name)
+                integration = self.integration_mgr.initialize_integration(integration_name)
                 self._initialized_integrations[integration_name] = integration
             return self._initialized_integrations[integration_name]
 
@@ -131,9 +233,13 @@ class ConfigurationManager:
             self.misp = self.initialize_misp()
         self._enabled_feeds = self.misp.get_enabled_feeds()
 
+    def _log_feed_progress(self, data_type, status, completed, total):
+        # Reports the progress of enabling and caching MISP feeds for an integration
+        self.log.info(f"MISP feed for {data_type}: {status} ({completed}/{total} feeds done)")
+
     def _update_integration(self, integration_name):
         # Calls the IntegrationManager's update_integration method
-        msg, functions = self.integration_mgr.update_integration(integration_name, self.misp)
+        msg, functions = self.integration_mgr.update_integration(integration_name, self.misp, progress=self._log_feed_progress)
         for function in functions:
             self._enable_playbook_function(function)
         self.update_enabled_items()
@@ -180,6 +286,8 @@ class ConfigurationManager:
             else:
                 self.log.error(f"Cannot disable playbook {playbook_name} while it is running. Please stop the playbook and try again.")
                 return  # Exiting the method since we cannot disable a running playbook without force_stop
+        if self._playbook_triggers is not None:
+            self._playbook_triggers.disarm(playbook_name)
         # The condition to check if the playbook is in the list has been moved down to after we have possibly stopped it
         if playbook_name in self._enabled_playbooks:
             del self._enabled_playbooks[playbook_name]
@@ -189,6 +297,7 @@ class ConfigurationManager:
 
     def _scan_configs(self):
         # Fixed the slice to correctly remove the file extension
+        PersistenceManager.get_instance().flush_directory(self.CONFIG_PATH)  # Include configurations that are still queued
         return [file[:-5] for file in os.listdir(self.CONFIG_PATH) if file.endswith('.yaml')]
 
     # Helper functions    
@@ -203,6 +312,27 @@ class ConfigurationManager:
         if not self._playbook_mgr:
             self._playbook_mgr = PlaybookManager()
         return self._playbook_mgr
+
+    @property
+    def playbook_triggers(self):
+        if not self._playbook_triggers:
+            self._playbook_triggers = PlaybookTriggerManager(self.playbook_mgr, self)
+        return self._playbook_triggers
+
+    @property
+    def ioc_store(self):
+        """Local store of indicators shared by the integrations and playbooks."""
+        if self._ioc_store is None:
+            from ioc_store import IocStore  # Imported here since the store depends on this module
+            self._ioc_store = IocStore.for_path()
+        return self._ioc_store
+
+    @property
+    def integration_executor(self):
+        if self._integration_executor is None:
+            self._integration_executor = ThreadPoolExecutor(
+                max_workers=self.INTEGRATION_INIT_WORKERS, thread_name_prefix='pysoar-integration')
+        return self._integration_executor
     
     @property
     def enabled_feeds(self):
@@ -333,6 +463,8 @@ class Integration:
     # Private functions
     def _read_config(self):
         try:
+            # Make sure any queued writes for this file are on disk before reading it
+            PersistenceManager.get_instance().flush(self._config_path)
             with open(self._config_path, 'r') as f:
                 return yaml.safe_load(f)
         except FileNotFoundError:
@@ -345,7 +477,8 @@ class Integration:
     # Helper functions
     @property
     def exists(self):
-        return os.path.isfile(self._config_path)
+        # A configuration saved moments ago may only be queued in the PersistenceManager
+        return PersistenceManager.get_instance().exists(self._config_path)
     
     @property
     def name(self):
@@ -436,11 +569,14 @@ class Integration:
 class IntegrationManager:
     CONFIG_PATH ='./config'
     """This class is used to manage integrations in the Integration class"""
+    # Maximum number of MISP feeds enabled and cached at the same time
+    FEED_WORKERS = 4
     def __init__(self):
         self._integrations_list = []
         self._enabled_integrations = []
         # Store the passed-in integration objects
         self._integration_class_cache = {}
+        self.persistence = PersistenceManager.get_instance()
         self.log = Log.get_instance()
     
     def get_enabled_integrations(self):
@@ -479,14 +615,14 @@ class IntegrationManager:
             # Store in cache only if it's a newly initialized enabled integration
             if integration_obj:
                 self._integration_class_cache[integration_name] = cls(integration_obj)
-            else:
-                integration_obj = Integration(integration_name)  # Don't cache if not enabled
+                return self._integration_class_cache[integration_name]
+            integration_obj = Integration(integration_name)  # Don't cache if not enabled
             return cls(integration_obj)
         
         # Raise an error if the integration does not exist
         raise Exception(f"Integration {integration_name} does not exist.")
     
-    def add_integration(self, integration_name, misp_obj, feeds, functions):
+    def add_integration(self, integration_name, misp_obj, feeds, functions, progress=None):
         # You would typically call the necessary functions or methods here to add the integration
         self.log.info(f"Adding {integration_name} integration...")
 
@@ -498,7 +634,7 @@ class IntegrationManager:
             integration_obj = Integration(integration_name)
             
             # Ensure the MISP feeds for the accepted data types are enabled
-            self._enable_feeds_for_integration(misp_obj, integration_obj)
+            self._enable_feeds_for_integration(misp_obj, integration_obj, progress)
             # update the integration's enabled status in the enabled_integrations dictionary
             self._enabled_integrations.append(integration_obj)
             
@@ -547,7 +683,7 @@ class IntegrationManager:
         else:
             self.log.info("Removal cancelled.")
 
-    def update_integration(self, integration_name, misp_obj):
+    def update_integration(self, integration_name, misp_obj, progress=None):
         self.log.info(f"Reloading {integration_name} integration...")
 
         integration_obj = self._get_integration_obj_by_name(integration_name)
@@ -557,7 +693,7 @@ class IntegrationManager:
             integration_obj = self._get_integration_obj_by_name(integration_name)
             
         # Ensure the MISP feeds for the accepted data types are enabled
-        self._enable_feeds_for_integration(misp_obj, integration_obj)
+        self._enable_feeds_for_integration(misp_obj, integration_obj, progress)
         self.log.info(f"{integration_name} integration has been updated with current feeds and configurations.")
         
         # Notify the user which feeds and playbook functions have been enabled
@@ -566,22 +702,20 @@ class IntegrationManager:
             
     def scan_integrations(self):
         # Scans the integrations directory and returns a list of integration names
+        self.persistence.flush_directory(self.CONFIG_PATH)  # Include configurations that are still queued
         return [file.split('.')[0] for file in os.listdir(self.CONFIG_PATH) if file.endswith('.yaml')]
 
     def save(self, integration_obj):
         """Saves all an integration object to disk in the correct format"""
-        # Ensure that integration object data is updated 
-        integration_obj.update()
-        # Format into yaml
+        # Format into yaml (_pack_data reads the current values straight from the integration object), keeping
+        # the integration specific settings it doesn't know about, e.g. `block_ttl` or `feed_cache_ttl`
+        params = (integration_obj.params or {}).get(integration_obj.name) or {}
         config = {
-            integration_obj.name: {
-                integration_obj._pack_data()
-            }
+            integration_obj.name: {**params, **integration_obj._pack_data()}
         }
-        # Write the file to disk
+        # Queue the file to be written to disk, rapid edits are merged into a single atomic write
         try:
-            with open(integration_obj.config_path, 'w') as f:
-                yaml.safe_dump(config, f)
+            self.persistence.save(integration_obj.config_path, config)
             self.log.info(f"Integration {integration_obj.name} saved.")
         except Exception as e:
             self.log.error(f"Integration {integration_obj.name} could not be saved: {e}.")
@@ -603,8 +737,7 @@ class IntegrationManager:
                 }
             }
             config_path = os.path.join(self.CONFIG_PATH, integration_name + '.yaml')
-            with open(config_path, 'w') as f:
-                yaml.safe_dump(default_config, f)
+            self.persistence.write_now(config_path, default_config)
             self.log.info(f"Default configuration for '{integration_name}' created.")
         except IOError as e:
             self.log.error(f"IOError when creating default configuration for '{integration_name}': {e}")
@@ -619,9 +752,37 @@ class IntegrationManager:
                 return integration
         return None
 
-    def _enable_feeds_for_integration(self, misp_obj, integration_obj):
-        for data_type in integration_obj.accepts:
-            misp_obj.ensure_feed_enabled(data_type)
+    def _enable_feeds_for_integration(self, misp_obj, integration_obj, progress=None):
+        """
+        Enables and caches the MISP feeds for the integration's accepted data types concurrently.
+
+        `progress(data_type, status, completed, total)` is called whenever a feed changes status.
+        Returns a dictionary of data types to the result of enabling their feed (or the exception raised).
+        """
+        data_types = list(dict.fromkeys(integration_obj.accepts or []))
+        total, completed, results = len(data_types), 0, {}
+        lock = threading.Lock()
+
+        def report(data_type, status):
+            if progress:
+                with lock:
+                    progress(data_type, status, completed, total)
+
+        with ThreadPoolExecutor(max_workers=self.FEED_WORKERS, thread_name_prefix='pysoar-feeds') as executor:
+            futures = {executor.submit(misp_obj.ensure_feed_enabled, data_type, True, report): data_type for data_type in data_types}
+            for future in as_completed(futures):
+                data_type = futures[future]
+                try:
+                    results[data_type] = future.result()
+                    status = 'done'
+                except Exception as e:
+                    self.log.error(f"Error enabling the MISP feed for {data_type}: {e}")
+                    results[data_type] = e
+                    status = 'failed'
+                with lock:
+                    completed += 1
+                report(data_type, status)
+        return results
 
     def _generate_removal_warning(self, integration_name, feeds_to_remove, functions_to_remove, playbooks_to_remove):
         warning = f"WARNING: Removing the '{integration_name}' integration will disable the following:\n" 
@@ -652,9 +813,12 @@ class IntegrationManager:
 class PlaybookManager:
     """This class is used to manage playbooks in the Playbook class"""
     PLAYBOOK_DIR = './playbooks'
+    # Seconds to wait for a playbook's integrations to finish initializing before giving up
+    INTEGRATION_READY_TIMEOUT = 120
     def __init__(self):
         self.playbooks_data = {}
         self._playbook_names = []
+        self.persistence = PersistenceManager.get_instance()
         self.log = Log.get_instance()
     
     def list_enabled_playbooks(self):
@@ -670,8 +834,11 @@ class PlaybookManager:
         return [playbook_name for playbook_name in self.playbooks_data.keys()
             if self.playbooks_data[playbook_name].get('is_running')]
         
-    def launch_playbook(self, playbook_name, config_mgr):
-        """Executes logic to run the playbook"""
+    def launch_playbook(self, playbook_name, config_mgr, shared_data=None):
+        """
+        Executes logic to run the playbook.
+        `shared_data` is passed to the first function, e.g. the event that triggered the playbook.
+        """
         # Check to ensure that the playbook exists
         if playbook_name not in self.playbooks_data:
             self.log.error(f"Playbook {playbook_name} does not exist.")
@@ -698,13 +865,18 @@ class PlaybookManager:
             return
         # Get the formatted playbook object logic 
         playbook = Playbook(playbook_name)
+        # Only wait for the integrations this playbook depends on, a slow integration won't delay the others
+        try:
+            config_mgr.wait_for_integrations(playbook.integration_deps or [], timeout=self.INTEGRATION_READY_TIMEOUT)
+        except Exception as e:
+            self.log.error(f"Playbook {playbook_name} cannot be launched, its integrations are not ready: {e}")
+            return
         # Initialize a shared_data object to store data between steps
         # Check to see if first function has any data dependencies (it shouldn't)
         if playbook.logic[0].data_dependencies:
             raise Exception(f"The first function in the {playbook.name} playbook should not have any data dependencies.")
         # Keep track of how many functions executed
         iteration = 0
-        shared_data = None
         current_function = playbook.logic[iteration] # Set the current function to the first function in the playbook
         playbook.is_running = True
         try:
@@ -744,6 +916,8 @@ class PlaybookManager:
     def _scan_playbooks(self):
         """Returns a list of playbook filenames in the './playbooks' directory."""
         try:
+            # Playbooks saved moments ago may only be queued, write them before listing the directory
+            self.persistence.flush_directory(self.PLAYBOOK_DIR)
             return [f for f in os.listdir(self.PLAYBOOK_DIR) 
                     if os.path.isfile(os.path.join(self.PLAYBOOK_DIR, f)) and f.endswith('.yaml') and f != 'playbook_template.yaml']
         except FileNotFoundError:
@@ -780,11 +954,13 @@ class PlaybookManager:
         NOTE: Ensure any references to the playbook elsewhere are also cleaned up.
         """
         filename = os.path.join(self.PLAYBOOK_DIR, name + '.yaml')
-        if os.path.exists(filename):
+        if self.persistence.exists(filename):
             choice = self._get_user_input(f"Are you sure you want to delete the playbook {name}? This cannot be undone. (yes/no): ")
             if choice.lower() == 'yes':
                 try:
-                    os.remove(filename)
+                    self.persistence.discard(filename)  # Drop any queued writes for the playbook
+                    if os.path.exists(filename):
+                        os.remove(filename)
                     # Remove from the internal cache if present
                     self.playbooks_data.pop(name, None)
                     self.log.info(f"Playbook {name} has been deleted.")
@@ -798,7 +974,7 @@ class PlaybookManager:
     def create_playbook(self, playbook_name):
         # Check if the playbook already exists
         playbook_path = os.path.join(self.PLAYBOOK_DIR, playbook_name + '.yaml')
-        if os.path.exists(playbook_path):
+        if self.persistence.exists(playbook_path):
             self.log.info(f"Playbook '{playbook_name}' already exists.")
             choice = input("Would you like to modify it instead? (yes/no): ")
             if choice.lower() == 'yes':
@@ -821,14 +997,13 @@ class PlaybookManager:
             # Convert the playbook data to a Playbook object
             playbook = Playbook(playbook_name, playbook_data)
             try:
-                # Write the YAML data to a file
-                with open(playbook.path, 'w') as file:
-                    yaml.safe_dump(playbook._pack_data(), file, default_flow_style=False, sort_keys=False)
+                # Queue the YAML data, rapid edits are merged into a single atomic write off the UI thread
+                self.persistence.save(playbook.path, playbook._pack_data(), default_flow_style=False, sort_keys=False)
                 self.log.info(f'Playbook "{playbook.name}" saved.')
             except Exception as e:
                 self.log.error(f'Playbook "{playbook.name}" could not be saved: {e}.')
         else:
-            self.log.error(f'Playbook "{playbook.name}" does not exist.')   
+            self.log.error(f'Playbook "{playbook_name}" does not exist.')   
 
     @property
     def playbook_names(self):
@@ -852,7 +1027,7 @@ class Playbook:
         self._functions = []
         self._enabled = False
         self._data = playbook_data or {}
-        self._exists = os.path.exists(self.path)
+        self._exists = PersistenceManager.get_instance().exists(self.path)  # Includes a save that is still queued
         self._is_running = False
         self.initialize() # Initialize the playbook
     
@@ -950,6 +1125,8 @@ class Playbook:
     def load(self):
         """Load a playbook's data from its YAML file."""
         try:
+            # Make sure any queued writes for this playbook are on disk before reading it
+            PersistenceManager.get_instance().flush(self.path)
             with open(self.path, 'r') as file:
                 data = yaml.safe_load(file) 
                 playbook_data = data.get('Playbook', {}) # dict(): returns the Playbook dictionary from the yaml file using the 'Playbook' key
@@ -993,8 +1170,8 @@ class Playbook:
     # Getter and setter functions
     @property
     def exists(self):
-        """Check if the playbook file exists."""
-        return os.path.exists(self.path)   
+        """Check if the playbook file exists, or is queued to be written."""
+        return PersistenceManager.get_instance().exists(self.path)   
     @property
     def data(self):
         return self._data
@@ -1063,6 +1240,9 @@ class PlaybookFunction:
         trigger_data = {'type': self.trigger_type}
         if self.trigger_type == 'time':
             trigger_data['duration'] = self.trigger_duration
+        elif self.trigger_type in PlaybookTriggerManager.TRIGGER_TYPES:
+            # Event and threshold triggers keep their conditions, e.g. `match` or `aggregate` and `threshold`
+            trigger_data.update((key, value) for key, value in self.trigger.items() if key != 'type')
         data = {
             'function': self.name,
             'trigger': trigger_data,
@@ -1098,6 +1278,10 @@ class PlaybookFunction:
             # No specific action needed, will execute immediately
             pass
 
+        elif self.trigger_type in PlaybookTriggerManager.TRIGGER_TYPES:
+            # The PlaybookTriggerManager launched the playbook when the event happened, execute immediately
+            pass
+
         # Check data dependencies
         needs = {dep: shared_data.get(dep) for dep in self.data_dependencies}
         if needs and any(value is None for value in needs.values()):
@@ -1137,6 +1321,245 @@ class PlaybookFunction:
     def update_data_dependencies(self, data_dependencies):
         self.data_dependencies = data_dependencies
 
+class EventMatcher:
+    """
+    Matches events against many predicates at once, with the counting algorithm.
+
+    A predicate is a {field: value or list of values} dictionary whose fields must all match. Predicates are
+    indexed by field and value, so an event looks up each indexed field once and counts the hits of each
+    predicate, and the predicates hit on all their fields match. Matching an event costs the same for 1 or
+    1000 predicates, apart from the matches themselves. Events can be dictionaries or objects.
+    """
+    def __init__(self):
+        self._index = {}     # field -> {value: [predicate ids]}
+        self._sizes = {}     # predicate id -> number of fields
+        self._keys = {}      # predicate id -> key returned on a match, e.g. a playbook name
+        self._match_all = [] # predicate ids without fields
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def add(self, key, predicate):
+        """Add a predicate, `key` is returned by match() for the events it matches. Returns the predicate's id."""
+        with self._lock:
+            predicate_id = self._next_id
+            self._next_id += 1
+            self._keys[predicate_id] = key
+            self._sizes[predicate_id] = len(predicate)
+            if not predicate:
+                self._match_all.append(predicate_id)
+            for field, values in predicate.items():
+                if not isinstance(values, (list, tuple, set)):
+                    values = [values]
+                index = self._index.setdefault(field, {})
+                for value in set(values):
+                    index.setdefault(self._normalize(value), []).append(predicate_id)
+            return predicate_id
+
+    def remove(self, key):
+        """Remove every predicate added with `key`."""
+        with self._lock:
+            removed = {predicate_id for predicate_id, predicate_key in self._keys.items() if predicate_key == key}
+            for predicate_id in removed:
+                del self._keys[predicate_id]
+                del self._sizes[predicate_id]
+            self._match_all = [predicate_id for predicate_id in self._match_all if predicate_id not in removed]
+            for field in list(self._index):
+                index = self._index[field]
+                for value in list(index):
+                    index[value] = [predicate_id for predicate_id in index[value] if predicate_id not in removed]
+                    if not index[value]:
+                        del index[value]
+                if not index:
+                    del self._index[field]
+
+    def match(self, event):
+        """Returns the keys of the predicates matching `event`, without duplicates."""
+        get = event.get if isinstance(event, dict) else lambda field: getattr(event, field, None)
+        normalize = self._normalize
+        counts = {}
+        # add and remove may run concurrently, e.g. when a playbook is disabled while events are ingested
+        with self._lock:
+            for field, index in self._index.items():
+                predicate_ids = index.get(normalize(get(field)))
+                if predicate_ids:
+                    for predicate_id in predicate_ids:
+                        counts[predicate_id] = counts.get(predicate_id, 0) + 1
+            sizes, keys = self._sizes, self._keys
+            matched = [keys[predicate_id] for predicate_id in self._match_all]
+            matched.extend(keys[predicate_id] for predicate_id, count in counts.items() if count == sizes[predicate_id])
+        return list(dict.fromkeys(matched))
+
+    @staticmethod
+    def _normalize(value):
+        # Log fields are strings, while YAML gives numbers for values such as ports
+        return value if value is None or value.__class__ is str else str(value)
+
+    def __len__(self):
+        return len(self._keys)
+
+class PlaybookTriggerManager:
+    """
+    Launches playbooks when the events they are triggered by happen, instead of polling for them.
+
+    The trigger of a playbook's first function can be an event trigger, {'type': 'event', 'match': {field: value}},
+    matched against every ingested log event by a single EventMatcher, or a threshold trigger,
+    {'type': 'threshold', 'aggregate': name, 'threshold': N}, registered with an integration's analytics.
+    Triggered playbooks are launched by a pool of `TRIGGER_WORKERS` threads, so a slow playbook doesn't delay
+    the others, and the pool is idle while nothing happens. A playbook runs at most once at a time: a trigger
+    firing while it runs queues a single follow-up run, and further triggers are merged into that one.
+    Events only arrive while logs are ingested, so the logs of an integration without a running syslog
+    listener are downloaded every `log_poll_interval` seconds (POLL_INTERVAL by default).
+    """
+    TRIGGER_TYPES = ('event', 'threshold')
+    TRIGGER_WORKERS = 4
+    POLL_INTERVAL = 30
+
+    def __init__(self, playbook_mgr, config_mgr):
+        self.playbook_mgr = playbook_mgr
+        self.config_mgr = config_mgr
+        self.matcher = EventMatcher()
+        self.thresholds = {}  # playbook name -> threshold trigger
+        self._attached = []   # (integration, threshold callbacks)
+        self._queued = {}     # playbook name -> shared data of its next run
+        self._running = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pollers = []
+        self._stopping = threading.Event()
+        self.fired = 0
+        self.log = Log.get_instance()
+
+    def arm(self, playbook_name, trigger):
+        """Register a playbook's event or threshold trigger."""
+        trigger_type = trigger.get('type')
+        if trigger_type == 'event':
+            self.matcher.add(playbook_name, trigger.get('match') or {})
+        elif trigger_type == 'threshold':
+            if not trigger.get('aggregate') or trigger.get('threshold') is None:
+                raise ValueError(f"Threshold trigger of playbook {playbook_name} needs an aggregate and a threshold.")
+            self.thresholds[playbook_name] = trigger
+            for integration, callbacks in self._attached:
+                self._add_threshold(integration, callbacks, playbook_name, trigger)
+        else:
+            raise ValueError(f"Invalid trigger type for playbook {playbook_name}: {trigger_type}")
+        self.log.info(f"Playbook {playbook_name} will be launched by its {trigger_type} trigger.")
+
+    def disarm(self, playbook_name):
+        """Stop launching a playbook from its trigger."""
+        self.matcher.remove(playbook_name)
+        if self.thresholds.pop(playbook_name, None) is not None:
+            for integration, callbacks in self._attached:
+                callback = callbacks.pop(playbook_name, None)
+                if callback is not None:
+                    integration.analytics.remove_threshold(callback.aggregate, callback)
+
+    def arm_playbooks(self, playbook_names):
+        """Register the triggers of the playbooks whose first function has an event or threshold trigger."""
+        armed = []
+        for playbook_name in playbook_names:
+            playbook = Playbook(playbook_name)
+            if not playbook.logic or playbook.logic[0].trigger_type not in self.TRIGGER_TYPES:
+                continue
+            try:
+                self.arm(playbook_name, playbook.logic[0].trigger)
+                armed.append(playbook)
+            except ValueError as e:
+                self.log.error(str(e))
+        return armed
+
+    def attach(self, integration):
+        """Receive an integration's log events (its `log_mgr`) and threshold crossings (its `analytics`)."""
+        log_mgr = getattr(integration, 'log_mgr', None)
+        if log_mgr is not None and hasattr(log_mgr, 'add_event_listener'):
+            log_mgr.add_event_listener(self.dispatch)
+            if getattr(integration, 'syslog_listener', None) is None:
+                self._start_poller(integration)
+        callbacks = {}
+        self._attached.append((integration, callbacks))
+        for playbook_name, trigger in self.thresholds.items():
+            self._add_threshold(integration, callbacks, playbook_name, trigger)
+
+    def _start_poller(self, integration):
+        """Download the integration's firewall logs periodically, since nothing pushes them."""
+        if not hasattr(integration, 'update_log_cache'):
+            self.log.warning(f"Nothing feeds the logs of {type(integration).__name__}, its events only reach the triggers "
+                             "when a playbook downloads its logs.")
+            return
+        interval = getattr(integration, 'log_poll_interval', None) or self.POLL_INTERVAL
+        self.log.warning(f"The syslog listener of {type(integration).__name__} is not running, triggers will receive its "
+                         f"firewall logs by downloading them every {interval} seconds.")
+        def poll():
+            while not self._stopping.is_set():
+                try:
+                    integration.update_log_cache('firewall', interval)
+                except Exception as e:
+                    self.log.error(f"Error polling the firewall logs for the playbook triggers: {e}")
+                self._stopping.wait(interval)
+        poller = threading.Thread(target=poll, name='pysoar-trigger-poller', daemon=True)
+        self._pollers.append(poller)
+        poller.start()
+
+    def _add_threshold(self, integration, callbacks, playbook_name, trigger):
+        analytics = getattr(integration, 'analytics', None)
+        if analytics is None or trigger['aggregate'] not in analytics.aggregates:
+            return
+        def callback(name, key, value, event):
+            self.fire(playbook_name, {'aggregate': name, 'key': key, 'value': value, 'event': self._event_data(event)})
+        callback.aggregate = trigger['aggregate']
+        analytics.add_threshold(trigger['aggregate'], trigger['threshold'], callback)
+        callbacks[playbook_name] = callback
+
+    def dispatch(self, events):
+        """Match ingested events against the event triggers. Returns the number of playbooks triggered."""
+        fired = 0
+        match = self.matcher.match
+        for event in events:
+            for playbook_name in match(event):
+                fired += self.fire(playbook_name, {'event': self._event_data(event)})
+        return fired
+
+    def fire(self, playbook_name, shared_data=None):
+        """Queue a playbook launch, unless a launch of the playbook is already queued. Returns True if it was queued."""
+        with self._lock:
+            if playbook_name in self._queued:
+                return False
+            self._queued[playbook_name] = shared_data
+            self.fired += 1
+            if playbook_name in self._running:
+                # The running launch starts the queued run when it finishes
+                return True
+            self._running.add(playbook_name)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.TRIGGER_WORKERS, thread_name_prefix='pysoar-playbook-trigger')
+            self._executor.submit(self._launch, playbook_name)
+        return True
+
+    def stop(self):
+        """Stop polling logs, and stop the launching threads once the queued playbooks have been launched."""
+        self._stopping.set()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _launch(self, playbook_name):
+        while True:
+            with self._lock:
+                shared_data = self._queued.pop(playbook_name)
+            try:
+                self.playbook_mgr.launch_playbook(playbook_name, self.config_mgr, shared_data=shared_data)
+            except Exception as e:
+                self.log.error(f"Error running triggered playbook {playbook_name}: {e}")
+                self.log.error(f"An error occurred: {e}\n{traceback.format_exc()}")
+            with self._lock:
+                if playbook_name not in self._queued:
+                    self._running.discard(playbook_name)
+                    return
+
+    @staticmethod
+    def _event_data(event):
+        return event.to_dict() if hasattr(event, 'to_dict') else event
+
 class PlaybookFlowchart:
     def __init__(self, playbook_logic):
         self.playbook_logic = playbook_logic
@@ -1179,6 +1602,212 @@ class PlaybookFlowchart:
             self.build_flowchart()
         return self.fc.flowchart()
 
+class Debouncer:
+    """
+    Coalesces repeated triggers into a single call of `callback` on a background thread.
+
+    The callback runs once `delay` seconds have passed without a new trigger, or once `max_latency`
+    seconds have passed since the first pending trigger, whichever comes first.
+    """
+    # Seconds the background thread stays alive without any triggers before exiting
+    IDLE_TIMEOUT = 30
+
+    def __init__(self, callback, delay=1.0, max_latency=5.0, name='pysoar-debouncer'):
+        self.delay = delay
+        self.max_latency = max_latency
+        self._callback = callback
+        self._name = name
+        self._condition = threading.Condition()
+        self._callback_lock = threading.Lock()  # Never run the callback twice at the same time
+        self._first_trigger = None
+        self._last_trigger = None
+        self._thread = None
+        self.log = Log.get_instance()
+
+    def trigger(self):
+        """Schedules the callback, postponing it by `delay` seconds up to the `max_latency` bound."""
+        with self._condition:
+            now = time.monotonic()
+            if self._first_trigger is None:
+                self._first_trigger = now
+            self._last_trigger = now
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def flush(self):
+        """Runs the callback now if a trigger is pending. Returns the callback's result, or None."""
+        with self._condition:
+            if self._first_trigger is None:
+                return None
+            self._first_trigger = self._last_trigger = None
+        with self._callback_lock:
+            return self._callback()
+
+    @property
+    def pending(self):
+        return self._first_trigger is not None
+
+    def _run(self):
+        with self._condition:
+            while True:
+                if self._first_trigger is None:
+                    # Nothing to do, exit the thread if no trigger arrives before the idle timeout
+                    self._condition.wait(timeout=self.IDLE_TIMEOUT)
+                    if self._first_trigger is None:
+                        self._thread = None
+                        return
+                    continue
+                due = min(self._last_trigger + self.delay, self._first_trigger + self.max_latency)
+                now = time.monotonic()
+                if now < due:
+                    self._condition.wait(timeout=due - now)
+                    continue
+                self._first_trigger = self._last_trigger = None
+                self._condition.release()
+                try:
+                    with self._callback_lock:
+                        self._callback()
+                except Exception as e:
+                    self.log.error(f"Error in {self._name}: {e}")
+                    self.log.error(f"An error occurred: {e}\n{traceback.format_exc()}")
+                finally:
+                    self._condition.acquire()
+
+class PersistenceManager:
+    """
+    Write-behind persistence for the YAML configuration and playbook files.
+
+    Saves are queued in memory and written by a background thread, so several rapid edits to the same
+    file end up as a single write. Each write goes to a temporary file that is fsynced and then renamed
+    over the original, and files whose content has not changed are not rewritten at all.
+    """
+    _instance = None
+    # Seconds to wait for further edits before writing, and the longest an edit may stay unwritten
+    WRITE_DELAY = 1.0
+    MAX_WRITE_LATENCY = 5.0
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, delay=WRITE_DELAY, max_latency=MAX_WRITE_LATENCY):
+        self._pending = {}  # path -> (data, yaml.safe_dump keyword arguments)
+        self._digests = {}  # path -> sha256 of the content currently on disk
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # Keeps writes to the same file in order
+        self._debouncer = Debouncer(self.flush, delay, max_latency, name='pysoar-persistence')
+        self.log = Log.get_instance()
+        atexit.register(self.flush)  # Don't lose queued edits when the application exits
+
+    def save(self, path, data, **dump_kwargs):
+        """Queues `data` to be written to `path` as YAML. A later save to the same path replaces this one."""
+        with self._lock:
+            self._pending[path] = (copy.deepcopy(data), dump_kwargs)
+        self._debouncer.trigger()
+
+    def write_now(self, path, data, **dump_kwargs):
+        """Atomically writes `data` to `path` as YAML right away. Returns True if the file changed."""
+        with self._write_lock:
+            with self._lock:
+                self._pending.pop(path, None)
+            return self._write(path, data, dump_kwargs)
+
+    def flush(self, path=None):
+        """Writes the queued data to disk now, for `path` only if given."""
+        with self._write_lock:
+            with self._lock:
+                if path is None:
+                    pending, self._pending = self._pending, {}
+                elif path in self._pending:
+                    pending = {path: self._pending.pop(path)}
+                else:
+                    return
+            for file_path, (data, dump_kwargs) in pending.items():
+                try:
+                    self._write(file_path, data, dump_kwargs)
+                except Exception as e:
+                    self.log.error(f"Could not write {file_path}: {e}")
+                    self.log.error(f"An error occurred: {e}\n{traceback.format_exc()}")
+
+    def discard(self, path):
+        """Drops any queued write for `path`, e.g. because the file is being deleted."""
+        with self._lock:
+            self._pending.pop(path, None)
+        self._digests.pop(path, None)
+
+    def exists(self, path):
+        """Returns True if `path` is on disk or has a queued write, e.g. a file created less than WRITE_DELAY ago."""
+        with self._lock:
+            if path in self._pending:
+                return True
+        return os.path.isfile(path)
+
+    def flush_directory(self, directory):
+        """Writes the queued data of the files in `directory` now, so that listing the directory finds them."""
+        directory = os.path.abspath(directory)
+        for path in self.pending:
+            if os.path.dirname(os.path.abspath(path)) == directory:
+                self.flush(path)
+
+    @property
+    def pending(self):
+        """List of paths with queued writes."""
+        with self._lock:
+            return list(self._pending)
+
+    def _write(self, path, data, dump_kwargs):
+        content = yaml.safe_dump(data, **dump_kwargs).encode()
+        digest = hashlib.sha256(content).hexdigest()
+        if digest == self._current_digest(path):
+            self.log.debug(f"{path} is unchanged, skipping write.")
+            return False
+        directory = os.path.dirname(path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            # Keep the permissions of the file being replaced
+            mode = stat.S_IMODE(os.stat(path).st_mode) if os.path.exists(path) else 0o644
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._fsync_directory(directory)
+        self._digests[path] = digest
+        self.log.debug(f"{path} written to disk.")
+        return True
+
+    def _current_digest(self, path):
+        if path not in self._digests:
+            try:
+                with open(path, 'rb') as f:
+                    self._digests[path] = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                return None
+        return self._digests[path]
+
+    @staticmethod
+    def _fsync_directory(directory):
+        # Persist the rename itself (not supported on every platform)
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
 class Log:
     _instance = None
 
@@ -0,0 +1,578 @@
+"""Compact Indicator Containers"""
+import ipaddress
+import math
+import socket
+import sys
+from array import array
+from bisect import bisect_right
+from hashlib import blake2b
+from urllib.parse import urlsplit, urlunsplit
+
+# Data types whose values are IP addresses or networks
+IP_DATA_TYPES = ('ip-dst', 'ip-src', 'ip')
+# Data types whose values are hex encoded hashes
+HASH_DATA_TYPES = ('hash', 'md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
+# Data types whose values are domain or host names
+DOMAIN_DATA_TYPES = ('domain', 'hostname')
+# Lengths of the hex encoded MD5, SHA-1, SHA-224, SHA-256, SHA-384 and SHA-512 digests
+HASH_LENGTHS = {32, 40, 56, 64, 96, 128}
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+def parse_ip_range(value):
+    """
+    Parse an IP address or network into a (version, first, last) tuple of integers.
+
+    IPv4 and IPv6 host addresses take a fast path through socket.inet_pton. Raises ValueError if the
+    value is not a valid address or network.
+    """
+    if isinstance(value, int):
+        return (4 if value <= 0xFFFFFFFF else 6), value, value
+    if not isinstance(value, str):
+        value = str(value)
+    if '/' not in value:
+        try:
+            number = int.from_bytes(socket.inet_pton(socket.AF_INET, value), 'big')
+            return 4, number, number
+        except OSError:
+            pass
+        try:
+            number = int.from_bytes(socket.inet_pton(socket.AF_INET6, value), 'big')
+            return 6, number, number
+        except OSError:
+            raise ValueError(f"Invalid IP address: {value}")
+    network = ipaddress.ip_network(value, strict=False)
+    return network.version, int(network.network_address), int(network.broadcast_address)
+
+def _normalize_ip(value):
+    version, first, last = parse_ip_range(value.strip() if isinstance(value, str) else value)
+    address = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+    if first == last:
+        return str(address(first))
+    return str(next(ipaddress.summarize_address_range(address(first), address(last))))
+
+def _normalize_hash(value):
+    value = value.strip().lower()
+    if len(value) not in HASH_LENGTHS or not HEX_DIGITS.issuperset(value):
+        raise ValueError(f"Invalid hash: {value}")
+    return value
+
+def _normalize_domain(value):
+    value = value.strip().rstrip('.').lower()
+    if not value or any(character.isspace() for character in value):
+        raise ValueError(f"Invalid domain: {value}")
+    if not value.isascii():
+        value = value.encode('idna').decode('ascii')
+    return value
+
+def _normalize_url(value):
+    parts = urlsplit(value.strip())
+    if not parts.scheme or not parts.netloc:
+        raise ValueError(f"Invalid URL: {value}")
+    netloc = parts.netloc
+    if '@' not in netloc:
+        # Host names are case insensitive, the path and query are not
+        netloc = netloc.lower().replace('.:', ':').rstrip('.')
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path or '/', parts.query, ''))
+
+def _normalize_email(value):
+    local, separator, domain = value.strip().rpartition('@')
+    if not local or not separator or not domain:
+        raise ValueError(f"Invalid email address: {value}")
+    return f"{local}@{_normalize_domain(domain)}"
+
+def normalize_indicator(data_type, value):
+    """
+    Returns the canonical, interned form of an indicator value.
+
+    IPs are written in their shortest form (hosts without a prefix length, networks by their network
+    address), hashes, domains and email domains are lowercased, and URLs get a lowercase scheme and host.
+    Values of other data types are only stripped. Raises ValueError if the value is not valid for the type.
+    """
+    if data_type in IP_DATA_TYPES:
+        value = _normalize_ip(value)
+    elif not isinstance(value, str):
+        raise ValueError(f"Invalid {data_type} value: {value!r}")
+    elif data_type in HASH_DATA_TYPES:
+        value = _normalize_hash(value)
+    elif data_type in DOMAIN_DATA_TYPES:
+        value = _normalize_domain(value)
+    elif data_type == 'url':
+        value = _normalize_url(value)
+    elif data_type in ('email', 'email-src', 'email-dst'):
+        value = _normalize_email(value)
+    else:
+        value = value.strip()
+        if not value:
+            raise ValueError(f"Empty {data_type} value")
+    return sys.intern(value)
+
+def iter_normalized_indicators(data_type, values):
+    """Yield the canonical form of each value once, in the order first seen. Invalid values are skipped."""
+    seen = set()
+    for value in values:
+        try:
+            value = normalize_indicator(data_type, value)
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if value not in seen:
+            seen.add(value)
+            yield value
+
+def normalize_indicators(data_type, values):
+    """
+    Canonicalize and deduplicate indicator values, keeping the order they were first seen in.
+
+    For IP data types, hosts and networks that fall inside another listed network are dropped as well,
+    since blocking the network already covers them.
+    """
+    values = list(iter_normalized_indicators(data_type, values))
+    if data_type not in IP_DATA_TYPES or not any('/' in value for value in values):
+        return values
+    # Sweep the ranges by start address, largest first: CIDRs either nest or are disjoint, so a range is
+    # covered exactly when it ends before the furthest end seen so far
+    ranges = sorted((parse_ip_range(value) + (index,) for index, value in enumerate(values)),
+                    key=lambda entry: (entry[0], entry[1], -entry[2]))
+    covered, version, furthest = set(), None, -1
+    for entry_version, first, last, index in ranges:
+        if entry_version != version:
+            version, furthest = entry_version, -1
+        if last <= furthest:
+            covered.add(index)
+        else:
+            furthest = last
+    return [value for index, value in enumerate(values) if index not in covered]
+
+class IPSet:
+    """
+    Set of IPv4 and IPv6 addresses and networks, stored as sorted, merged integer ranges.
+
+    IPv4 ranges are packed into unsigned 32-bit arrays (8 bytes per range), and adjacent or overlapping
+    entries are merged, so a feed of CIDRs and hosts costs a few bytes per entry. Membership tests are a
+    binary search. Additions are buffered and merged in on the next lookup.
+    """
+
+    def __init__(self, networks=()):
+        self._v4_starts = array('I')
+        self._v4_ends = array('I')
+        self._v6_starts = []
+        self._v6_ends = []
+        self._pending = []  # (version, first, last) added since the last merge
+        self.update(networks)
+
+    def add(self, network):
+        """Add an address or network (string, integer or ipaddress object)."""
+        self._pending.append(parse_ip_range(network))
+
+    def update(self, networks):
+        """Add several addresses or networks. Invalid values raise ValueError."""
+        self._pending.extend(parse_ip_range(network) for network in networks)
+
+    def difference_update(self, networks):
+        """Remove several addresses or networks, splitting stored ranges where needed."""
+        removals = IPSet(networks)
+        removals._merge()
+        self._merge()
+        self._v4_starts, self._v4_ends = self._subtract(self._v4_starts, self._v4_ends, removals._v4_starts, removals._v4_ends, 'I')
+        self._v6_starts, self._v6_ends = self._subtract(self._v6_starts, self._v6_ends, removals._v6_starts, removals._v6_ends, None)
+
+    def discard(self, network):
+        """Remove an address or network."""
+        self.difference_update([network])
+
+    def __contains__(self, ip):
+        if self._pending:
+            self._merge()
+        try:
+            version, first, last = parse_ip_range(ip)
+        except ValueError:
+            return False
+        starts, ends = (self._v4_starts, self._v4_ends) if version == 4 else (self._v6_starts, self._v6_ends)
+        index = bisect_right(starts, first) - 1
+        return index >= 0 and last <= ends[index]
+
+    def contains_many(self, ips):
+        """Returns the addresses (or networks) in `ips` that are fully covered by the set."""
+        return [ip for ip in ips if ip in self]
+
+    def __len__(self):
+        """Number of merged ranges in the set."""
+        self._merge()
+        return len(self._v4_starts) + len(self._v6_starts)
+
+    def __iter__(self):
+        """Yield the smallest list of ipaddress networks covering the set, IPv4 first."""
+        self._merge()
+        for starts, ends, address in ((self._v4_starts, self._v4_ends, ipaddress.IPv4Address),
+                                      (self._v6_starts, self._v6_ends, ipaddress.IPv6Address)):
+            for first, last in zip(starts, ends):
+                yield from ipaddress.summarize_address_range(address(first), address(last))
+
+    @property
+    def num_addresses(self):
+        """Number of individual addresses covered by the set."""
+        self._merge()
+        return (sum(last - first + 1 for first, last in zip(self._v4_starts, self._v4_ends))
+                + sum(last - first + 1 for first, last in zip(self._v6_starts, self._v6_ends)))
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the stored ranges."""
+        self._merge()
+        return (self._v4_starts.itemsize * (len(self._v4_starts) + len(self._v4_ends))
+                + 2 * 16 * len(self._v6_starts))
+
+    def _merge(self):
+        """Merge the pending additions into the sorted ranges."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        v4 = list(zip(self._v4_starts, self._v4_ends)) + [(first, last) for version, first, last in pending if version == 4]
+        v6 = list(zip(self._v6_starts, self._v6_ends)) + [(first, last) for version, first, last in pending if version == 6]
+        v4_starts, v4_ends = self._merge_ranges(v4)
+        self._v4_starts, self._v4_ends = array('I', v4_starts), array('I', v4_ends)
+        self._v6_starts, self._v6_ends = self._merge_ranges(v6)
+
+    @staticmethod
+    def _merge_ranges(ranges):
+        starts, ends = [], []
+        for first, last in sorted(ranges):
+            if ends and first <= ends[-1] + 1:
+                if last > ends[-1]:
+                    ends[-1] = last
+            else:
+                starts.append(first)
+                ends.append(last)
+        return starts, ends
+
+    @staticmethod
+    def _subtract(starts, ends, removal_starts, removal_ends, typecode):
+        new_starts, new_ends = [], []
+        index, count = 0, len(removal_starts)
+        for first, last in zip(starts, ends):
+            # Skip removals that end before this range
+            while index < count and removal_ends[index] < first:
+                index += 1
+            cursor, position = first, index
+            while position < count and removal_starts[position] <= last:
+                if removal_starts[position] > cursor:
+                    new_starts.append(cursor)
+                    new_ends.append(removal_starts[position] - 1)
+                cursor = max(cursor, removal_ends[position] + 1)
+                position += 1
+            if cursor <= last:
+                new_starts.append(cursor)
+                new_ends.append(last)
+        if typecode:
+            return array(typecode, new_starts), array(typecode, new_ends)
+        return new_starts, new_ends
+
+class PrefixMap:
+    """
+    Longest-prefix match map from IP networks to values.
+
+    Networks are kept in one hash table per prefix length, and a lookup probes the prefix lengths in use
+    from the most to the least specific, so its cost depends on the number of distinct prefix lengths
+    (a handful in practice), not on the number of networks.
+    """
+
+    def __init__(self, items=()):
+        self._tables = {4: {}, 6: {}}   # version -> {prefix length: {network integer: [values]}}
+        self._lengths = {4: [], 6: []}  # version -> prefix lengths in use, most specific first
+        self._count = 0
+        for network, value in items:
+            self.add(network, value)
+
+    @staticmethod
+    def _parse(network):
+        """Returns the (version, prefix length, network integer) of an address, network or parsed range."""
+        if isinstance(network, tuple):
+            version, first, last = network
+        else:
+            version, first, last = parse_ip_range(network.strip() if isinstance(network, str) else network)
+        bits = 32 if version == 4 else 128
+        return version, bits - (last - first).bit_length(), first
+
+    def add(self, network, value):
+        """
+        Map an address or network to a value. A network can be mapped to several values.
+
+        The network can also be given as a (version, first, last) tuple from parse_ip_range.
+        """
+        version, prefixlen, key = self._parse(network)
+        table = self._tables[version].get(prefixlen)
+        if table is None:
+            table = self._tables[version][prefixlen] = {}
+            self._lengths[version] = sorted(self._tables[version], reverse=True)
+        table.setdefault(key, []).append(value)
+        self._count += 1
+
+    def discard(self, network, value):
+        """Remove a value from a network, if it is mapped to it."""
+        try:
+            version, prefixlen, key = self._parse(network)
+        except ValueError:
+            return
+        table = self._tables[version].get(prefixlen, {})
+        values = table.get(key)
+        if values and value in values:
+            values.remove(value)
+            self._count -= 1
+            if not values:
+                del table[key]
+            if not table and prefixlen in self._tables[version]:
+                del self._tables[version][prefixlen]
+                self._lengths[version] = sorted(self._tables[version], reverse=True)
+
+    def get(self, network, default=None):
+        """Returns the values mapped to exactly this network (not to networks covering it)."""
+        try:
+            version, prefixlen, key = self._parse(network)
+        except ValueError:
+            return default
+        values = self._tables[version].get(prefixlen, {}).get(key)
+        return list(values) if values else default
+
+    def match_all(self, ip):
+        """Returns the values of every network covering the address or network, most specific first."""
+        try:
+            version, prefixlen, key = self._parse(ip)
+        except ValueError:
+            return []
+        bits = 32 if version == 4 else 128
+        tables, matches = self._tables[version], []
+        for length in self._lengths[version]:
+            if length > prefixlen:
+                continue
+            shift = bits - length
+            values = tables[length].get(key >> shift << shift)
+            if values:
+                matches.extend(values)
+        return matches
+
+    def longest_match(self, ip, default=None):
+        """Returns the first value of the most specific network covering the address or network."""
+        try:
+            version, prefixlen, key = self._parse(ip)
+        except ValueError:
+            return default
+        bits = 32 if version == 4 else 128
+        tables = self._tables[version]
+        for length in self._lengths[version]:
+            if length <= prefixlen:
+                shift = bits - length
+                values = tables[length].get(key >> shift << shift)
+                if values:
+                    return values[0]
+        return default
+
+    def __contains__(self, ip):
+        return self.longest_match(ip) is not None
+
+    def __len__(self):
+        """Number of (network, value) mappings."""
+        return self._count
+
+def aggregate_networks(values):
+    """
+    Collapse IP addresses and networks into the smallest equivalent list of CIDRs, IPv4 first.
+
+    Adjacent and overlapping entries are merged (e.g. 10.0.0.0/25 and 10.0.0.128/25 become 10.0.0.0/24)
+    and hosts are written without a prefix length. Invalid values are skipped.
+
+    Returns:
+        A tuple of the aggregated networks and a dictionary of statistics: the number of valid input
+        values, invalid values skipped, output networks, and the percentage the list was reduced by.
+    """
+    ip_set, count, invalid = IPSet(), 0, 0
+    for value in values:
+        try:
+            ip_set.add(value.strip() if isinstance(value, str) else value)
+            count += 1
+        except ValueError:
+            invalid += 1
+    networks = [str(network.network_address) if network.prefixlen == network.max_prefixlen else str(network)
+                for network in ip_set]
+    stats = {
+        'input': count,
+        'invalid': invalid,
+        'output': len(networks),
+        'reduction': round(100 * (1 - len(networks) / count), 1) if count else 0.0,
+    }
+    return networks, stats
+
+class DigestSet:
+    """
+    Set of hashes stored as fixed-width binary digests.
+
+    Digests of each length (MD5, SHA-1, SHA-256, ...) are kept sorted in their own packed byte buffer and
+    found by binary search, so a SHA-256 costs 32 bytes instead of a ~100 byte Python string.
+    """
+
+    def __init__(self, digests=()):
+        self._tables = {}  # digest length -> sorted, concatenated digests
+        self._pending = set()
+        self.update(digests)
+
+    @staticmethod
+    def to_digest(value):
+        """Convert a hex string (any case, surrounding whitespace allowed) or bytes to a binary digest."""
+        if isinstance(value, (bytes, bytearray)):
+            return bytes(value)
+        return bytes.fromhex(value.strip())
+
+    def add(self, digest):
+        self._pending.add(self.to_digest(digest))
+
+    def update(self, digests):
+        self._pending.update(self.to_digest(digest) for digest in digests)
+
+    def __contains__(self, digest):
+        try:
+            digest = self.to_digest(digest)
+        except (ValueError, AttributeError):
+            return False
+        if digest in self._pending:
+            return True
+        table = self._tables.get(len(digest))
+        if not table:
+            return False
+        width = len(digest)
+        low, high = 0, len(table) // width
+        while low < high:
+            middle = (low + high) // 2
+            entry = table[middle * width:(middle + 1) * width]
+            if entry < digest:
+                low = middle + 1
+            elif entry > digest:
+                high = middle
+            else:
+                return True
+        return False
+
+    def contains_many(self, digests):
+        """Returns the values in `digests` that are in the set."""
+        self._merge()
+        return [digest for digest in digests if digest in self]
+
+    def __len__(self):
+        self._merge()
+        return sum(len(table) // width for width, table in self._tables.items())
+
+    def __iter__(self):
+        """Yield the digests as lowercase hex strings."""
+        self._merge()
+        for width, table in self._tables.items():
+            for offset in range(0, len(table), width):
+                yield table[offset:offset + width].hex()
+
+    @property
+    def nbytes(self):
+        self._merge()
+        return sum(len(table) for table in self._tables.values())
+
+    def _merge(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, set()
+        by_width = {}
+        for digest in pending:
+            by_width.setdefault(len(digest), set()).add(digest)
+        for width, digests in by_width.items():
+            table = self._tables.get(width, b'')
+            digests.update(table[offset:offset + width] for offset in range(0, len(table), width))
+            self._tables[width] = b''.join(sorted(digests))
+
+class BloomFilter:
+    """
+    Probabilistic set membership prefilter.
+
+    Never reports a false negative, and reports false positives at roughly `error_rate` once `capacity`
+    items have been added. Use it in front of a slower exact lookup (e.g. the IOC store) to skip it for
+    values that are certainly unknown.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+        self._count = 0
+
+    def _positions(self, item):
+        if not isinstance(item, (bytes, bytearray)):
+            item = str(item).encode()
+        digest = blake2b(item, digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def __len__(self):
+        """Number of items added (including duplicates)."""
+        return self._count
+
+    @property
+    def nbytes(self):
+        return len(self._bits)
+
+class PrefilteredSet:
+    """
+    Wraps an exact set (or anything with `__contains__`) with a Bloom filter to skip most misses.
+
+    `key` converts a value to the form added to the Bloom filter, e.g. a binary digest for hashes.
+    """
+
+    def __init__(self, exact_set, bloom, key=None):
+        self.exact_set = exact_set
+        self.bloom = bloom
+        self._key = key
+
+    def __contains__(self, item):
+        try:
+            bloom_key = self._key(item) if self._key else item
+        except (ValueError, TypeError, AttributeError):
+            return False
+        return bloom_key in self.bloom and item in self.exact_set
+
+    def contains_many(self, items):
+        return [item for item in items if item in self]
+
+    def __len__(self):
+        return len(self.exact_set)
+
+def indicator_set(data_type, values=(), prefilter=False, error_rate=0.01):
+    """
+    Build the most compact container for the given data type.
+
+    IP data types use an IPSet, hashes a DigestSet, and every other type a set of interned strings.
+    Invalid values are skipped. If `prefilter` is True, a Bloom filter sized for the values is added in
+    front of hash and string sets (IPSets cover whole networks, so they are never prefiltered).
+    """
+    if data_type in IP_DATA_TYPES:
+        container, key = IPSet(), None
+    elif data_type in HASH_DATA_TYPES:
+        container, key = DigestSet(), DigestSet.to_digest
+    else:
+        container, key = set(), None
+    for value in values:
+        try:
+            container.add(sys.intern(value) if isinstance(container, set) and isinstance(value, str) else value)
+        except (ValueError, TypeError, AttributeError):
+            continue
+    if prefilter and not isinstance(container, IPSet):
+        bloom = BloomFilter(len(container), error_rate)
+        for value in container:
+            bloom.add(key(value) if key else value)
+        return PrefilteredSet(container, bloom, key)
+    return container
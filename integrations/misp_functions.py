@@ -1,9 +1,14 @@
 """Integration Specific Functions"""
+import atexit
+import threading
+import time
 from pymisp import ExpandedPyMISP as PyMISP
 from pymisp import MISPEvent
 from pymisp import MISPAttribute
 from pymisp import MISPTag
-from classes import Log
+from classes import Log, Debouncer
+from ioc_store import IocStore
+from indicators import indicator_set, iter_normalized_indicators, normalize_indicator, normalize_indicators
 
 class MispFunction:
     """Class for MISP functions."""
@@ -24,9 +29,32 @@ class MispFunction:
         'filename': ['filename_feed_id_1', 'filename_feed_id_2'],
         'email': ['email_feed_id_1', 'email_feed_id_2']
     }
+    # Reverse lookup of the data type for each feed name in FEEDS_BY_DATA_TYPE
+    DATA_TYPE_BY_FEED_NAME = {feed_name: data_type for data_type, feed_list in FEEDS_BY_DATA_TYPE.items() for feed_name in feed_list}
+    # Seconds the feed catalogue is cached before it is downloaded from MISP again
+    FEED_CACHE_TTL = 300
+    # Number of attributes requested per page when streaming attributes from MISP
+    ATTRIBUTE_PAGE_SIZE = 1000
+    # Seconds to wait for a feed caching job to finish, and between checks of its status
+    FEED_CACHE_TIMEOUT = 900
+    FEED_CACHE_POLL_INTERVAL = 5
+
     def __init__(self, misp_init):
         """Initialize the MISP class."""
         self.log = Log.get_instance()
+        # Feed catalogue cache
+        self._feeds = None
+        self._feed_index = ({}, {}, {})  # Feeds by name, by id and by data type, rebuilt on every refresh
+        self._feeds_expire_at = 0.0
+        self._feeds_lock = threading.Lock()
+        # Incremental sync watermarks by (feed_id, data_type)
+        self._watermarks = {}
+        self._reporter = None
+        self._sync_lock = threading.Lock()
+        self.feed_cache_ttl = self._get_setting(misp_init, 'feed_cache_ttl', self.FEED_CACHE_TTL)
+        # Data types synchronized into the local IOC store when the integration starts
+        self.ioc_sync_types = self._get_setting(misp_init, 'ioc_sync_types', []) or []
+        self.ioc_store_path = self._get_setting(misp_init, 'ioc_store_path', None)
         try:
             self.misp_api = PyMISP(misp_init.url, 
                 misp_init.api_key, 
@@ -37,7 +65,9 @@ class MispFunction:
             self.log.error(f"Error initializing MISP: {e}")
             return None
         self.enabled_feeds = self.get_enabled_feeds()
-        self._feeds = self._get_feeds()
+        if self.ioc_sync_types:
+            # Fill the IOC store in the background, the integration is usable before the sync finishes
+            threading.Thread(target=self.sync_iocs, name='pysoar-ioc-sync', daemon=True).start()
 
     def get_enabled_feeds(self):
         """Get the list of enabled feeds from MISP."""
@@ -45,22 +75,41 @@ class MispFunction:
         enabled_feeds = {}
         for feed in self.feeds:
             if feed['Feed']['enabled']:
-                feed_type = next((data_type for data_type, feed_list in self.FEEDS_BY_DATA_TYPE.items() if feed['Feed']['name'] in feed_list), None)
+                feed_type = self.DATA_TYPE_BY_FEED_NAME.get(feed['Feed']['name'])
+                # Copy the metadata so the cached feed catalogue is not modified
+                metadata = dict(feed['Feed'])
                 enabled_feeds[feed['Feed']['name']] = {
-                    'feed_id': feed['Feed']['id'],
+                    'feed_id': metadata.pop('id', None),
                     'data_types': feed_type,
-                    'metadata': feed['Feed']
+                    'metadata': metadata
                 }
-        # Remove the name and id from the metadata
-        for feed_name, feed_data in enabled_feeds.items():
-            feed_data['metadata'].pop('name', None)
-            feed_data['metadata'].pop('id', None)
+                # Remove the name from the metadata
+                metadata.pop('name', None)
         self.log.debug(f"Enabled feeds: {enabled_feeds}")
         return enabled_feeds
 
     def send_to_misp(self, event):
-        """Send an event to MISP."""
-        pass
+        """
+        Send an event to MISP.
+
+        A MISPEvent is added as is. A dictionary of data types to lists of values is buffered by the
+        reporter and sent in batches (see MispReporter).
+        """
+        if isinstance(event, MISPEvent):
+            return self.misp_api.add_event(event, pythonify=True)
+        for data_type, values in event.items():
+            self.report_indicators(data_type, values)
+        return True
+
+    def report_indicators(self, data_type, values, to_ids=True, comment=None):
+        """Queue indicators to be added to the PySOAR report event in MISP."""
+        for value in values:
+            self.reporter.add_attribute(data_type, value, to_ids=to_ids, comment=comment)
+
+    def report_sightings(self, values, source='PySOAR'):
+        """Queue sightings (e.g. firewall hits) of the given values to be sent to MISP."""
+        for value in values:
+            self.reporter.add_sighting(value, source=source)
 
     def get_misp_event(self, event_id):
         """Get an event from MISP."""
@@ -97,6 +146,8 @@ class MispFunction:
             self.misp_api.enable_feed(feed_id)
         except Exception as e:
             raise e
+        finally:
+            self.invalidate_feeds()  # The cached catalogue no longer reflects the feed's status
 
     def disable_threat_feed(self, feed_id):
         """Disables a threat feed in MISP by its id or name."""
@@ -104,15 +155,26 @@ class MispFunction:
             self.misp_api.disable_feed(feed_id)
         except Exception as e:
             raise e
+        finally:
+            self.invalidate_feeds()  # The cached catalogue no longer reflects the feed's status
     
     def check_enabled_by_name(self, feed_name):
         """Check if a feed is enabled in MISP by its feed_id."""
-        if next((feed['Feed'] for feed in self.feeds if feed['Feed']['name'] == feed_name and feed['Feed']['enabled']), None):
+        feed_data = self.feeds_by_name.get(feed_name)
+        if feed_data and feed_data['enabled']:
             return True
         else:
             return False
 
-    def ensure_feed_enabled(self, data_type):
+    def ensure_feed_enabled(self, data_type, wait_for_cache=False, progress=None):
+        """
+        Make sure a feed is enabled and cached in MISP for the given data type.
+
+        The feed's caching job is started but not waited for, unless `wait_for_cache` is True, in which case
+        the job is polled until it finishes. `progress(data_type, status)` is called as the work advances.
+        Raises an Exception if the feed can't be found or enabled.
+        """
+        report = progress or (lambda data_type, status: None)
         # Get list of potential feeds for this data type
         potential_feeds = (self.FEEDS_BY_DATA_TYPE.get(data_type, []))
 
@@ -121,29 +183,43 @@ class MispFunction:
 
         if enabled_feed_name:
             # A feed for this data type is already enabled
+            report(data_type, 'already enabled')
             return
 
         # If we reached here, we need to enable a feed for this data type
-        feed_to_enable = potential_feeds[0]  # You can modify the logic to choose which feed to enable if there are multiple
+        feed_to_enable = potential_feeds[0] if potential_feeds else None  # You can modify the logic to choose which feed to enable if there are multiple
         if feed_to_enable:
             # Retrieve the corresponding MISP's feed ID 
             feed_data = self._get_misp_feed_by_name(feed_to_enable)
+            if not feed_data:
+                # The feed may be one of MISP's default feeds that hasn't been loaded yet
+                self.load_default_feeds()
+                feed_data = self._get_misp_feed_by_name(feed_to_enable)
+            if not feed_data:
+                raise Exception(f"Error enabling feed {feed_to_enable}: feed not found in MISP")
+            feed_data = dict(feed_data)  # Copy so the cached feed catalogue is not modified
 
             # Toggle the feed using the MISP's feed ID and cache it
             try:
+                report(data_type, 'enabling')
                 self.enable_threat_feed(feed_data.get('id'))
-                self._cache_feed(feed_data.get('id'))
+                report(data_type, 'caching')
+                previous_cache = self.cache_feed(feed_data.get('id'))
 
                 # Verify the feed is now enabled
                 if self.check_enabled_by_name(feed_to_enable):
-                    print(f"Successfully enabled feed {feed_to_enable}")
+                    self.log.info(f"Successfully enabled feed {feed_to_enable}")
+
+                if wait_for_cache:
+                    cached = self.wait_for_feed_cache(feed_data.get('id'), previous_cache)
+                    report(data_type, 'cached' if cached else 'cache timed out')
 
             except Exception as e:
-                return (f"Error enabling feed {feed_to_enable}: {e}")
+                raise Exception(f"Error enabling feed {feed_to_enable}: {e}") from e
             
             feed_data.pop('enabled', None)  # Remove the enabled status from the feed data (not needed anymore
             feed_data.pop('name', None)
-            feed_id = feed_data.pop('ip', None)
+            feed_id = feed_data.pop('id', None)
             # Update the status of this feed in your enabled_feeds dictionary
             self.enabled_feeds[feed_to_enable] = {
                 'feed_id': feed_id,  # Fetching the feed ID again for assurance
@@ -152,6 +228,38 @@ class MispFunction:
             }
             return True
         
+    def cache_feed(self, feed_id):
+        """Start MISP's caching job for a feed. Returns the feed's cache timestamp from before the job."""
+        previous_cache = self._get_feed_cache_timestamp(feed_id)
+        self._cache_feed(feed_id)
+        return previous_cache
+
+    def wait_for_feed_cache(self, feed_id, previous_cache=None, timeout=None, poll_interval=None):
+        """
+        Poll MISP until the feed's cache timestamp moves past `previous_cache`.
+
+        Returns True once the caching job has finished, or False if it did not finish within `timeout` seconds.
+        """
+        timeout = self.FEED_CACHE_TIMEOUT if timeout is None else timeout
+        poll_interval = self.FEED_CACHE_POLL_INTERVAL if poll_interval is None else poll_interval
+        deadline = time.monotonic() + timeout
+        while True:
+            cache_timestamp = self._get_feed_cache_timestamp(feed_id)
+            if cache_timestamp and cache_timestamp != previous_cache:
+                return True
+            if time.monotonic() + poll_interval > deadline:
+                self.log.warning(f"Feed {feed_id} was not cached within {timeout} seconds.")
+                return False
+            time.sleep(poll_interval)
+
+    def _get_feed_cache_timestamp(self, feed_id):
+        """Get the time the feed was last cached by MISP, or None if it never was."""
+        try:
+            return self._get_cached_feed(feed_id).get('Feed', {}).get('cache_timestamp') or None
+        except Exception as e:
+            self.log.debug(f"Could not read the cache status of feed {feed_id}: {e}")
+            return None
+
     def _cache_feed(self, feed_id):
         """Cache the given feed."""
         try:
@@ -170,8 +278,16 @@ class MispFunction:
         """Get the event ID from the cached feed."""
         return self._get_cached_feed(feed_id)['Feed']['event_id']
 
-    def get_event_data_by_type(self, data_type, feed_id='14'):
-        """Get blacklisted IP addresses from a cached feed."""
+    def get_event_data_by_type(self, data_type, feed_id='14', stream=False, to_ids=None, timestamp=None, normalize=True):
+        """
+        Get blacklisted IP addresses from a cached feed.
+
+        If `stream` is True, the filtering is done by MISP instead and a generator over every matching
+        value is returned (see iter_event_data_by_type). If `normalize` is True, the values are
+        canonicalized and deduplicated (see normalize_indicators).
+        """
+        if stream:
+            return self.iter_event_data_by_type(data_type, feed_id, to_ids=to_ids, timestamp=timestamp, normalize=normalize)
         # Get event ID from the cached feed and fetch the event data
         #event_id = self.get_event_id(feed_id)
         event_id = self.get_event_id(feed_id)
@@ -186,9 +302,212 @@ class MispFunction:
         # Initialize a list to hold all the target values
         values = []
         values.append([attr['value'] for attr in metadata])
+        if normalize:
+            values[0] = normalize_indicators(data_type, values[0])
 
         # Only the return the first five values as a list (Testing only)
         return values[0][25:30]
+
+    def iter_event_data_by_type(self, data_type, feed_id='14', to_ids=None, timestamp=None, page_size=None, normalize=True):
+        """
+        Stream the values of a cached feed's attributes of the given data type.
+
+        The type, to_ids and timestamp filters are applied by MISP's attribute search and the results are
+        fetched one page at a time, so the feed's event is never downloaded as a whole. If `normalize` is
+        True, each value is canonicalized and yielded once (hosts covered by a listed network are only
+        dropped by normalize_indicators, which needs every value).
+        """
+        event_id = self.get_event_id(feed_id)
+        attributes = self._iter_attributes(data_type, event_id=event_id, to_ids=to_ids, timestamp=timestamp, page_size=page_size)
+        values = (attribute['value'] for attribute in attributes)
+        yield from (iter_normalized_indicators(data_type, values) if normalize else values)
+
+    def normalize_indicators(self, data_type, values):
+        """Canonicalize and deduplicate indicators, e.g. between playbook steps (see indicators.normalize_indicators)."""
+        normalized = normalize_indicators(data_type, values)
+        self.log.debug(f"Normalized {data_type} indicators down to {len(normalized)} values.")
+        return normalized
+
+    def get_indicator_set(self, data_type, feed_id='14', to_ids=None, prefilter=False):
+        """
+        Get a cached feed's values of the given data type as a compact indicator set.
+
+        IP addresses are stored as packed integer ranges and hashes as binary digests (see indicators.py),
+        and the values are streamed from MISP straight into the set without building a list first.
+        """
+        return indicator_set(data_type, self.iter_event_data_by_type(data_type, feed_id, to_ids=to_ids), prefilter=prefilter)
+
+    def sync_event_data_by_type(self, data_type, feed_id='14', to_ids=None, normalize=True):
+        """
+        Get only the attribute values that changed since the previous sync of this feed and data type.
+
+        A watermark (the latest attribute timestamp seen) is kept per feed and data type, and only attributes
+        added or modified since then are fetched from MISP. The first sync returns every current value. If
+        `normalize` is True, each value is canonicalized on its own and invalid values are dropped (see
+        iter_normalized_indicators), so that a value and its variants are added and removed as one.
+
+        Returns:
+            A tuple of (added, removed) value lists. Removed values are values of attributes that were deleted,
+            or that no longer have the IDS flag set when `to_ids` is True, and that no other attribute provides.
+        """
+        key = (str(feed_id), data_type)
+        watermark = self._watermarks.get(key)
+        event_id = self.get_event_id(feed_id)
+        if watermark is None:
+            # Full sync, only the current attributes are needed
+            since, seen, filters = None, set(), {'to_ids': to_ids}
+        else:
+            # Incremental sync, include deleted attributes and classify the IDS flag locally to find removals
+            since, seen, filters = watermark['timestamp'], set(watermark['uuids']), {'deleted': [0, 1]}
+        latest, latest_uuids = since or 0, set(seen)
+        added, removed = [], []
+        for attribute in self._iter_attributes(data_type, event_id=event_id, timestamp=since, **filters):
+            attribute_timestamp = int(attribute.get('timestamp') or 0)
+            uuid = attribute.get('uuid')
+            if attribute_timestamp == since and uuid in seen:
+                continue  # Already processed in the previous sync
+            if attribute_timestamp > latest:
+                latest, latest_uuids = attribute_timestamp, {uuid}
+            elif attribute_timestamp == latest:
+                latest_uuids.add(uuid)
+            if attribute.get('deleted') or (to_ids and not attribute.get('to_ids')):
+                removed.append(attribute['value'])
+            else:
+                added.append(attribute['value'])
+        if normalize:
+            added = list(iter_normalized_indicators(data_type, added))
+        # A value that is still provided by another attribute, changed or not, has not been removed
+        if removed:
+            added_values = set(added)
+            candidates = {}
+            for value in removed:
+                try:
+                    canonical = normalize_indicator(data_type, value) if normalize else value
+                except (ValueError, TypeError, AttributeError):
+                    continue
+                if canonical not in added_values:
+                    # Ask MISP for the raw values and their canonical form, as its value filter is an exact match
+                    candidates.setdefault(canonical, {canonical: None})[value] = None
+            provided = self._get_provided_values(data_type, [value for values in candidates.values() for value in values],
+                                                 event_id=event_id, to_ids=to_ids)
+            provided = set(iter_normalized_indicators(data_type, provided)) if normalize else provided
+            removed = [value for value in candidates if value not in provided]
+        self._watermarks[key] = {'timestamp': latest, 'uuids': latest_uuids}
+        self.log.debug(f"Synchronized {data_type} attributes from feed {feed_id}: {len(added)} added, {len(removed)} removed, watermark {latest}.")
+        return added, removed
+
+    def sync_to_store(self, store, data_type, feed_id='14', to_ids=None):
+        """
+        Synchronize a feed's attributes of the given data type into a local IocStore.
+
+        The sync watermarks are kept in the store, so only the changes since the last sync are fetched, even
+        across restarts. Values are stored in their canonical form, and values the feed no longer provides
+        stay in the store while another feed provides them. Returns the (added, removed) counts.
+        """
+        if not self._watermarks:
+            self.restore_watermarks(store.get_state('misp_watermarks', {}))
+        added, removed = self.sync_event_data_by_type(data_type, feed_id, to_ids=to_ids)
+        source_feed = self._get_misp_feed_by_id(feed_id).get('name', str(feed_id))
+        store.add(data_type, added, source_feed=source_feed)
+        store.remove(data_type, removed, source_feed=source_feed)
+        store.set_state('misp_watermarks', self.watermarks)
+        return len(added), len(removed)
+
+    def sync_iocs(self, data_types=None):
+        """
+        Synchronize the enabled feeds of each data type into the local IOC store.
+
+        `data_types` defaults to the configured `ioc_sync_types`. Only the changes since the previous sync of
+        each feed are fetched (see sync_to_store). Returns the {data_type: [added, removed]} counts.
+        """
+        data_types = data_types or self.ioc_sync_types
+        if isinstance(data_types, str):
+            data_types = [data_types]
+        results = {}
+        with self._sync_lock:
+            for feed_name, feed in self.enabled_feeds.items():
+                data_type = feed.get('data_types')
+                if data_type not in data_types:
+                    continue
+                try:
+                    added, removed = self.sync_to_store(self.ioc_store, data_type, feed['feed_id'])
+                except Exception as e:
+                    self.log.error(f"Error synchronizing feed {feed_name} into the IOC store: {e}")
+                    continue
+                counts = results.setdefault(data_type, [0, 0])
+                counts[0] += added
+                counts[1] += removed
+        self.log.info(f"Synchronized the IOC store: {results}")
+        return results
+
+    def lookup_iocs(self, data_type, values):
+        """
+        Returns the values that are known indicators in the local IOC store, keeping their order.
+
+        IP addresses inside a network listed by a feed are known indicators (see IocStore.contains_many).
+        """
+        if isinstance(values, str):
+            values = [values]
+        return self.ioc_store.filter_known(data_type, values)
+
+    def lookup_ioc(self, data_type, value):
+        """Get an indicator's details from the local IOC store, or None if it is not a known indicator."""
+        return self.ioc_store.lookup(data_type, value)
+
+    @property
+    def ioc_store(self):
+        """The local IOC store filled by sync_iocs."""
+        return IocStore.for_path(self.ioc_store_path)
+
+    def reset_watermark(self, data_type, feed_id='14'):
+        """Forget the sync watermark so that the next sync fetches every value again."""
+        self._watermarks.pop((str(feed_id), data_type), None)
+
+    @property
+    def watermarks(self):
+        """The sync watermarks in a serializable format, keyed by 'feed_id:data_type'."""
+        return {f"{feed_id}:{data_type}": {'timestamp': watermark['timestamp'], 'uuids': sorted(watermark['uuids'])}
+                for (feed_id, data_type), watermark in self._watermarks.items()}
+
+    def restore_watermarks(self, watermarks):
+        """Restore sync watermarks previously read from the `watermarks` property."""
+        for key, watermark in watermarks.items():
+            feed_id, data_type = key.split(':', 1)
+            self._watermarks[(feed_id, data_type)] = {'timestamp': int(watermark['timestamp']), 'uuids': set(watermark['uuids'])}
+
+    def _get_provided_values(self, data_type, values, event_id=None, to_ids=None):
+        """Returns the set of `values` that current attributes of the given data type still provide."""
+        provided = set()
+        for start in range(0, len(values), self.ATTRIBUTE_PAGE_SIZE):
+            chunk = values[start:start + self.ATTRIBUTE_PAGE_SIZE]
+            attributes = self._iter_attributes(data_type, event_id=event_id, to_ids=True if to_ids else None, value=chunk)
+            provided.update(attribute['value'] for attribute in attributes)
+        return provided
+
+    def _iter_attributes(self, data_type, event_id=None, to_ids=None, timestamp=None, page_size=None, **filters):
+        """Yield the attributes (as plain dictionaries) matching the filters, one page of results at a time."""
+        page_size = page_size or self.ATTRIBUTE_PAGE_SIZE
+        page = 1
+        while True:
+            response = self.misp_api.search(
+                controller='attributes',
+                type_attribute=data_type,
+                eventid=event_id,
+                to_ids=to_ids,
+                timestamp=timestamp,
+                page=page,
+                limit=page_size,
+                include_context=False,
+                pythonify=False,
+                **filters
+            )
+            if isinstance(response, dict) and response.get('errors'):
+                raise Exception(f"Error searching MISP attributes: {response['errors']}")
+            attributes = response.get('Attribute', []) if isinstance(response, dict) else response
+            yield from attributes
+            if len(attributes) < page_size:
+                return
+            page += 1
     
     def _search_attributes(self, attribute_type, value=None):
         """Search for attributes in MISP."""
@@ -204,28 +523,228 @@ class MispFunction:
         except Exception as e:
             raise e
 
+    def get_feeds_by_data_type(self, data_type):
+        """Get the MISP feeds known to provide the given data type."""
+        return self.feeds_by_data_type.get(data_type, [])
+
     def _get_misp_feed_by_name(self, feed_name):
         """Get a feed from MISP."""
-        feed_data = next((feed['Feed'] for feed in self.feeds if feed['Feed']['name'] == feed_name), {})
-        return feed_data
+        return self.feeds_by_name.get(feed_name, {})
     
     def _get_misp_feed_by_id(self, feed_id):
         """Get a feed from MISP."""
-        feed_data = next((feed['Feed'] for feed in self.feeds if feed['Feed']['id'] == feed_id), {})
-        return feed_data
+        return self.feeds_by_id.get(str(feed_id), {})
+
+    def _index_feeds(self, all_feeds):
+        """Build the lookup tables for a freshly downloaded feed catalogue."""
+        by_name, by_id, by_data_type = {}, {}, {}
+        for feed in all_feeds:
+            feed_data = feed['Feed']
+            by_name[feed_data['name']] = feed_data
+            by_id[str(feed_data['id'])] = feed_data
+            data_type = self.DATA_TYPE_BY_FEED_NAME.get(feed_data['name'])
+            if data_type:
+                by_data_type.setdefault(data_type, []).append(feed_data)
+        return by_name, by_id, by_data_type
+
+    def load_default_feeds(self):
+        """Load MISP's default feeds into the instance. Only runs when explicitly requested."""
+        try:
+            self.misp_api.load_default_feeds()
+        except Exception as e:
+            raise e
+        finally:
+            self.invalidate_feeds()
+
+    def invalidate_feeds(self):
+        """Mark the cached feed catalogue as stale so that the next access downloads it again."""
+        self._feeds_expire_at = 0.0
 
     def _get_feeds(self):
         """Get the list of feeds from MISP."""
         try:
-            # Load the default list of feeds
-            self.misp_api.load_default_feeds()
-            all_feeds = self.misp_api.feeds()
-            return all_feeds
-        except:
-            return []
+            return self.misp_api.feeds()
+        except Exception as e:
+            self.log.error(f"Error getting feeds from MISP: {e}")
+            return None
     
     @property
     def feeds(self):
-        """Get the list of feeds from MISP."""
-        return self._get_feeds()
-        
+        """Get the list of feeds from MISP, cached for `feed_cache_ttl` seconds."""
+        with self._feeds_lock:
+            if self._feeds is None or time.monotonic() >= self._feeds_expire_at:
+                all_feeds = self._get_feeds()
+                if all_feeds is not None:
+                    self._feeds = all_feeds
+                    self._feed_index = self._index_feeds(all_feeds)
+                    self._feeds_expire_at = time.monotonic() + self.feed_cache_ttl
+            # Fall back to the last known catalogue if MISP could not be reached
+            return self._feeds if self._feeds is not None else []
+
+    @property
+    def feeds_by_name(self):
+        """Feeds in the catalogue indexed by their name."""
+        self.feeds  # Refresh the catalogue and its indexes if they have expired
+        return self._feed_index[0]
+
+    @property
+    def feeds_by_id(self):
+        """Feeds in the catalogue indexed by their MISP id (as a string)."""
+        self.feeds
+        return self._feed_index[1]
+
+    @property
+    def feeds_by_data_type(self):
+        """Feeds in the catalogue listed in FEEDS_BY_DATA_TYPE, indexed by data type."""
+        self.feeds
+        return self._feed_index[2]
+
+    @property
+    def reporter(self):
+        """Batches attributes and sightings reported to MISP."""
+        if self._reporter is None:
+            self._reporter = MispReporter(self.misp_api)
+        return self._reporter
+
+    @staticmethod
+    def _get_setting(misp_init, setting, default):
+        """Read an optional setting from the integration's configuration file."""
+        params = getattr(misp_init, 'params', None) or {}
+        return params.get(getattr(misp_init, 'name', 'misp'), {}).get(setting, default)
+
+class MispReporter:
+    """
+    Buffers attributes and sightings reported to MISP and sends them in batched API calls.
+
+    The buffer is flushed once it holds `max_batch_size` items, or `max_latency` seconds after the first
+    item was buffered, whichever comes first. Attributes are added to a single report event, which is
+    created on the first flush. After a failed flush, the background thread retries with an exponential
+    backoff up to MAX_BACKOFF seconds, and the buffer keeps at most `max_buffer_size` items, dropping the
+    oldest sightings first, then the oldest attributes.
+    """
+    MAX_BATCH_SIZE = 500
+    MAX_LATENCY = 10.0
+    MAX_BUFFER_SIZE = 50000
+    MAX_BACKOFF = 300.0
+
+    def __init__(self, misp_api, event_info='PySOAR Reported Indicators', distribution=0, threat_level_id=4,
+                 analysis=0, max_batch_size=MAX_BATCH_SIZE, max_latency=MAX_LATENCY, max_buffer_size=MAX_BUFFER_SIZE):
+        self.log = Log.get_instance()
+        self.misp_api = misp_api
+        self.event_id = None
+        self.event_info = event_info
+        self.distribution = distribution
+        self.threat_level_id = threat_level_id
+        self.analysis = analysis
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_buffer_size = max_buffer_size
+        self._attributes = []
+        self._sightings = []
+        self._backoff = 0  # Seconds before the next retry, 0 while MISP accepts the reports
+        self.dropped = 0
+        self._unreported_drops = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._debouncer = Debouncer(self.flush, delay=max_latency, max_latency=max_latency, name='pysoar-misp-reporter')
+        atexit.register(self.flush)  # Send what is left in the buffer when the application exits
+
+    def add_attribute(self, data_type, value, to_ids=True, comment=None):
+        """Buffer an attribute for the report event."""
+        attribute = {'type': data_type, 'value': value, 'to_ids': to_ids}
+        if comment:
+            attribute['comment'] = comment
+        self._buffer(self._attributes, attribute)
+
+    def add_sighting(self, value, source='PySOAR', sighting_type=0):
+        """Buffer a sighting of a value (type 0 is a sighting, 1 a false positive, 2 an expiration)."""
+        self._buffer(self._sightings, {'value': value, 'source': source, 'type': sighting_type})
+
+    def _buffer(self, buffer, item):
+        with self._lock:
+            buffer.append(item)
+            self._trim()
+            # While MISP is failing the retries are left to the background thread
+            full = len(self._attributes) + len(self._sightings) >= self.max_batch_size and not self._backoff
+        if full:
+            self.flush()
+        else:
+            self._debouncer.trigger()
+
+    def _trim(self):
+        """Drop the oldest items past `max_buffer_size`, sightings first. Must be called with the lock held."""
+        overflow = len(self._attributes) + len(self._sightings) - self.max_buffer_size
+        if overflow <= 0:
+            return
+        for buffer in (self._sightings, self._attributes):
+            count = min(overflow, len(buffer))
+            del buffer[:count]
+            overflow -= count
+            self.dropped += count
+            self._unreported_drops += count
+
+    @property
+    def pending(self):
+        """Number of buffered attributes and sightings."""
+        return len(self._attributes) + len(self._sightings)
+
+    def flush(self):
+        """Send every buffered attribute and sighting to MISP now."""
+        with self._flush_lock:
+            with self._lock:
+                attributes, self._attributes = self._attributes, []
+                sightings, self._sightings = self._sightings, []
+            try:
+                if attributes:
+                    self._send_attributes(attributes)
+                    attributes = []
+                if sightings:
+                    self._send_sightings(sightings)
+                    sightings = []
+            except Exception as e:
+                with self._lock:
+                    self._attributes[:0] = attributes
+                    self._sightings[:0] = sightings
+                    self._trim()
+                self._backoff = min(self._backoff * 2, self.MAX_BACKOFF) if self._backoff else self.max_latency
+                self.log.error(f"Error reporting to MISP, {len(attributes)} attributes and {len(sightings)} sightings will be "
+                               f"retried in {self._backoff} seconds: {e}")
+            else:
+                self._backoff = 0
+            with self._lock:
+                dropped, self._unreported_drops = self._unreported_drops, 0
+            if dropped:
+                self.log.warning(f"The MISP report buffer is full, dropped the {dropped} oldest items.")
+            self._debouncer.delay = self._debouncer.max_latency = self._backoff or self.max_latency
+            if self._backoff:
+                self._debouncer.trigger()
+
+    def _send_attributes(self, attributes):
+        if self.event_id is None:
+            # Create the report event with the first batch of attributes in a single call
+            event = MISPEvent()
+            event.info = self.event_info
+            event.distribution = self.distribution
+            event.threat_level_id = self.threat_level_id
+            event.analysis = self.analysis
+            for attribute in attributes:
+                event.add_attribute(**attribute)
+            response = self.misp_api.add_event(event, pythonify=True)
+            self.event_id = response.id
+        else:
+            batch = []
+            for data in attributes:
+                attribute = MISPAttribute()
+                attribute.from_dict(**data)
+                batch.append(attribute)
+            self.misp_api.add_attribute(self.event_id, batch)
+        self.log.info(f"Reported {len(attributes)} attributes to MISP event {self.event_id}.")
+
+    def _send_sightings(self, sightings):
+        # MISP accepts a list of values per sighting, so send one call per source and type
+        grouped = {}
+        for sighting in sightings:
+            grouped.setdefault((sighting['source'], sighting['type']), []).append(sighting['value'])
+        for (source, sighting_type), values in grouped.items():
+            self.misp_api.add_sighting({'values': values, 'source': source, 'type': sighting_type})
+        self.log.info(f"Reported {len(sightings)} sightings to MISP in {len(grouped)} calls.")
@@ -2,8 +2,23 @@
 import requests
 import json
 import ipaddress
-from datetime import datetime, time, timezone
-from classes import Log
+import atexit
+import heapq
+import threading
+import yaml
+import calendar
+import hashlib
+import socket
+import socketserver
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+from itertools import compress
+from datetime import datetime, time, timedelta, timezone
+from functools import lru_cache
+from classes import Log, Debouncer, PersistenceManager
+from analytics import FirewallLogAnalytics
+from indicators import PrefixMap, aggregate_networks, parse_ip_range, indicator_set, iter_normalized_indicators, normalize_indicator
 import os
 import re
 
@@ -13,6 +28,23 @@ class PfsenseFunction:
     CERT_PATH = './certs/api_user.crt'
     CA_CERT_PATH = './certs/CA.crt'
     KEY_PATH = './certs/api_user.key'
+    # Blocking mode, 'rule' creates a firewall rule per address and 'alias' adds addresses to the block list aliases
+    BLOCK_MODE = 'rule'
+    # Name of the parent alias referenced by the block rule, the shard aliases are named {BLOCK_ALIAS}_{index}
+    BLOCK_ALIAS = 'PySOAR_Block'
+    BLOCK_RULE_DESCR = 'PySOAR Block List'
+    # Maximum number of entries in each shard alias, and number of entries sent per API call
+    ALIAS_SHARD_SIZE = 4000
+    ALIAS_CHUNK_SIZE = 500
+    # Seconds to wait for further changes before reloading the filter, and the longest a change may stay unapplied
+    APPLY_DELAY = 2.0
+    APPLY_MAX_LATENCY = 15.0
+    # Seconds of logs kept in the log cache
+    LOG_RETENTION = 86400
+    # Seconds between log downloads for the playbook triggers while the syslog listener is off
+    LOG_POLL_INTERVAL = 30
+    # Stands in for the response of a failed request, which _make_request returns as None
+    ERROR_RESPONSE = (None, None, None, None, None)
     # A list of optional pfsense logs
 
     def __init__(self, pfsense_init):
@@ -27,7 +59,45 @@ class PfsenseFunction:
         self._api = None
         self._log_mgr = None
         self._rules = None
+        self._rule_index = FirewallRuleIndex()
         self._interfaces = None
+        self._aliases = None
+        self.block_mode = self._get_setting(pfsense_init, 'block_mode', self.BLOCK_MODE)
+        self.block_alias = self._get_setting(pfsense_init, 'block_alias', self.BLOCK_ALIAS)
+        self.alias_shard_size = self._get_setting(pfsense_init, 'alias_shard_size', self.ALIAS_SHARD_SIZE)
+        # Seconds a block lasts by default, None blocks forever
+        self.block_ttl = self._get_setting(pfsense_init, 'block_ttl', None)
+        self._expiry = None
+        # Seconds of logs kept in the log cache, None keeps every line
+        self.log_retention = self._get_setting(pfsense_init, 'log_retention', self.LOG_RETENTION)
+        self._log_polled = {}
+        # Seconds of firewall logs covered by the analytics aggregates
+        self.analytics_window = self._get_setting(pfsense_init, 'analytics_window', FirewallLogAnalytics.WINDOW)
+        self.syslog_listener = None
+        # Seconds between the log downloads feeding the playbook triggers while the syslog listener is off
+        self.log_poll_interval = self._get_setting(pfsense_init, 'log_poll_interval', self.LOG_POLL_INTERVAL)
+        # Every PfsenseFunction for the same pfSense shares one coordinator, so concurrent playbooks share reloads
+        self.apply_coordinator = ApplyCoordinator.for_url(
+            self.url,
+            self._apply_changes_now,
+            delay=self._get_setting(pfsense_init, 'apply_delay', self.APPLY_DELAY),
+            max_latency=self._get_setting(pfsense_init, 'apply_max_latency', self.APPLY_MAX_LATENCY),
+            )
+        # Resume expiring the blocks scheduled by a previous run
+        if os.path.exists(BlockExpiryScheduler.sidecar_path(self.url)):
+            self.expiry
+        if self._get_setting(pfsense_init, 'syslog_listener', False):
+            try:
+                self.start_syslog_listener(
+                    host=self._get_setting(pfsense_init, 'syslog_host', '0.0.0.0'),
+                    port=self._get_setting(pfsense_init, 'syslog_port', 5514),
+                    protocol=self._get_setting(pfsense_init, 'syslog_protocol', 'udp'),
+                    queue_size=self._get_setting(pfsense_init, 'syslog_queue_size', SyslogListener.QUEUE_SIZE),
+                    drop_policy=self._get_setting(pfsense_init, 'syslog_drop_policy', 'drop_newest'),
+                    )
+            except (OSError, ValueError) as e:
+                # The firewall logs are still read through the API
+                self.log.error(f"Error starting the syslog listener: {e}")
         self.log.debug(f"pfSense API initialized with the following parameters: {self.__dict__}")
 
     # Server Functions
@@ -124,7 +194,7 @@ class PfsenseFunction:
             elif method.lower() == 'put':
                 response = self.api.put(url, data=json.dumps(data), **kwargs)
             elif method.lower() == 'delete':
-                response = self.api.delete(url, **kwargs)
+                response = self.api.delete(url, data=json.dumps(data) if data is not None else None, **kwargs)
             else:
                 raise ValueError("Invalid HTTP method specified")
 
@@ -173,20 +243,101 @@ class PfsenseFunction:
         """Send a PUT request to pfSense."""
         return self._make_request('PUT', endpoint, data)
 
-    def delete(self, endpoint):
+    def delete(self, endpoint, data=None):
         """Send a DELETE request to pfSense."""
-        return self._make_request('DELETE', endpoint, data=None)
+        return self._make_request('DELETE', endpoint, data)
     
     # Firewall Rule Functions
     def _parse_firewall_body(self, data):
-        """Parse the body of a firewall rule from pfSense."""
-        self.rules = [FirewallRule(rule) for rule in data]
+        """
+        Parse the body of a firewall rule from pfSense.
 
-    def add_firewall_rule(self, src=["any"], src_port="any", dst="wan", dst_port="any", proto="any", direction="any", descr="", rule_action="block", interface="vmx0", gateway="", top=True):
-        """Add a new firewall rule to pfSense."""
+        Once the rules are cached, only the rules whose tracker is new or whose `updated.time` changed are
+        parsed again, and the lookup indexes are updated for those rules only.
+        """
+        if self._rules is None:
+            self.rules = [FirewallRule(rule) for rule in data or []]
+            return
+        cached = {str(rule.tracker): rule for rule in self._rules if getattr(rule, 'tracker', None) is not None}
+        rules, added = [], []
+        for rule_data in data or []:
+            rule = cached.pop(str(rule_data.get('tracker')), None)
+            if rule is None or self._is_rule_changed(rule, rule_data):
+                rule = FirewallRule(rule_data)
+                added.append(rule)
+            rules.append(rule)
+        kept = {id(rule) for rule in rules}
+        removed = [rule for rule in self._rules if id(rule) not in kept]
+        for rule in removed:
+            self._rule_index.remove(rule)
+        for rule in added:
+            self._rule_index.add(rule)
+        self._rule_index.reorder(rules)
+        self._rules = rules
+        self.log.debug(f"Firewall rule cache refreshed: {len(added)} rules parsed, {len(removed)} replaced or removed, {len(rules) - len(added)} unchanged.")
+
+    @staticmethod
+    def _is_rule_changed(rule, rule_data):
+        """Compare a cached rule with the rule data from pfSense by their last update time."""
+        updated_time = (rule_data.get('updated') or {}).get('time')
+        if updated_time is None:
+            return rule.rule_data != rule_data
+        return getattr(rule, 'updated_time', None) != updated_time
+
+    def _cache_added_rule(self, rule_data):
+        """Add a rule created through the API to the cache without downloading the rules again."""
+        if self._rules is None:
+            return
+        rule = FirewallRule(rule_data)
+        self._rules.append(rule)
+        self._rule_index.add(rule)
+
+    def _cache_deleted_rule(self, tracker):
+        """Remove a rule deleted through the API from the cache without downloading the rules again."""
+        rule = self._rule_index.get_by_tracker(tracker)
+        if self._rules is None or rule is None:
+            return
+        self._rules.remove(rule)
+        self._rule_index.remove(rule)
+        self._rule_index.reorder(self._rules)
+
+    @staticmethod
+    def _is_success(code, body=None):
+        """Check if a pfSense API response code is a success, and if `body` is given, that it holds a rule."""
+        try:
+            success = 200 <= int(code) < 300
+        except (TypeError, ValueError):
+            return False
+        return success if body is None else success and isinstance(body, dict) and body.get('tracker') is not None
+
+    def add_firewall_rule(self, src=["any"], src_port="any", dst="wan", dst_port="any", proto="any", direction="any", descr="", rule_action="block", interface="vmx0", gateway="", top=True, aggregate=True, ttl=None):
+        """
+        Add a new firewall rule to pfSense.
+
+        If `aggregate` is True, the source addresses are first collapsed into the smallest equivalent list
+        of CIDRs (see aggregate_networks), so adjacent addresses and networks share a single rule. Blocks
+        expire after `ttl` seconds, or the configured `block_ttl` (see BlockExpiryScheduler). In 'alias' block
+        mode, plain source blocks go to the block list aliases (see block_addresses), and blocks narrowed by
+        port, destination, protocol or description still get a rule per address.
+        """
         # Iterate through the list of source addresses
         if not isinstance(src, list):
             src = [src]
+        ttl = ttl if ttl is not None else self.block_ttl
+        if self.block_mode == 'alias' and rule_action == "block" and "any" not in src:
+            # The block list rule blocks every destination, port and protocol, narrower blocks need their own rule
+            criteria = (('src_port', src_port, "any"), ('dst', dst, "wan"), ('dst_port', dst_port, "any"), ('proto', proto, "any"), ('descr', descr, ""))
+            narrowed = [name for name, value, default in criteria if value != default]
+            if not narrowed:
+                # Block the addresses through the block list aliases instead of a rule per address
+                return self.block_addresses(src, interface=interface, ttl=ttl)
+            self.log.error(f"The block list aliases can't block by {', '.join(narrowed)}, creating a rule per address instead.")
+        if aggregate and "any" not in src:
+            src = self.aggregate_addresses(src)
+        message = None
+        refresh = False
+        posted = False
+        expiring = []
         for src_addr in src:
             # Check to make sure it is a valid IP address
             if not self.is_ip_valid(src_addr):
@@ -206,32 +357,315 @@ class PfsenseFunction:
                 stage_rule = FirewallRule.new_pass_rule(src_addr, src_port, dst, dst_port, proto, direction, descr, interface, gateway, top)
                 self.log.debug(f"FirewallRule.new_pass_rule 'stage_rule': {stage_rule}") # Debugging
             # Send the rule to the pfSense API
-            status, code, return_code, message, body = self.post('api/v1/firewall/rule', data=stage_rule)
+            status, code, return_code, message, body = self.post('api/v1/firewall/rule', data=stage_rule) or self.ERROR_RESPONSE
+            posted = True
             # Debugging
             self.log.debug_requests_function("PfsenseFunction", "add_firewall_rule", status, code, return_code, message, self.to_pretty(body))
             self.log.debug(f"PfsenseFunction.add_firewall_rule 'rule': {stage_rule}")
+            if self._is_success(code, body):
+                # Cache the created rule, so the following checks see it without a refresh
+                self._cache_added_rule(body)
+            else:
+                refresh = True
+            if not self._is_success(code):
+                self.log.error(f"Error adding firewall rule for {src_addr}: {message}")
+            elif ttl and rule_action == "block":
+                # Only blocks that were created can expire
+                expiring.append(src_addr)
+        if expiring:
+            self.expiry.schedule(expiring, ttl)
 
-        # Validate that the new rule has been added
-        if len(src) > 1:
-            # Apply changes 
-            status = self.apply_changes()
-            self.log.info(f"Changes applied: {status}")
-        # Retrieve rules 
-        self.read_firewall_rule()
+        # The rules are created without reloading the filter, schedule a single reload for all of them
+        if posted:
+            self.apply_changes()
+        # Retrieve rules if a response did not include the created rule
+        if refresh:
+            self.read_firewall_rule()
+        # Get the rule by its description
+        rule = self.get_firewall_rule_by_description(descr)
         tracker = self.get_tracker_by_firewall_rule(rule)
-        if tracker is None:
-            # Try to get rule by its description
-            rule = self.get_firewall_rule_by_description(descr)
-            tracker = self.get_tracker_by_firewall_rule(rule)
         if tracker is None:
             raise Exception(f"Error adding firewall rule: {message}")
         self.log.info(f"Firewall rule added successfully: {tracker}")
 
-    def apply_changes(self):
-        """Apply changes to pfSense."""
+    def aggregate_addresses(self, addresses):
+        """Collapse a list of IP addresses and networks into the smallest equivalent list of CIDRs."""
+        networks, stats = aggregate_networks(addresses)
+        if stats['invalid']:
+            self.log.error(f"Skipped {stats['invalid']} invalid IP addresses or networks.")
+        self.log.info(f"Aggregated {stats['input']} addresses into {stats['output']} networks ({stats['reduction']}% fewer).")
+        return networks
+
+    # Alias Block List Functions
+    def block_addresses(self, addresses, interface="wan", ttl=None):
+        """
+        Block IP addresses and networks by adding them to PySOAR's block list aliases.
+
+        The addresses are aggregated and the ones not already blocked are spread over shard aliases of at
+        most `alias_shard_size` entries, in bulk API calls of ALIAS_CHUNK_SIZE entries. The shards are nested
+        in a parent alias that a single block rule references, and the changes are applied once at the end.
+        With a `ttl`, the entries expire after that many seconds, and blocking an entry again extends it.
+        Returns the number of entries added.
+        """
+        entries = self._get_alias_entries()
+        blocked = indicator_set('ip-dst', entries)
+        aggregated = self.aggregate_addresses(addresses)
+        networks = [network for network in aggregated if network not in blocked]
+        if not ttl and self._expiry is not None:
+            # Blocking without a TTL keeps the block forever
+            self._expiry.cancel(aggregated)
+        if not networks:
+            self.log.info("All addresses are already blocked.")
+            self._schedule_alias_expiry(aggregated, ttl)
+            return 0
+        shards = self._get_shard_names()
+        for shard in shards:
+            # Fill the free space in the existing shards first
+            free = self.alias_shard_size - len(self.aliases[shard]['address'])
+            if free > 0 and networks:
+                self._add_alias_entries(shard, networks[:free])
+                networks = networks[free:]
+        while networks:
+            shard = f"{self.block_alias}_{len(shards)}"
+            self._create_alias(shard, networks[:self.alias_shard_size], f"{self.BLOCK_RULE_DESCR} shard {len(shards)}")
+            if shard not in self.aliases:
+                # The parent alias can't nest a shard that wasn't created
+                break
+            networks = networks[self.alias_shard_size:]
+            shards.append(shard)
+        self._update_parent_alias(self._get_shard_names())
+        self._ensure_block_rule(interface)
+        self.apply_changes()
+        self._schedule_alias_expiry(aggregated, ttl)
+        added = len(self._get_alias_entries()) - len(entries)
+        self.log.info(f"Added {added} entries to the {self.block_alias} block list.")
+        return added
+
+    def _schedule_alias_expiry(self, networks, ttl):
+        """Expire the networks stored as is in the aliases, not addresses inside a larger blocked network or failed additions."""
+        if ttl:
+            stored = {self._canonical_network(entry) for entry in self._get_alias_entries()}
+            self.expiry.schedule([network for network in networks if network in stored], ttl)
+
+    def unblock_addresses(self, addresses):
+        """
+        Remove IP addresses and networks from PySOAR's block list aliases.
+
+        Only entries stored in the aliases are removed, an address inside a blocked network stays blocked.
+        Returns the number of entries removed.
+        """
+        # Each address on its own, a host inside another network to remove is still stored as its own entry
+        to_remove = set(iter_normalized_indicators('ip-dst', addresses))
+        if self._expiry is not None:
+            self._expiry.cancel(to_remove)
+        removed = 0
+        failed = False
+        for shard in self._get_shard_names():
+            entries = [entry for entry in self.aliases[shard]['address'] if self._canonical_network(entry) in to_remove]
+            for start in range(0, len(entries), self.ALIAS_CHUNK_SIZE):
+                chunk = entries[start:start + self.ALIAS_CHUNK_SIZE]
+                status, code, return_code, message, body = self.delete('api/v1/firewall/alias/entry',
+                                                                       data={'name': shard, 'address': chunk, 'apply': False}) or self.ERROR_RESPONSE
+                self.log.debug_requests_function("PfsenseFunction", "unblock_addresses", status, code, return_code, message, self.to_pretty(body))
+                if not self._is_success(code):
+                    self.log.error(f"Error removing entries from alias {shard}: {message}")
+                    failed = True
+                    continue
+                removed_entries = set(chunk)
+                self.aliases[shard]['address'] = [entry for entry in self.aliases[shard]['address'] if entry not in removed_entries]
+                removed += len(chunk)
+        if failed:
+            # Read the aliases again instead of guessing which entries pfSense kept
+            self.read_aliases()
+        if removed:
+            self.apply_changes()
+        self.log.info(f"Removed {removed} entries from the {self.block_alias} block list.")
+        return removed
+
+    def remove_blocked_networks(self, networks):
+        """
+        Remove blocks on exactly these networks, from the block list aliases or as block rules.
+
+        Used to expire blocks, the deletions are sent without applying them and are applied together.
+        Returns the number of entries or rules removed.
+        """
+        if self.block_mode == 'alias':
+            removed = self.unblock_addresses(networks)
+            # Entries still stored after the removal failed
+            stored = {self._canonical_network(entry) for entry in self._get_alias_entries()}
+            self._retry_expiry(network for network in iter_normalized_indicators('ip-dst', networks) if network in stored)
+            return removed
+        if self.rules is None:
+            self.read_firewall_rule()
+        removed = 0
+        failed = []
+        # Each network on its own, a host inside another expired network still has its own rule
+        for network in iter_normalized_indicators('ip-dst', networks):
+            for rule in list(self._rule_index.get_by_network(network)):
+                if rule.type != 'block' or self._canonical_network(rule.source_address) != network:
+                    continue
+                status, code, return_code, message, body = self.delete('api/v1/firewall/rule', data={'tracker': int(rule.tracker), 'apply': False}) or self.ERROR_RESPONSE
+                self.log.debug_requests_function("PfsenseFunction", "remove_blocked_networks", status, code, return_code, message, self.to_pretty(body))
+                if self._is_success(code):
+                    self._cache_deleted_rule(rule.tracker)
+                    removed += 1
+                else:
+                    self.log.error(f"Error removing the block rule for {network}: {message}")
+                    failed.append(network)
+        if removed:
+            self.apply_changes()
+        self._retry_expiry(failed)
+        self.log.info(f"Removed {removed} block rules.")
+        return removed
+
+    def _retry_expiry(self, networks):
+        """Expire blocks again after a failed removal, the scheduler already dropped their expiry time."""
+        networks = list(dict.fromkeys(networks))
+        if networks:
+            self.log.error(f"Retrying the removal of {len(networks)} expired blocks in {self.expiry.batch_window} seconds.")
+            self.expiry.schedule(networks, 0)
+
+    def reconcile_blocklist(self, desired, dry_run=False, descr="PySOAR Block"):
+        """
+        Converge pfSense's block list with the desired set of addresses and networks (see BlocklistReconciler).
+
+        Returns the reconciliation report. With `dry_run`, nothing is changed on pfSense.
+        """
+        return BlocklistReconciler(self, descr=descr).reconcile(desired, dry_run=dry_run)
+
+    def get_blocked_addresses(self):
+        """Get the entries of PySOAR's block list aliases."""
+        return self._get_alias_entries()
+
+    def is_address_blocked(self, ip):
+        """Check if an IP address or network is covered by PySOAR's block list aliases."""
+        return ip in indicator_set('ip-dst', self._get_alias_entries())
+
+    def read_aliases(self):
+        """Read the firewall aliases from pfSense."""
+        self.log.info(f"Reading firewall aliases...")
+        response = self.get('api/v1/firewall/alias')
+        if response is None:
+            # Keep the cached aliases rather than forgetting every block list entry
+            self.log.error(f"Error reading firewall aliases.")
+            return self._aliases if self._aliases is not None else {}
+        status, code, return_code, message, body = response
+        # Debugging
+        self.log.debug_requests_function("PfsenseFunction", "read_aliases", status, code, return_code, message, self.to_pretty(body))
+        aliases = {}
+        for alias in body or []:
+            address = alias.get('address') or []
+            aliases[alias.get('name')] = dict(alias, address=address.split() if isinstance(address, str) else list(address))
+        self._aliases = aliases
+        return aliases
+
+    @staticmethod
+    def _canonical_network(entry):
+        """Returns the canonical form of an IP address or network, or None for other alias entries."""
+        try:
+            return normalize_indicator('ip-dst', entry)
+        except (ValueError, TypeError):
+            return None
+
+    def _get_shard_names(self):
+        """Get the names of the block list shard aliases, in order."""
+        prefix = f"{self.block_alias}_"
+        shards = [name for name in self.aliases if name.startswith(prefix) and name[len(prefix):].isdigit()]
+        return sorted(shards, key=lambda name: int(name[len(prefix):]))
+
+    def _get_alias_entries(self):
+        return [entry for shard in self._get_shard_names() for entry in self.aliases[shard]['address']]
+
+    def _create_alias(self, name, entries, descr):
+        """Create a network alias, adding entries past the first chunk in separate bulk calls."""
+        first, rest = entries[:self.ALIAS_CHUNK_SIZE], entries[self.ALIAS_CHUNK_SIZE:]
+        data = {'name': name, 'type': 'network', 'descr': descr, 'address': first, 'detail': ['PySOAR'] * len(first), 'apply': False}
+        status, code, return_code, message, body = self.post('api/v1/firewall/alias', data=data) or self.ERROR_RESPONSE
+        self.log.debug_requests_function("PfsenseFunction", "_create_alias", status, code, return_code, message, self.to_pretty(body))
+        if not self._is_success(code):
+            # Read the aliases again instead of caching an alias pfSense may not have created
+            self.log.error(f"Error creating alias {name}: {message}")
+            self.read_aliases()
+            return
+        self.aliases[name] = {'name': name, 'type': 'network', 'descr': descr, 'address': list(first)}
+        if rest:
+            self._add_alias_entries(name, rest)
+
+    def _add_alias_entries(self, name, entries):
+        """Add entries to an existing alias in chunks of ALIAS_CHUNK_SIZE."""
+        for start in range(0, len(entries), self.ALIAS_CHUNK_SIZE):
+            chunk = entries[start:start + self.ALIAS_CHUNK_SIZE]
+            data = {'name': name, 'address': chunk, 'detail': ['PySOAR'] * len(chunk), 'apply': False}
+            status, code, return_code, message, body = self.post('api/v1/firewall/alias/entry', data=data) or self.ERROR_RESPONSE
+            self.log.debug_requests_function("PfsenseFunction", "_add_alias_entries", status, code, return_code, message, self.to_pretty(body))
+            if not self._is_success(code):
+                self.log.error(f"Error adding entries to alias {name}: {message}")
+                self.read_aliases()
+                return
+            self.aliases[name]['address'].extend(chunk)
+
+    def _update_parent_alias(self, shards):
+        """Create or update the parent alias so that it nests every shard alias."""
+        parent = self.aliases.get(self.block_alias)
+        if parent and parent['address'] == shards:
+            return
+        data = {'name': self.block_alias, 'type': 'network', 'descr': self.BLOCK_RULE_DESCR, 'address': shards,
+                'detail': ['PySOAR shard'] * len(shards), 'apply': False}
+        if parent:
+            response = self.put('api/v1/firewall/alias', data=dict(data, id=self.block_alias))
+        else:
+            response = self.post('api/v1/firewall/alias', data=data)
+        status, code, return_code, message, body = response or self.ERROR_RESPONSE
+        self.log.debug_requests_function("PfsenseFunction", "_update_parent_alias", status, code, return_code, message, self.to_pretty(body))
+        if not self._is_success(code):
+            self.log.error(f"Error updating alias {self.block_alias}: {message}")
+            self.read_aliases()
+            return
+        self.aliases[self.block_alias] = {'name': self.block_alias, 'type': 'network', 'descr': self.BLOCK_RULE_DESCR, 'address': list(shards)}
+
+    def _ensure_block_rule(self, interface):
+        """Create the block rule referencing the parent alias, unless it already exists."""
+        if self.get_firewall_rule_by_description(self.BLOCK_RULE_DESCR):
+            return
+        stage_rule = FirewallRule.new_block_rule(self.block_alias, "any", "any", "any", descr=self.BLOCK_RULE_DESCR, interface=interface)
+        stage_rule['apply'] = False
+        status, code, return_code, message, body = self.post('api/v1/firewall/rule', data=stage_rule) or self.ERROR_RESPONSE
+        self.log.debug_requests_function("PfsenseFunction", "_ensure_block_rule", status, code, return_code, message, self.to_pretty(body))
+        if self._is_success(code, body):
+            self._cache_added_rule(body)
+        else:
+            self.read_firewall_rule()
+
+    def apply_changes(self, immediate=False):
+        """
+        Apply changes to pfSense.
+
+        Reloading the filter is slow, so by default the apply is only scheduled and changes from every
+        playbook using this pfSense are applied together (see ApplyCoordinator). Pass `immediate=True`, or
+        call flush_changes, to apply the pending changes now.
+
+        Returns the result of the apply when `immediate` is True, otherwise None as the apply is only scheduled.
+        """
+        self.apply_coordinator.mark_dirty()
+        if immediate:
+            return self.flush_changes()
+        return None
+
+    def flush_changes(self):
+        """Apply the pending changes now. Returns True if there was nothing to apply."""
+        result = self.apply_coordinator.flush()
+        return True if result is None else result
+
+    def _apply_changes_now(self):
+        """Send the apply request to pfSense."""
         # Will reload all firewall items
         self.log.info(f"Applying changes...")
-        status, code, return_code, message, body =  self.post('api/v1/firewall/apply', data={"async": True})
+        response = self.post('api/v1/firewall/apply', data={"async": True})
+        if response is None:
+            # The request failed or pfSense returned an error status, _make_request logged it
+            self.log.error(f"Error applying changes.")
+            return False
+        status, code, return_code, message, body = response
         self.log.debug_requests_function("PfsenseFunction", "apply_changes", status, code, return_code, message, self.to_pretty(body))
         
         if body:
@@ -251,71 +685,39 @@ class PfsenseFunction:
         self._parse_firewall_body(body)
 
     def update_firewall_rule_cache(self):
-        """Updates firewall rule cache  from pfSense."""
-        # TODO: Add logic to update the firewall rule by pulling only the rules that have been updated since the last update
+        """Updates firewall rule cache from pfSense, only parsing the rules that changed since the last update."""
         self.log.debug(f"Updating firewall rules...")
-        status, code, return_code, message, body = self.put('api/v1/firewall/rule', data=self.rules)
-        # Debugging
-        self.log.debug_requests_function("PfsenseFunction", "update_firewall_rules", status, code, return_code, message, self.to_pretty(body))
+        self.read_firewall_rule()
 
     def get_firewall_rule_by_description(self, description):
         """Get a firewall rule by description from pfSense."""
         self.log.info(f"Getting firewall rule by description: {description}...")
         if self.rules is None:
             self.read_firewall_rule()
-        for rule in self.rules:
-            if rule.description == description:
-                return rule
-        return None
+        return self._rule_index.get_by_description(description)
 
     def get_firewall_rule_by_ip(self, ip):
-        """Get a firewall rule by IP address from pfSense."""
+        """Get the first firewall rule whose source or destination network covers an IP address or network."""
         if self.rules is None:
             self.read_firewall_rule()
-        for rule in self.rules:
-            if rule.source_address and rule.destination_address:
-                src_network = rule.source_address
-                dst_network = rule.destination_address
-                if self.is_in_network_range(ip, src_network) or self.is_in_network_range(ip, dst_network):
-                    return rule
-            elif rule.source_address:
-                src_network = rule.source_address
-                if self.is_in_network_range(ip, src_network):
-                    return rule
-            elif rule.destination_address:
-                dst_network = rule.destination_address
-                if self.is_in_network_range(ip, dst_network):
-                    return rule
-        return None
+        return self._rule_index.get_by_ip(ip)
     
     def get_firewall_rule_by_port(self, port):
         """Get a firewall rule by port from pfSense."""
         if self.rules is None:
             self.read_firewall_rule()
-        for rule in self.rules:
-            if rule.source_port and rule.destination_port:
-                src_port = rule.source_port
-                dst_port = rule.destination_port
-                if port == src_port or port == dst_port:
-                    return rule
-            elif rule.source_port:
-                src_port = rule.source_port
-                if port == src_port:
-                    return rule
-            elif rule.destination_port:
-                dst_port = rule.destination_port
-                if port == dst_port:
-                    return rule
-        return None 
+        return self._rule_index.get_by_port(port)
 
     def delete_firewall_rule(self, tracker):
         """Delete a firewall rule from pfSense."""
         self.log.info(f"Deleting firewall rule {tracker}...")
         # Post the delete request
-        status, code, return_code, message, body = self.delete(f"api/v1/firewall/rule", data={int(tracker)})
+        status, code, return_code, message, body = self.delete(f"api/v1/firewall/rule", data={'tracker': int(tracker)})
         
         # Debugging 
         self.log.debug_requests_function("PfsenseFunction", "delete_firewall_rule", status, code, return_code, message, self.to_pretty(body))
+        if self._is_success(code):
+            self._cache_deleted_rule(tracker)
 
         # Verify the rule was deleted
         self.log.info(f"Verifying firewall rule {tracker} was deleted...")
@@ -328,22 +730,17 @@ class PfsenseFunction:
         """Get a firewall rule by tracker from pfSense."""
         if self.rules is None:
             self.read_firewall_rule()
-        # Parse Response
-        for rule in self.rules:
-            if rule.tracker == tracker:
-                return rule
-        return None
+        return self._rule_index.get_by_tracker(tracker)
     
     def get_tracker_by_firewall_rule(self, rule_to_find):
         """Get a firewall rule by tracker from pfSense."""
         if self.rules is None:
             self.read_firewall_rule()
-        # Parse Response
-        for rule in self.rules:
-            if rule == rule_to_find:
-                # Debugging
-                self.log.debug(f"PfsenseFunction.get_tracker_by_firewall_rule 'rule': {rule}")
-                return rule.tracker
+        rule = self._rule_index.get_by_tracker(getattr(rule_to_find, 'tracker', None))
+        if rule is not None and rule is rule_to_find:
+            # Debugging
+            self.log.debug(f"PfsenseFunction.get_tracker_by_firewall_rule 'rule': {rule}")
+            return rule.tracker
         return None
     
     # Log Manager Functions
@@ -365,32 +762,107 @@ class PfsenseFunction:
         return body
     
     def get_firewall_logs(self):
-        """Get the firewall logs from pfSense."""
-        if not self.log_mgr.system_logs:
-            return self.log_mgr.gather_system_logs(self.get_logs('system'))
+        """Get the firewall logs from pfSense, parsed into a FirewallLogStore."""
+        if not self.log_mgr.firewall_logs and self.syslog_listener is None:
+            self.update_log_cache('firewall')
+        return self.log_mgr.firewall_logs
     
     def get_dhcp_logs(self):
         """Get the DHCP logs from pfSense."""
         if not self.log_mgr.dhcp_logs:
-            return self.log_mgr.gather_dhcp_logs(self.get_logs('dhcp'))
+            self.update_log_cache('dhcp')
+        return self.log_mgr.dhcp_logs
     
     def get_system_logs(self):
         """Get the system logs from pfSense."""
         if not self.log_mgr.system_logs:
-            return self.log_mgr.gather_system_logs(self.get_logs('system'))
+            self.update_log_cache('system')
+        return self.log_mgr.system_logs
     
     def get_config_history_logs(self):
         """Get the config history logs from pfSense."""
         if not self.log_mgr.config_history_logs:
-            return self.log_mgr.gather_config_history_logs(self.get_logs('config_history'))
+            self.update_log_cache('config_history')
+        return self.log_mgr.config_history_logs
     
     def get_firewall_logs_by_datetimerange(self, start_date, end_date, start_time=None, end_time=None):
         """Calls the FirewallLog class to get the firewall logs by datetime range."""
-        return self.log_mgr.get_firewall_logs_by_datetimerange(self.firewall_logs, start_date, end_date, start_time, end_time)
+        self.get_firewall_logs()
+        return self.log_mgr.get_firewall_logs_by_datetimerange(start_date, end_date, start_time, end_time)
+
+    def get_recent_firewall_logs(self, minutes=5):
+        """Get the firewall logs from the last N minutes, as a FirewallLogSlice."""
+        if self.syslog_listener is None:
+            self.update_log_cache('firewall')
+        return self.log_mgr.get_recent_firewall_logs(minutes)
                 
+    # Log Analytics Functions
+    @property
+    def analytics(self):
+        """The FirewallLogAnalytics updated as firewall log entries are read or received."""
+        return self.log_mgr.analytics
+
+    def _refresh_analytics(self):
+        """Read the new firewall log lines, unless the syslog listener pushes them, and expire the old events."""
+        if self.syslog_listener is None:
+            self.update_log_cache('firewall')
+        self.analytics.advance(datetime.now().timestamp())
+
+    def get_top_blocked_sources(self, n=10):
+        """Get the `n` sources with the most blocked packets in the analytics window, as (address, count) tuples."""
+        self._refresh_analytics()
+        return self.analytics.top('blocked_sources', n)
+
+    def get_top_blocked_ports(self, n=10):
+        """Get the `n` destination ports with the most blocked packets in the analytics window, as (port, count) tuples."""
+        self._refresh_analytics()
+        return self.analytics.top('blocked_ports', n)
+
+    def get_port_scanners(self, threshold=50):
+        """Get the sources that hit at least `threshold` distinct ports in the analytics window, as {address: ports}."""
+        self._refresh_analytics()
+        return self.analytics.over('source_ports', threshold)
+
+    def get_log_aggregate(self, name, n=10):
+        """Get the top `n` keys of any analytics aggregate, e.g. 'source_destinations'."""
+        self._refresh_analytics()
+        return self.analytics.top(name, n)
+
+    def start_syslog_listener(self, host='0.0.0.0', port=5514, protocol='udp', **kwargs):
+        """
+        Receive the firewall logs pushed by pfSense's remote logging instead of polling the API.
+
+        The listener adds the entries to this instance's log cache, and an instance created later for the same
+        address shares the running listener's cache. Raises OSError if the address can't be bound (see
+        SyslogListener.for_address).
+        """
+        self.syslog_listener = SyslogListener.for_address(self.log_mgr, host, port, protocol=protocol, **kwargs)
+        self._log_mgr = self.syslog_listener.log_mgr
+        return self.syslog_listener
+
+    def stop_syslog_listener(self):
+        """Stop the syslog listener, parsing the messages it has already received."""
+        if self.syslog_listener is not None:
+            self.syslog_listener.stop()
+            self.syslog_listener = None
+
+    def get_syslog_stats(self):
+        """Counters of the syslog listener, e.g. to watch the number of dropped messages."""
+        return self.syslog_listener.stats if self.syslog_listener is not None else {}
+
     def update_log_cache(self, log_name, interval=''):
-        # TODO: Add logic to update the log cache from the PfsenseLog class based on a time interval
-        pass 
+        """
+        Download a log and add the lines that are new since the last download to the log cache.
+
+        When `interval` (seconds) is given and the log was downloaded less than `interval` seconds ago, the cache
+        is left as is. Returns the number of new lines.
+        """
+        now = datetime.now().timestamp()
+        if interval and now - self._log_polled.get(log_name, 0) < float(interval):
+            return 0
+        logs = self.get_logs(log_name)
+        self._log_polled[log_name] = now
+        return self.log_mgr.tail_logs(log_name, logs)
     
     def is_in_network_range(self, ip, network_address):
         """Get a list of address ranges from pfSense."""
@@ -434,10 +906,24 @@ class PfsenseFunction:
             self.read_firewall_rule()
         return self._rules
 
+    @property
+    def aliases(self):
+        """Lazy initialization of the firewall aliases"""
+        if self._aliases is None:
+            return self.read_aliases()
+        return self._aliases
+
+    @property
+    def expiry(self):
+        """Lazy initialization of the block expiry scheduler"""
+        if self._expiry is None:
+            self._expiry = BlockExpiryScheduler.for_pfsense(self)
+        return self._expiry
+
     @property
     def log_mgr(self):
         if not self._log_mgr:
-            self._log_mgr = PfsenseLog()
+            self._log_mgr = PfsenseLog(retention=self.log_retention, analytics=FirewallLogAnalytics(window=self.analytics_window))
         return self._log_mgr
 
     @property
@@ -454,6 +940,14 @@ class PfsenseFunction:
     @rules.setter
     def rules(self, rules):
         self._rules = rules
+        # Rebuild the lookup indexes whenever the rule cache is loaded
+        self._rule_index = FirewallRuleIndex(rules or [])
+
+    @staticmethod
+    def _get_setting(pfsense_init, setting, default):
+        """Read an optional setting from the integration's configuration file."""
+        params = getattr(pfsense_init, 'params', None) or {}
+        return params.get(getattr(pfsense_init, 'name', 'pfsense'), {}).get(setting, default)
 
     @staticmethod
     def epoch_to_datetime(epoch_time, tz=timezone.utc):
@@ -470,71 +964,503 @@ class PfsenseFunction:
         """Make JSON pretty."""
         return json.dumps(json_data, indent=4, sort_keys=True)
 
-class FirewallRule:
-    """Formats Firewall Rules from pfSense."""
-    def __init__(self, rule_data=None):
+class ApplyCoordinator:
+    """
+    Coalesces the filter reloads requested for a pfSense instance.
+
+    Mutations mark the instance dirty, and a single apply runs once `delay` seconds pass without further
+    changes, or `max_latency` seconds after the first unapplied change. There is one coordinator per
+    pfSense URL, shared by every playbook, and pending changes are applied when the application exits.
+    """
+    _coordinators = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def for_url(cls, url, apply_func, delay=PfsenseFunction.APPLY_DELAY, max_latency=PfsenseFunction.APPLY_MAX_LATENCY):
+        """Get the coordinator for a pfSense URL, applying changes with `apply_func`."""
+        with cls._registry_lock:
+            if url not in cls._coordinators:
+                if not cls._coordinators:
+                    atexit.register(cls.flush_all)  # Don't leave staged changes unapplied when the application exits
+                cls._coordinators[url] = cls(apply_func, delay, max_latency, name=f"pysoar-pfsense-apply-{len(cls._coordinators)}")
+            else:
+                # Apply through the newest session, e.g. after the integration was reloaded with a new API key
+                cls._coordinators[url]._apply_func = apply_func
+            return cls._coordinators[url]
+
+    @classmethod
+    def flush_all(cls):
+        """Apply the pending changes of every pfSense instance now."""
+        for coordinator in list(cls._coordinators.values()):
+            coordinator.flush()
+
+    def __init__(self, apply_func, delay=PfsenseFunction.APPLY_DELAY, max_latency=PfsenseFunction.APPLY_MAX_LATENCY, name='pysoar-pfsense-apply'):
         self.log = Log.get_instance()
-        self.rule_data = rule_data
+        self._apply_func = apply_func
+        self._debouncer = Debouncer(self._apply, delay=delay, max_latency=max_latency, name=name)
+        self.requested = 0  # Number of applies requested
+        self.applied = 0    # Number of applies sent to pfSense
+
+    def mark_dirty(self):
+        """Record that changes are waiting to be applied."""
+        self.requested += 1
+        self._debouncer.trigger()
+
+    def flush(self):
+        """Apply the pending changes now. Returns the apply's result, or None if nothing was pending."""
+        return self._debouncer.flush()
+
+    @property
+    def pending(self):
+        return self._debouncer.pending
+
+    def _apply(self):
+        self.applied += 1
         try:
-            self.extract_rule_data()
+            result = self._apply_func()
         except Exception as e:
-            self.log.error(f"Error extracting rule data: {e}")
-            self.log.debug(f"FirewallRule.__init__ 'rule_data': {rule_data}")
-    
-    def extract_rule_data(self):
-        # Safely get the value from rule_data or default to None if key does not exist
-        #self.log.info(f"Extracting rule data...")
-        self.id = self.rule_data.get("id")
-        self.tracker = self.rule_data.get("tracker")
-        self.type = self.rule_data.get("type")
-        self.interface = self.rule_data.get("interface")
-        self.ipproto = self.rule_data.get("ipprotocol")
-        self.tag = self.rule_data.get("tag")
-        self.tagged = self.rule_data.get("tagged")
-        self.max = self.rule_data.get("max")
-        self.max_src_nodes = self.rule_data.get("max-src-nodes")
-        self.max_src_conn = self.rule_data.get("max-src-conn")
-        self.max_src_states = self.rule_data.get("max-src-states")
-        self.state_timeout = self.rule_data.get("statetimeout")
-        self.state_type = self.rule_data.get("statetype")
-        self.os = self.rule_data.get("os")
-        self.protocol = self.rule_data.get("protocol")
-        self.source = self.rule_data.get("source")
-        self.destination = self.rule_data.get("destination")
-        self.description = self.rule_data.get("descr")
-        self.updated = self.rule_data.get("updated")
-        self.created = self.rule_data.get("created")
-        # Extract nested fields
-        self.extract_addr_data()
-        self.extract_time_data()
-
-    def extract_addr_data(self):
-        if self.source.get('address', None):
-            self.source_address = self.source['address']
-        if self.source.get('port', None):
-            self.source_port = self.source['port']
-        if self.source.get('network', None):
-            self.source_network = self.source['network']
-        if self.source.get('any', None):
-            self.source_any = self.source['any']
-        if self.destination.get('address', None):
-            self.destination_address = self.destination['address']
-        if self.destination.get('port', None):
-            self.destination_port = self.destination['port']
-        if self.destination.get('network', None):
-            self.destination_network = self.destination['network']
-        if self.destination.get('any', None):
-            self.destination_any = self.destination['any']
-        
-    def extract_time_data(self):
-        if self.updated.get('time', None):
-            self.updated_time = self.updated['time']
-        if self.updated.get('username', None):
-            self.updated_username = self.updated['username']
-        if self.created.get('time', None):
-            self.created_time = self.created['time']
-        if self.created.get('username', None):
-            self.created_username = self.created['username']
+            self.log.error(f"Error applying pfSense changes: {e}")
+            result = False
+        if not result:
+            # Schedule the apply again, the changes are still staged on pfSense
+            self.log.error("Applying pfSense changes failed, retrying after the debounce delay.")
+            self._debouncer.trigger()
+        return result
+
+class BlockExpiryScheduler:
+    """
+    Removes blocks from pfSense once their time to live (TTL) has passed.
+
+    Expiry times are kept in a heap and in a sidecar file under SIDECAR_DIR, saved through the
+    PersistenceManager, so they survive restarts. A background thread waits for the earliest expiry plus
+    `batch_window` seconds, then removes every block expired by then together, so they share the API
+    calls and a single apply. There is one scheduler per pfSense URL.
+    """
+    SIDECAR_DIR = './data'
+    # Seconds to wait after the earliest expiry for more blocks to expire, so they are removed together
+    EXPIRY_BATCH_WINDOW = 60
+    _schedulers = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def for_pfsense(cls, pfsense):
+        """Get the scheduler for a pfSense instance's URL, removing the blocks through `pfsense`."""
+        with cls._registry_lock:
+            scheduler = cls._schedulers.get(pfsense.url)
+            if scheduler is None:
+                scheduler = cls._schedulers[pfsense.url] = cls(pfsense)
+            else:
+                scheduler.pfsense = pfsense
+            return scheduler
+
+    @classmethod
+    def sidecar_path(cls, url):
+        """Path of the file holding the expiry times of the blocks on a pfSense instance."""
+        name = re.sub(r'[^A-Za-z0-9]+', '_', str(url)).strip('_')
+        return os.path.join(cls.SIDECAR_DIR, f"{name}_block_expiry.yaml")
+
+    def __init__(self, pfsense, batch_window=EXPIRY_BATCH_WINDOW):
+        self.log = Log.get_instance()
+        self.pfsense = pfsense
+        self.batch_window = batch_window
+        self.path = self.sidecar_path(pfsense.url)
+        self.persistence = PersistenceManager.get_instance()
+        self._expiry = {}  # network -> expiry epoch time
+        self._heap = []    # (expiry epoch time, network), entries whose time no longer matches _expiry are stale
+        self._condition = threading.Condition()
+        self._thread = None
+        self._load()
+
+    def schedule(self, networks, ttl):
+        """Expire the blocks on these networks in `ttl` seconds, replacing any earlier expiry time."""
+        expires_at = int(self._now() + ttl)
+        with self._condition:
+            for network in networks:
+                self._expiry[network] = expires_at
+                heapq.heappush(self._heap, (expires_at, network))
+            self._save()
+            self._start()
+            self._condition.notify()
+
+    def cancel(self, networks):
+        """Keep the blocks on these networks forever."""
+        with self._condition:
+            cancelled = [network for network in networks if self._expiry.pop(network, None) is not None]
+            if cancelled:
+                self._save()
+
+    def expires_at(self, network):
+        """Epoch time a block expires at, or None if it never does."""
+        return self._expiry.get(network)
+
+    @property
+    def pending(self):
+        """Number of blocks waiting to expire."""
+        return len(self._expiry)
+
+    def pop_expired(self, now=None):
+        """Remove and return the networks whose blocks have expired at `now`."""
+        now = self._now() if now is None else now
+        expired = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, network = heapq.heappop(self._heap)
+                if self._expiry.get(network) == expires_at:
+                    del self._expiry[network]
+                    expired.append(network)
+            if expired:
+                self._save()
+        return expired
+
+    def remove_expired(self, now=None):
+        """Remove every expired block from pfSense in one batch. Returns the networks removed."""
+        expired = self.pop_expired(now)
+        if not expired:
+            return []
+        self.log.info(f"Removing {len(expired)} expired blocks...")
+        try:
+            self.pfsense.remove_blocked_networks(expired)
+        except Exception as e:
+            self.log.error(f"Error removing expired blocks, retrying in {self.batch_window} seconds: {e}")
+            self.schedule(expired, 0)
+            return []
+        return expired
+
+    def _run(self):
+        with self._condition:
+            while True:
+                # Drop the heap entries of cancelled or rescheduled blocks
+                while self._heap and self._expiry.get(self._heap[0][1]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._thread = None
+                    return
+                wait = self._heap[0][0] + self.batch_window - self._now()
+                if wait > 0:
+                    self._condition.wait(timeout=wait)
+                    continue
+                self._condition.release()
+                try:
+                    self.remove_expired()
+                except Exception as e:
+                    self.log.error(f"Error in the block expiry scheduler: {e}")
+                finally:
+                    self._condition.acquire()
+
+    def _start(self):
+        if self._thread is None and self._expiry:
+            self._thread = threading.Thread(target=self._run, name='pysoar-block-expiry', daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        self.persistence.flush(self.path)
+        try:
+            with open(self.path, 'r') as f:
+                expiry = yaml.safe_load(f) or {}
+        except FileNotFoundError:
+            return
+        except yaml.YAMLError as e:
+            self.log.error(f"Error reading the block expiry times from {self.path}: {e}")
+            return
+        with self._condition:
+            for network, expires_at in expiry.items():
+                self._expiry[network] = expires_at
+                heapq.heappush(self._heap, (expires_at, network))
+            self._start()
+        self.log.info(f"Loaded {len(expiry)} block expiry times from {self.path}.")
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.persistence.save(self.path, dict(self._expiry))
+
+    @staticmethod
+    def _now():
+        return datetime.now(tz=timezone.utc).timestamp()
+
+class BlocklistReconciler:
+    """
+    Converges pfSense's block list with a desired set of blocked networks.
+
+    The desired addresses are aggregated and compared with the current block list: the alias entries in
+    'alias' block mode, or the block rules with the reconciler's description in 'rule' mode. Only the
+    difference is sent to pfSense, in bulk calls, and the changes are applied once. Each reconciliation
+    returns a report of the planned operations and the API calls saved compared with sending every
+    indicator on its own.
+    """
+
+    def __init__(self, pfsense, descr="PySOAR Block"):
+        self.log = Log.get_instance()
+        self.pfsense = pfsense
+        self.descr = descr
+
+    def reconcile(self, desired, dry_run=False):
+        """Compute the difference with the desired addresses and apply it, unless `dry_run` is True."""
+        desired = list(desired)
+        networks, stats = aggregate_networks(desired)
+        current = self._read_current()
+        desired_set, current_set = set(networks), set(current)
+        to_add = [network for network in networks if network not in current_set]
+        to_remove = [network for network in current if network not in desired_set]
+        api_calls = self._count_api_calls(to_add, to_remove)
+        report = {
+            'mode': self.pfsense.block_mode,
+            'dry_run': dry_run,
+            'desired': stats['input'],
+            'aggregated': len(networks),
+            'current': len(current),
+            'unchanged': len(networks) - len(to_add),
+            'add': to_add,
+            'remove': to_remove,
+            'api_calls': api_calls,
+            # One call per indicator and per stale entry, each applied on its own
+            'naive_api_calls': 2 * (stats['input'] + len(to_remove)),
+        }
+        report['saved_api_calls'] = max(report['naive_api_calls'] - api_calls, 0)
+        self.log.info(f"Block list reconciliation{' (dry run)' if dry_run else ''}: {len(to_add)} to add, {len(to_remove)} to remove, "
+                      f"{report['unchanged']} unchanged, {api_calls} API calls ({report['saved_api_calls']} saved).")
+        if dry_run:
+            for network in to_add:
+                self.log.info(f"Would block {network}")
+            for network in to_remove:
+                self.log.info(f"Would unblock {network}")
+            return report
+        if to_add or to_remove:
+            if self.pfsense.block_mode == 'alias':
+                self._apply_alias_changes(to_add, to_remove)
+            else:
+                self._apply_rule_changes(to_add, to_remove)
+            self.pfsense.flush_changes()
+        return report
+
+    def _read_current(self):
+        """Returns the currently blocked networks, in their canonical form, and keeps where each is stored."""
+        self._stored = {}  # shard alias name, or None in rule mode -> canonical entries
+        if self.pfsense.block_mode == 'alias':
+            self.pfsense.read_aliases()
+            for shard in self.pfsense._get_shard_names():
+                self._stored[shard] = [self.pfsense._canonical_network(entry) for entry in self.pfsense.aliases[shard]['address']]
+        else:
+            self.pfsense.update_firewall_rule_cache()
+            rules = self.pfsense._rule_index.get_all_by_description(self.descr)
+            self._stored[None] = [self.pfsense._canonical_network(rule.source_address) for rule in rules if rule.networks]
+        return list(dict.fromkeys(entry for entries in self._stored.values() for entry in entries if entry))
+
+    def _count_api_calls(self, to_add, to_remove):
+        """Number of API calls needed to apply the difference, including the apply."""
+        if not to_add and not to_remove:
+            return 0
+        if self.pfsense.block_mode != 'alias':
+            return len(to_add) + len(to_remove) + 1
+        chunks = lambda count, size: -(-count // size)
+        chunk_size, shard_size = self.pfsense.ALIAS_CHUNK_SIZE, self.pfsense.alias_shard_size
+        removing, remaining, calls = set(to_remove), len(to_add), 1  # The apply
+        for entries in self._stored.values():
+            removed = sum(1 for entry in entries if entry in removing)
+            calls += chunks(removed, chunk_size)
+            free = min(max(shard_size - len(entries) + removed, 0), remaining)
+            calls += chunks(free, chunk_size)
+            remaining -= free
+        if remaining:
+            # New shards, created with their first chunk, and the parent alias update
+            calls += chunks(remaining, chunk_size) + 1
+        if not self.pfsense.get_firewall_rule_by_description(self.pfsense.BLOCK_RULE_DESCR):
+            calls += 1
+        return calls
+
+    def _apply_alias_changes(self, to_add, to_remove):
+        if to_remove:
+            self.pfsense.unblock_addresses(to_remove)
+        if to_add:
+            self.pfsense.block_addresses(to_add)
+
+    def _apply_rule_changes(self, to_add, to_remove):
+        removing = set(to_remove)
+        for rule in self.pfsense._rule_index.get_all_by_description(self.descr):
+            if rule.networks and self.pfsense._canonical_network(rule.source_address) in removing:
+                status, code, return_code, message, body = self.pfsense.delete('api/v1/firewall/rule', data={'tracker': int(rule.tracker), 'apply': False})
+                self.log.debug_requests_function("BlocklistReconciler", "_apply_rule_changes", status, code, return_code, message, self.pfsense.to_pretty(body))
+                if self.pfsense._is_success(code):
+                    self.pfsense._cache_deleted_rule(rule.tracker)
+        for network in to_add:
+            stage_rule = FirewallRule.new_block_rule(network, "any", "any", "any", descr=self.descr)
+            stage_rule['apply'] = False
+            status, code, return_code, message, body = self.pfsense.post('api/v1/firewall/rule', data=stage_rule)
+            self.log.debug_requests_function("BlocklistReconciler", "_apply_rule_changes", status, code, return_code, message, self.pfsense.to_pretty(body))
+            if self.pfsense._is_success(code, body):
+                self.pfsense._cache_added_rule(body)
+        self.pfsense.apply_changes()
+
+class FirewallRuleIndex:
+    """
+    Lookup indexes over the cached firewall rules.
+
+    Rules are indexed by tracker, description and port in dictionaries, and by their source and destination
+    networks in a longest-prefix match map, so lookups don't scan the rule list. Where several rules match,
+    the one that comes first in the rule list is returned, like the linear scans this replaces.
+    """
+
+    def __init__(self, rules=()):
+        self._by_tracker = {}
+        self._by_description = {}
+        self._by_port = {}
+        self._networks = PrefixMap()
+        self._order = {}  # id(rule) -> position in the rule list
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        """Index a rule, after the rules already indexed."""
+        self._order[id(rule)] = len(self._order)
+        if getattr(rule, 'tracker', None) is not None:
+            self._by_tracker[str(rule.tracker)] = rule
+        self._by_description.setdefault(getattr(rule, 'description', None), []).append(rule)
+        for port in self._ports(rule):
+            self._by_port.setdefault(port, []).append(rule)
+        for network in rule.networks:
+            self._networks.add(network, rule)
+
+    def remove(self, rule):
+        """Remove a rule from the indexes."""
+        if self._order.pop(id(rule), None) is None:
+            return
+        if self._by_tracker.get(str(getattr(rule, 'tracker', None))) is rule:
+            del self._by_tracker[str(rule.tracker)]
+        self._discard(self._by_description, getattr(rule, 'description', None), rule)
+        for port in self._ports(rule):
+            self._discard(self._by_port, port, rule)
+        for network in rule.networks:
+            self._networks.discard(network, rule)
+
+    def reorder(self, rules):
+        """Update the position of each rule after rules were inserted, removed or moved."""
+        self._order = {id(rule): position for position, rule in enumerate(rules)}
+
+    def get_by_tracker(self, tracker):
+        return self._by_tracker.get(str(tracker)) if tracker is not None else None
+
+    def get_by_description(self, description):
+        rules = self._by_description.get(description)
+        return rules[0] if rules else None
+
+    def get_all_by_description(self, description):
+        return list(self._by_description.get(description, []))
+
+    def get_by_network(self, network):
+        """Get the rules whose source or destination is exactly this address or network."""
+        return self._networks.get(network, [])
+
+    def get_by_port(self, port):
+        rules = self._by_port.get(str(port))
+        return rules[0] if rules else None
+
+    def get_by_ip(self, ip):
+        """Get the first rule whose source or destination network covers an IP address or network."""
+        matches = self._networks.match_all(ip)
+        return min(matches, key=lambda rule: self._order[id(rule)]) if matches else None
+
+    def __len__(self):
+        return len(self._order)
+
+    @staticmethod
+    def _discard(index, key, rule):
+        rules = index.get(key, [])
+        if rule in rules:
+            rules.remove(rule)
+            if not rules:
+                del index[key]
+
+    @staticmethod
+    def _ports(rule):
+        ports = {getattr(rule, 'source_port', None), getattr(rule, 'destination_port', None)}
+        return {str(port) for port in ports if port}
+
+class RuleField:
+    """Reads a (nested) field of a firewall rule's data when it is accessed, instead of copying it up front."""
+    __slots__ = ('keys',)
+
+    def __init__(self, *keys):
+        self.keys = keys
+
+    def __get__(self, rule, owner=None):
+        if rule is None:
+            return self
+        value = rule.rule_data
+        for key in self.keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+class FirewallRule:
+    """
+    Formats Firewall Rules from pfSense.
+
+    The rule keeps the data returned by pfSense as is and decodes each field when it is read, so building
+    the rules for a large ruleset is cheap. The source and destination networks are parsed once, up front,
+    for the rule lookups (see FirewallRuleIndex).
+    """
+    __slots__ = ('rule_data', 'networks')
+
+    id = RuleField("id")
+    tracker = RuleField("tracker")
+    type = RuleField("type")
+    interface = RuleField("interface")
+    ipproto = RuleField("ipprotocol")
+    tag = RuleField("tag")
+    tagged = RuleField("tagged")
+    max = RuleField("max")
+    max_src_nodes = RuleField("max-src-nodes")
+    max_src_conn = RuleField("max-src-conn")
+    max_src_states = RuleField("max-src-states")
+    state_timeout = RuleField("statetimeout")
+    state_type = RuleField("statetype")
+    os = RuleField("os")
+    protocol = RuleField("protocol")
+    source = RuleField("source")
+    destination = RuleField("destination")
+    description = RuleField("descr")
+    updated = RuleField("updated")
+    created = RuleField("created")
+    # Nested fields
+    source_address = RuleField("source", "address")
+    source_port = RuleField("source", "port")
+    source_network = RuleField("source", "network")
+    source_any = RuleField("source", "any")
+    destination_address = RuleField("destination", "address")
+    destination_port = RuleField("destination", "port")
+    destination_network = RuleField("destination", "network")
+    destination_any = RuleField("destination", "any")
+    updated_time = RuleField("updated", "time")
+    updated_username = RuleField("updated", "username")
+    created_time = RuleField("created", "time")
+    created_username = RuleField("created", "username")
+
+    def __init__(self, rule_data=None):
+        self.rule_data = rule_data if isinstance(rule_data, dict) else {}
+        if not isinstance(rule_data, dict):
+            Log.get_instance().error(f"Invalid firewall rule data: {rule_data}")
+        self.networks = self._parse_networks()
+
+    def _parse_networks(self):
+        """Returns the (version, first, last) ranges of the source and destination IP addresses or networks."""
+        networks = []
+        for address in (self.source_address, self.destination_address):
+            if not address or not isinstance(address, str):
+                continue
+            try:
+                network = parse_ip_range(address)
+            except ValueError:
+                continue  # Aliases, interface names and 'any' are not networks
+            if network not in networks:
+                networks.append(network)
+        return tuple(networks)
+
+    @property
+    def log(self):
+        return Log.get_instance()
+
+    def __repr__(self):
+        return f"FirewallRule(tracker={self.tracker!r}, type={self.type!r}, descr={self.description!r})"
 
     def format_rule(self):
         """Format the rule data."""
@@ -563,7 +1489,6 @@ class FirewallRule:
         
     @staticmethod
     def new_block_rule(
-            self,
             src, 
             src_port, 
             dst, 
@@ -581,7 +1506,6 @@ class FirewallRule:
     
     @staticmethod
     def new_pass_rule(
-            self, 
             src, 
             src_port, 
             dst, 
@@ -602,7 +1526,7 @@ class FirewallRule:
         # REF: "https://{PfSenseFunction.url}/api/documentation/#/Firewall%20>%20Rule/APIFirewallRuleCreate
         return {
             "ackqueue": "",
-            "apply": True,
+            "apply": False,  # The filter is reloaded once for every change through apply_changes
             "defaultqueue": "",
             "descr": descr,
             "direction": direction,
@@ -631,31 +1555,17 @@ class FirewallRule:
 
     def _format_source_addr_data(self):
         """Formats the address data for the source."""
-        data = {}
-        if hasattr(self, 'source_address'):
-            data['address'] = self.source_address
-        if hasattr(self, 'source_port'):
-            data['port'] = self.source_port
-        if hasattr(self, 'source_network'):
-            data['network'] = self.source_network
-        if hasattr(self, 'source_any'):
-            data['any'] = self.source_any
-        self.log.debug(f"FirewallRule._format_source_addr_data 'data': {data}") # Debugging
-        return data
+        return self._format_addr_data(self.source)
 
     def _format_destination_addr_data(self):
         """Formats the address data for the destination."""
-        data = {}
-        if hasattr(self, 'destination_address'):
-            data['address'] = self.destination_address
-        if hasattr(self, 'destination_port'):
-            data['port'] = self.destination_port
-        if hasattr(self, 'destination_network'):
-            data['network'] = self.destination_network
-        if hasattr(self, 'destination_any'):
-            data['any'] = self.destination_any
-        self.log.debug(f"FirewallRule._format_destination_addr_data 'data': {data}")
-        return data
+        return self._format_addr_data(self.destination)
+
+    @staticmethod
+    def _format_addr_data(addr_data):
+        if not isinstance(addr_data, dict):
+            return {}
+        return {key: addr_data[key] for key in ('address', 'port', 'network', 'any') if addr_data.get(key)}
 
     def _format_updated_time_data(self):
         """Formats the time data for the """
@@ -671,30 +1581,457 @@ class FirewallRule:
             "username": self.created_username,
         }        
     
-class PfsenseLog:
-    """Formats pfSense Logs."""
+# Syslog header of a filterlog line, in the BSD ("Nov  7 05:55:22") or RFC 5424 (ISO 8601) timestamp format
+FILTERLOG_PATTERN = re.compile(r'(\w{3}\s+\d{1,2}\s+\d\d:\d\d:\d\d|\d{4}-\d\d-\d\dT\S+)\s+(\S+)\s+(\w+)\[\d+\]:\s+(.*)')
+MONTHS = {month: number for number, month in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+def parse_syslog_timestamp(timestamp, today=None):
+    """
+    Parse a syslog timestamp into a datetime, cached since consecutive log lines share their timestamps.
+
+    BSD timestamps have no year, they are placed in the last twelve months before `today` (a date, the
+    current date by default).
+    """
+    return _parse_syslog_timestamp(timestamp, today or datetime.now().date())
+
+@lru_cache(maxsize=4096)
+def _parse_syslog_timestamp(timestamp, today):
+    # The inferred year depends on `today`, so it is part of the cache key
+    if 'T' in timestamp:
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    month, day, clock = timestamp.split()
+    hour, minute, second = clock.split(':')
+    parsed = datetime(today.year, MONTHS[month], int(day), int(hour), int(minute), int(second))
+    if parsed.date() > today:
+        parsed = parsed.replace(year=today.year - 1)
+    return parsed
+
+class FirewallLogEntry:
+    """
+    A parsed pfSense firewall (filterlog) log line.
+
+    Entries can also be read like the dictionaries the parser used to return, e.g. `entry['src_ip']`.
+    """
+    __slots__ = ('timestamp', 'hostname', 'rule_number', 'sub_rule_number', 'anchor', 'tracker', 'interface',
+                 'reason', 'action', 'direction', 'ip_version', 'proto', 'length', 'src_ip', 'dest_ip',
+                 'src_port', 'dest_port', 'data_length')
+
+    def __init__(self, timestamp, hostname, fields):
+        self.timestamp = timestamp
+        self.hostname = hostname
+        (self.rule_number, self.sub_rule_number, self.anchor, self.tracker, self.interface,
+         self.reason, self.action, self.direction, self.ip_version) = fields[:9]
+        # The IP header fields differ between IPv4 and IPv6
+        if self.ip_version == '6':
+            self.proto, self.length, self.src_ip, self.dest_ip = fields[12], fields[14], fields[15], fields[16]
+            ports = 17
+        else:
+            self.proto, self.length, self.src_ip, self.dest_ip = fields[16], fields[17], fields[18], fields[19]
+            ports = 20
+        if self.proto in ('tcp', 'udp') and len(fields) > ports + 2:
+            self.src_port, self.dest_port, self.data_length = fields[ports], fields[ports + 1], fields[ports + 2]
+        else:
+            self.src_port = self.dest_port = self.data_length = None
+
+    @property
+    def date(self):
+        return self.timestamp.date()
+
+    @property
+    def time(self):
+        return self.timestamp.time()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.__slots__}
+        data.update(date=self.date, time=self.time)
+        return data
+
+    def __repr__(self):
+        return f"FirewallLogEntry({self.timestamp:%b %d %H:%M:%S} {self.action} {self.src_ip} -> {self.dest_ip} {self.proto})"
+
+def iter_firewall_logs(lines, today=None):
+    """
+    Yield a FirewallLogEntry for each filterlog line, skipping lines from other processes or that don't parse.
+
+    `lines` can be any iterable, e.g. an open file, and is consumed one line at a time.
+    """
+    match = FILTERLOG_PATTERN.match
+    parse_timestamp = _parse_syslog_timestamp
+    today = today or datetime.now().date()
+    for line in lines:
+        matched = match(line)
+        if matched is None:
+            continue
+        timestamp, hostname, process, rest = matched.groups()
+        if process != 'filterlog':
+            continue
+        fields = rest.rstrip().split(',')
+        if len(fields) < 17:
+            continue
+        try:
+            yield FirewallLogEntry(parse_timestamp(timestamp, today), hostname, fields)
+        except (IndexError, ValueError, KeyError):
+            continue
+
+def log_time_key(timestamp):
+    """Seconds since the epoch of a log timestamp, read as local wall clock time like the BSD syslog timestamps."""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return calendar.timegm(timestamp.timetuple())
+
+class LogColumn:
+    """A dictionary-encoded column, each row is stored as a code into the list of distinct values."""
+    __slots__ = ('values', 'codes', 'data')
+
     def __init__(self):
+        self.values = []
+        self.codes = {}
+        self.data = array('I')
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+class FirewallLogStore:
+    """
+    Columnar store of firewall log entries, kept sorted by time.
+
+    Timestamps are kept in an integer array (see log_time_key) and every other field is dictionary encoded,
+    so a time range is found with two binary searches and returned as a FirewallLogSlice without copying rows.
+    """
+    COLUMNS = FirewallLogEntry.__slots__[1:]
+
+    def __init__(self, entries=()):
+        self.timestamps = array('q')
+        self.columns = {name: LogColumn() for name in self.COLUMNS}
+        self.extend(entries)
+
+    def append(self, entry):
+        self.extend((entry,))
+
+    def extend(self, entries):
+        """Add entries, appending those in time order and merging the late ones (e.g. a delayed syslog message)."""
+        timestamps, columns = self.timestamps, self.columns.items()
+        late = []
+        for entry in entries:
+            key = log_time_key(entry.timestamp)
+            if timestamps and key < timestamps[-1]:
+                late.append((key, entry))
+                continue
+            # The row count is read from the timestamps, so they are appended last for concurrent readers
+            for name, column in columns:
+                column.data.append(column.encode(getattr(entry, name)))
+            timestamps.append(key)
+        if late:
+            self._merge(late)
+
+    def _merge(self, late):
+        """Add out of order entries with a single stable sort of every column."""
+        keys = list(self.timestamps) + [key for key, _ in late]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.timestamps = array('q', map(keys.__getitem__, order))
+        for name, column in self.columns.items():
+            codes = list(column.data) + [column.encode(getattr(entry, name)) for _, entry in late]
+            column.data = array('I', map(codes.__getitem__, order))
+
+    def expire(self, before):
+        """Drop the entries older than `before` (a log_time_key). Returns the number of entries dropped."""
+        index = bisect_left(self.timestamps, before)
+        if index:
+            self.timestamps = self.timestamps[index:]
+            for column in self.columns.values():
+                column.data = column.data[index:]
+        return index
+
+    def between(self, start, end):
+        """Entries from `start` to `end` (datetimes), both inclusive."""
+        return FirewallLogSlice(self, bisect_left(self.timestamps, log_time_key(start)),
+                                bisect_right(self.timestamps, log_time_key(end)))
+
+    def since(self, start):
+        """Entries from `start` (a datetime) onwards."""
+        return FirewallLogSlice(self, bisect_left(self.timestamps, log_time_key(start)), len(self.timestamps))
+
+    def last(self, minutes=0, seconds=0, now=None):
+        """Entries from the last N minutes and/or seconds, before `now` (defaults to the current local time)."""
+        now = now or datetime.now()
+        return self.between(now - timedelta(minutes=minutes, seconds=seconds), now)
+
+    def entry(self, index):
+        """Rebuild the FirewallLogEntry at a row index."""
+        entry = FirewallLogEntry.__new__(FirewallLogEntry)
+        entry.timestamp = datetime.fromtimestamp(self.timestamps[index], timezone.utc).replace(tzinfo=None)
+        for name, column in self.columns.items():
+            setattr(entry, name, column.values[column.data[index]])
+        return entry
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("FirewallLogStore slices do not support a step.")
+            return FirewallLogSlice(self, start, max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.entry(index)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __len__(self):
+        return len(self.timestamps)
+
+class FirewallLogSlice:
+    """
+    A contiguous range of rows of a FirewallLogStore.
+
+    Slices don't copy the rows, columns are only decoded when they are read. A slice keeps the arrays the
+    store had when it was taken: expire and late entries replace the store's arrays instead of changing them,
+    and new rows are appended past the slice's end, so a slice's entries don't change as the store is updated.
+    """
+    __slots__ = ('timestamps', 'columns', 'start', 'stop')
+
+    def __init__(self, store, start, stop):
+        self.timestamps = store.timestamps
+        self.columns = {name: (column.values, column.codes, column.data) for name, column in store.columns.items()}
+        self.start = start
+        self.stop = stop
+
+    def column(self, name):
+        """The decoded values of a column."""
+        values, _, data = self.columns[name]
+        return list(map(values.__getitem__, data[self.start:self.stop]))
+
+    def count_by(self, name):
+        """Counter of the values of a column, e.g. count_by('src_ip')."""
+        values, _, data = self.columns[name]
+        return Counter({values[code]: count for code, count in Counter(data[self.start:self.stop]).items()})
+
+    def where(self, **conditions):
+        """The entries whose columns equal the given values, e.g. where(action='block', proto='tcp')."""
+        rows = range(self.start, self.stop)
+        for name, value in conditions.items():
+            _, codes, data = self.columns[name]
+            code = codes.get(value)
+            if code is None:
+                return []
+            rows = list(compress(rows, map(code.__eq__, map(data.__getitem__, rows))))
+        return [self.entry(index) for index in rows]
+
+    def entry(self, index):
+        """Rebuild the FirewallLogEntry at a row index of the store's arrays."""
+        entry = FirewallLogEntry.__new__(FirewallLogEntry)
+        entry.timestamp = datetime.fromtimestamp(self.timestamps[index], timezone.utc).replace(tzinfo=None)
+        for name, (values, _, data) in self.columns.items():
+            setattr(entry, name, values[data[index]])
+        return entry
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("FirewallLogSlice slices do not support a step.")
+            sliced = FirewallLogSlice.__new__(FirewallLogSlice)
+            sliced.timestamps, sliced.columns = self.timestamps, self.columns
+            sliced.start, sliced.stop = self.start + start, self.start + max(start, stop)
+            return sliced
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.entry(self.start + index)
+
+    def __iter__(self):
+        entry = self.entry
+        for index in range(self.start, self.stop):
+            yield entry(index)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __bool__(self):
+        return self.stop > self.start
+
+class LogCursor:
+    """Position of the last line read from a log, the line's time and a hash of its text."""
+    __slots__ = ('timestamp', 'line_hash')
+
+    def __init__(self, timestamp, line_hash):
+        self.timestamp = timestamp
+        self.line_hash = line_hash
+
+    @staticmethod
+    def hash_line(line):
+        return hashlib.blake2b(str(line).encode(), digest_size=8).digest()
+
+    @classmethod
+    def for_line(cls, line):
+        return cls(line_time_key(line), cls.hash_line(line))
+
+    def __repr__(self):
+        return f"LogCursor({self.timestamp}, {self.line_hash.hex()})"
+
+def line_time_key(line):
+    """log_time_key of a syslog line, or None if it has no syslog header."""
+    matched = FILTERLOG_PATTERN.match(line) if isinstance(line, str) else None
+    if matched is None:
+        return None
+    try:
+        return log_time_key(parse_syslog_timestamp(matched.group(1)))
+    except (KeyError, ValueError):
+        return None
+
+class PfsenseLog:
+    """
+    Formats pfSense Logs.
+
+    Each log keeps a LogCursor on the last line read, so when a log is downloaded again (see tail_logs) only the
+    lines after the cursor are parsed and added to the cache. Lines older than `retention` seconds are dropped.
+    """
+    LOG_NAMES = ('config_history', 'dhcp', 'firewall', 'system')
+    # Seconds between the retention checks of the lines pushed by the syslog listener
+    EXPIRE_INTERVAL = 10
+
+    def __init__(self, retention=None, analytics=None):
         self._firewall_logs = None
         self._dhcp_logs = None
         self._system_logs = None
         self._config_history_logs = None
+        self._cursors = {}
+        self.retention = retention
+        self._next_expiry = 0  # log_time_key of the next retention check of pushed lines
+        self.lock = threading.RLock()  # Serializes the API tailing and the syslog listener
+        # Windowed aggregates updated as firewall log entries are added, see FirewallLogAnalytics
+        self.analytics = analytics
+        self._event_listeners = []
         # Debugging
         self.log = Log.get_instance()
         self.log.debug(f"FirewallLog.__init__: {self.__dict__}")
 
+    def tail_logs(self, log_name, logs):
+        """Add the lines of a downloaded log that come after the log's cursor to the cache. Returns the number of new lines."""
+        if log_name not in self.LOG_NAMES:
+            raise ValueError(f"Invalid log name: {log_name}")
+        lines = self._get_lines(logs)
+        with self.lock:
+            new_lines = self._get_new_lines(log_name, lines)
+            self._add_lines(log_name, new_lines)
+        self.log.debug(f"Read {len(new_lines)} new {log_name} log lines out of {len(lines)}.")
+        return len(new_lines)
+
+    def ingest_firewall_logs(self, lines):
+        """Add firewall log lines pushed by the syslog listener to the cache. Returns the number of entries added."""
+        with self.lock:
+            if self._firewall_logs is None:
+                self._firewall_logs = FirewallLogStore()
+            added = self._add_firewall_entries(list(iter_firewall_logs(lines)))
+            # Batches arrive many times per second, the retention is only checked every EXPIRE_INTERVAL seconds
+            now = datetime.now()
+            if self.retention and log_time_key(now) >= self._next_expiry:
+                self.expire_logs('firewall', now)
+                self._next_expiry = log_time_key(now) + self.EXPIRE_INTERVAL
+            return added
+
+    def add_event_listener(self, callback):
+        """Call `callback(entries)` with every batch of new firewall log entries, e.g. to trigger playbooks."""
+        self._event_listeners.append(callback)
+
+    def remove_event_listener(self, callback):
+        self._event_listeners = [listener for listener in self._event_listeners if listener is not callback]
+
+    def _add_firewall_entries(self, entries):
+        self._firewall_logs.extend(entries)
+        if self.analytics is not None:
+            self.analytics.observe_many(entries)
+        for callback in self._event_listeners:
+            try:
+                callback(entries)
+            except Exception as e:
+                self.log.error(f"Error in firewall log event listener: {e}")
+        return len(entries)
+
+    def _add_lines(self, log_name, new_lines):
+        if new_lines:
+            self._cursors[log_name] = LogCursor.for_line(new_lines[-1])
+            if log_name == 'firewall':
+                if self._firewall_logs is None:
+                    self._firewall_logs = FirewallLogStore()
+                self._add_firewall_entries(list(iter_firewall_logs(new_lines)))
+            else:
+                cache = getattr(self, f"_{log_name}_logs")
+                if cache is None:
+                    cache = []
+                    setattr(self, f"_{log_name}_logs", cache)
+                cache.extend(new_lines)
+        elif log_name == 'firewall' and self._firewall_logs is None:
+            self._firewall_logs = FirewallLogStore()
+        elif getattr(self, f"_{log_name}_logs") is None:
+            setattr(self, f"_{log_name}_logs", [])
+        self.expire_logs(log_name)
+
+    def expire_logs(self, log_name, now=None):
+        """Drop the cached lines older than the retention period. Returns the number of lines dropped."""
+        if not self.retention:
+            return 0
+        before = log_time_key(now or datetime.now()) - self.retention
+        if log_name == 'firewall':
+            return self._firewall_logs.expire(before) if self._firewall_logs is not None else 0
+        cache = getattr(self, f"_{log_name}_logs") or []
+        # Lines are in time order, lines without a syslog header are kept with the line before them
+        expired = 0
+        for line in cache:
+            timestamp = line_time_key(line)
+            if timestamp is not None and timestamp >= before:
+                break
+            expired += 1
+        del cache[:expired]
+        return expired
+
+    def reset_cursor(self, log_name):
+        """Forget the position in a log, the next download is read in full."""
+        self._cursors.pop(log_name, None)
+
+    def _get_new_lines(self, log_name, lines):
+        """The lines after the cursor, found by searching back from the end for the last line read."""
+        cursor = self._cursors.get(log_name)
+        if cursor is None:
+            return lines
+        hash_line = LogCursor.hash_line
+        for index in range(len(lines) - 1, -1, -1):
+            if hash_line(lines[index]) == cursor.line_hash:
+                return lines[index + 1:]
+        # The last line read has been rotated out of the log, fall back to the lines that are newer than it
+        self.log.debug(f"The {log_name} log cursor was not found, reading the lines after {cursor.timestamp}.")
+        if cursor.timestamp is None:
+            return lines
+        return [line for line in lines if (line_time_key(line) or 0) > cursor.timestamp]
+
+    @staticmethod
+    def _get_lines(logs):
+        if isinstance(logs, dict):
+            logs = logs.get('data')
+        return list(logs or [])
+
     def gather_firewall_logs(self, logs):
-        """Converts each entry in a log list to a json object and then returns the list"""
+        """Parses each entry in a log list into a FirewallLogStore and then returns the store"""
         self.log.debug(f"Gathering firewall logs...")
-        all_logs = []
-        for log in logs:
-            log = self.extract_log_data(log)
-            # Convert the date (ex. 'Nov 7') and time (ex. 05:55:22) to a datetime object
-            log['date'] = datetime.strptime(log['date'], '%b %d')
-            log['time'] = datetime.strptime(log['time'], '%H:%M:%S')
-            all_logs.append(log)
-        
-        self._firewall_log_data = all_logs
-        return all_logs
+        self._firewall_logs = None
+        self.reset_cursor('firewall')
+        if self.analytics is not None:
+            self.analytics.reset()
+        self.tail_logs('firewall', logs)
+        return self._firewall_logs
     
     def get_firewall_logs_by_datetimerange(self, start_date, end_date, start_time=None, end_time=None):
         """Get the firewall logs by date and time range from pfSense."""
@@ -709,51 +2046,45 @@ class PfsenseLog:
         if start_datetime >= end_datetime:
             raise ValueError("Start datetime must be before end datetime.")
 
-        filtered_logs = [
-            log for log in self._log_data
-            if start_datetime <= datetime.combine(log['date'], log['time']) <= end_datetime
-        ]
+        if self._firewall_logs is None:
+            return []
+        return self._firewall_logs.between(start_datetime, end_datetime)
 
-        return filtered_logs
+    def get_recent_firewall_logs(self, minutes=5):
+        """Get the firewall logs from the last N minutes."""
+        if self._firewall_logs is None:
+            return []
+        return self._firewall_logs.last(minutes=minutes)
 
     def extract_firewall_log_data(self, log_entry):
-        """Parse a pfSense firewall log entry into a JSON object."""
-        log_parts = [
-            'date', 'time', 'hostname', 'process', 'rule_number', 'sub_rule_number',
-            'anchor', 'tracker', 'interface', 'reason', 'action', 'direction',
-            'ip_version', 'tos', 'ecn', 'ttl', 'id', 'offset', 'flags', 'proto',
-            'length', 'src_ip', 'dest_ip', 'src_port', 'dest_port', 'data_length'
-        ]
-
-        # Regular expression to match the log entry pattern
-        # Note: This pattern is very specific to the example log format provided
-        pattern = r'(\w+\s+\d+\s+\d+:\d+:\d+)\s+(\w+)\s+(\w+)\[(\d+)\]:\s+(\d+),(\S*),(\S*),(\S*),(\S*),(\S*),(\S*),(\S*),(\S*),(\S*),(\S*),(\d+),(\S*),(\d+),(\S*),(\S*),(\S*),(\d+),(\S*),(\S*),(\S*),(\S*),(\d+),(\S+),(\d+),(\d+),(\d+)'
-
-        # Match the log entry with the pattern
-        match = re.match(pattern, log_entry)
-        if match:
-            # Extract the groups from the match and zip with the parts names
-            log_data = dict(zip(log_parts, match.groups()))
-
-            # Convert to JSON object (string)
-            json_data = json.dumps(log_data, indent=4)
-            return json_data
-        else:
+        """Parse a pfSense firewall log entry into a FirewallLogEntry."""
+        entry = next(iter_firewall_logs([log_entry]), None)
+        if entry is None:
             self.log.error("Log entry does not match the expected format.")
-            return None
+        return entry
 
     def gather_dhcp_logs(self, logs):
-        """Converts each entry in a log list to a json object and then returns the list"""
-        self._dhcp_log_data = logs
+        """Caches the lines of the DHCP log and then returns the list"""
+        return self._gather_logs('dhcp', logs)
 
     def gather_system_logs(self, logs):
-        """Converts each entry in a log list to a json object and then returns the list"""
-        self._system_log_data = logs
+        """Caches the lines of the system log and then returns the list"""
+        return self._gather_logs('system', logs)
 
     def gather_config_history_logs(self, logs):
-        """Converts each entry in a log list to a json object and then returns the list"""
-        self._config_history_log_data = logs
+        """Caches the lines of the config history log and then returns the list"""
+        return self._gather_logs('config_history', logs)
+
+    def _gather_logs(self, log_name, logs):
+        setattr(self, f"_{log_name}_logs", None)
+        self.reset_cursor(log_name)
+        self.tail_logs(log_name, logs)
+        return getattr(self, f"_{log_name}_logs")
     
+    @property
+    def cursors(self):
+        return self._cursors
+
     @property
     def firewall_logs(self):
         return self._firewall_logs
@@ -770,3 +2101,240 @@ class PfsenseLog:
     def config_history_logs(self):
         return self._config_history_logs
 
+# Network syslog messages, the RFC 5424 format and the BSD (RFC 3164) format, where pfSense omits the hostname
+SYSLOG_PRI_PATTERN = re.compile(r'<\d{1,3}>')
+RFC5424_PATTERN = re.compile(r'1 (\S+) (\S+) (\S+) (\S+) \S+ (?:-|\[.*?\]) ?(.*)', re.DOTALL)
+RFC3164_PATTERN = re.compile(r'(\w{3}\s+\d{1,2}\s+\d\d:\d\d:\d\d)\s+(?:(\S+)\s+)?(\w+\[\d+\]:.*)', re.DOTALL)
+
+def syslog_to_log_line(message, default_hostname='pfSense'):
+    """Convert a syslog message received from the network to the format of the pfSense log files, or None."""
+    pri = SYSLOG_PRI_PATTERN.match(message)
+    if pri:
+        message = message[pri.end():]
+    matched = RFC5424_PATTERN.match(message)
+    if matched:
+        timestamp, hostname, process, pid, rest = matched.groups()
+        return f"{timestamp} {hostname} {process}[{pid if pid != '-' else 0}]: {rest.rstrip()}"
+    matched = RFC3164_PATTERN.match(message)
+    if matched:
+        timestamp, hostname, rest = matched.groups()
+        return f"{timestamp} {hostname or default_hostname} {rest.rstrip()}"
+    return None
+
+class SyslogListener:
+    """
+    Receives the remote syslog messages sent by pfSense and adds the firewall log entries to a PfsenseLog.
+
+    Receiving threads only put the raw messages on a bounded queue, and a single worker parses them in batches of
+    up to `batch_size`. When the queue is full, `drop_policy` decides what gives:
+    'drop_newest' drops the incoming message, 'drop_oldest' drops the oldest queued message and 'block' makes the
+    receiver wait, which pushes back on TCP senders (UDP senders are then dropped by the kernel instead).
+    There is one listener per address, shared by every PfsenseFunction using it.
+    """
+    DROP_POLICIES = ('drop_newest', 'drop_oldest', 'block')
+    QUEUE_SIZE = 50000
+    BATCH_SIZE = 1000
+    # Seconds the worker waits for a full batch before parsing what it has
+    BATCH_WAIT = 0.2
+    # Socket receive buffer for UDP, to absorb bursts while the worker parses a batch
+    UDP_RECEIVE_BUFFER = 4 * 1024 * 1024
+    _listeners = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def for_address(cls, log_mgr, host, port, **kwargs):
+        """
+        Get the running listener for an address, or start one that feeds `log_mgr`.
+
+        Raises:
+            OSError: If the socket could not be bound, the listener is then not registered.
+            ValueError: If the running listener uses another protocol.
+        """
+        with cls._registry_lock:
+            listener = cls._listeners.get((host, port))
+            if listener is None:
+                listener = cls(log_mgr, host, port, **kwargs)
+                listener.start()
+                cls._listeners[(host, port)] = listener
+                return listener
+        protocol = kwargs.get('protocol', 'udp')
+        if protocol != listener.protocol:
+            raise ValueError(f"The syslog listener on {host}:{port} uses {listener.protocol}, not {protocol}")
+        for setting in ('queue_size', 'batch_size', 'drop_policy'):
+            if setting in kwargs and kwargs[setting] != getattr(listener, setting):
+                listener.log.warning(f"The syslog listener on {host}:{port} is already running with {setting}="
+                                     f"{getattr(listener, setting)}, ignoring {setting}={kwargs[setting]}")
+        return listener
+
+    def __init__(self, log_mgr, host='0.0.0.0', port=5514, protocol='udp', queue_size=QUEUE_SIZE,
+                 batch_size=BATCH_SIZE, drop_policy='drop_newest'):
+        if protocol not in ('udp', 'tcp'):
+            raise ValueError(f"Invalid syslog protocol: {protocol}")
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError(f"Invalid drop policy: {drop_policy}")
+        self.log = Log.get_instance()
+        self.log_mgr = log_mgr
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.drop_policy = drop_policy
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._running = False
+        self._socket = None
+        self._server = None
+        self._threads = []
+        # Counters
+        self.received = 0
+        self.dropped = 0
+        self.ingested = 0
+        self.batches = 0
+
+    def start(self):
+        """Bind the socket and start the receiving and parsing threads. Raises OSError if the socket can't be bound."""
+        if self.protocol == 'udp':
+            self._socket = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.UDP_RECEIVE_BUFFER)
+                self._socket.bind((self.host, self.port))
+            except OSError:
+                self._socket.close()
+                self._socket = None
+                raise
+            self._socket.settimeout(0.5)
+            receiver = self._receive_udp
+        else:
+            self._server = SyslogTCPServer((self.host, self.port), SyslogTCPHandler, self)
+            receiver = self._server.serve_forever
+        self._running = True
+        self._threads = [
+            threading.Thread(target=receiver, name=f"pysoar-syslog-{self.protocol}", daemon=True),
+            threading.Thread(target=self._work, name='pysoar-syslog-worker', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self.log.info(f"Listening for pfSense syslog messages on {self.protocol}://{self.host}:{self.address[1]}")
+
+    def stop(self):
+        """Stop receiving, then parse what is left on the queue."""
+        self._running = False
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        with self._condition:
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        if self._socket is not None:
+            self._socket.close()
+        with self._registry_lock:
+            if self._listeners.get((self.host, self.port)) is self:
+                del self._listeners[(self.host, self.port)]
+
+    def put(self, message, hostname=None):
+        """Queue a raw message according to the drop policy. Returns False if the message was dropped."""
+        with self._condition:
+            self.received += 1
+            if len(self._queue) >= self.queue_size:
+                if self.drop_policy == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                if self.drop_policy == 'drop_oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._queue) >= self.queue_size and self._running:
+                        self._condition.wait()
+            self._queue.append((message, hostname))
+            if len(self._queue) >= self.batch_size:
+                self._condition.notify_all()
+            return True
+
+    def _receive_udp(self):
+        receive, put = self._socket.recvfrom, self.put
+        while self._running:
+            try:
+                data, address = receive(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            put(data, address[0])
+
+    def _work(self):
+        while True:
+            with self._condition:
+                if len(self._queue) < self.batch_size and self._running:
+                    self._condition.wait(timeout=self.BATCH_WAIT)
+                if not self._queue:
+                    if not self._running:
+                        return
+                    continue
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                # Wake up the receivers blocked on a full queue
+                self._condition.notify_all()
+            try:
+                self._ingest(batch)
+            except Exception as e:
+                self.log.error(f"Error parsing syslog messages: {e}")
+
+    def _ingest(self, batch):
+        lines = []
+        for message, hostname in batch:
+            if isinstance(message, bytes):
+                message = message.decode('utf-8', 'replace')
+            line = syslog_to_log_line(message, hostname or 'pfSense')
+            if line is not None:
+                lines.append(line)
+        self.ingested += self.log_mgr.ingest_firewall_logs(lines)
+        self.batches += 1
+
+    @property
+    def address(self):
+        """The address the listener is bound to, e.g. to find the port picked when binding to port 0."""
+        if self._socket is not None:
+            return self._socket.getsockname()[:2]
+        if self._server is not None:
+            return self._server.server_address[:2]
+        return (self.host, self.port)
+
+    @property
+    def pending(self):
+        return len(self._queue)
+
+    @property
+    def stats(self):
+        return {'received': self.received, 'dropped': self.dropped, 'ingested': self.ingested,
+                'batches': self.batches, 'pending': self.pending}
+
+class SyslogTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, listener):
+        self.address_family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+        self.listener = listener
+        super().__init__(address, handler)
+
+class SyslogTCPHandler(socketserver.StreamRequestHandler):
+    """Reads syslog messages framed by newlines, or by octet counting (RFC 6587)."""
+
+    def handle(self):
+        put, hostname, rfile = self.server.listener.put, self.client_address[0], self.rfile
+        while True:
+            first = rfile.peek(1)[:1]
+            if not first:
+                return
+            if first.isdigit():
+                # Octet counting, the message length then a space, e.g. b'123 <134>1 2024-...'
+                length = b''
+                while (char := rfile.read(1)) not in (b' ', b''):
+                    length += char
+                message = rfile.read(int(length or 0))
+            else:
+                message = rfile.readline()
+            if not message:
+                return
+            put(message, hostname)
@@ -0,0 +1,276 @@
+"""Local Indicator of Compromise (IOC) Store"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from classes import Log
+from indicators import IP_DATA_TYPES, PrefixMap
+
+class IocStore:
+    """
+    On-disk store of indicators, indexed by type and value.
+
+    The store is fed by the MISP integration and lets playbooks make decisions from local data, without a
+    round trip to MISP, so they keep working at full speed while the uplink is down. Each indicator keeps
+    the time it was first and last seen, the feeds that provide it, and its tags. An indicator removed by
+    one feed stays in the store while another feed still provides it. For IP data types, an address inside
+    a stored network is a known indicator too.
+    """
+    DB_PATH = './data/iocs.db'
+    # Maximum number of values bound to a single SQL statement
+    CHUNK_SIZE = 500
+    # One store per database file, shared by the integrations and playbooks
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, db_path=None):
+        self.log = Log.get_instance()
+        self.db_path = db_path or self.DB_PATH
+        self._lock = threading.RLock()
+        # Stored networks of each IP data type, rebuilt when the store changed since they were loaded
+        self._generation = 0
+        self._networks = {}  # data type -> (generation, PrefixMap of network -> stored value)
+        if self.db_path != ':memory:':
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._create_tables()
+        self.log.debug(f"IOC store opened at {self.db_path}")
+
+    @classmethod
+    def for_path(cls, db_path=None):
+        """Get the store of a database file, opening it on first use."""
+        db_path = db_path or cls.DB_PATH
+        with cls._stores_lock:
+            store = cls._stores.get(db_path)
+            if store is None:
+                store = cls._stores[db_path] = cls(db_path)
+            return store
+
+    def _create_tables(self):
+        with self._lock, self._conn:
+            migrate = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'iocs'").fetchone() is not None
+            migrate = migrate and self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ioc_sources'").fetchone() is None
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS iocs (
+                    type TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    first_seen INTEGER NOT NULL,
+                    last_seen INTEGER NOT NULL,
+                    source_feed TEXT,
+                    tags TEXT,
+                    PRIMARY KEY (type, value)
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS iocs_by_feed ON iocs (source_feed, type)")
+            # The feeds that provide each indicator
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS ioc_sources (
+                    type TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    source_feed TEXT NOT NULL,
+                    PRIMARY KEY (type, value, source_feed)
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ioc_sources_by_feed ON ioc_sources (source_feed, type)")
+            if migrate:
+                # Stores created before the feeds were tracked only know the feed that last provided each indicator
+                self._conn.execute("INSERT OR IGNORE INTO ioc_sources SELECT type, value, source_feed FROM iocs WHERE source_feed IS NOT NULL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS iocs_by_last_seen ON iocs (last_seen)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, state TEXT NOT NULL)")
+
+    # Writers
+    def add(self, data_type, values, source_feed=None, tags=None, seen=None):
+        """Insert or refresh indicators of a single type. Returns the number of values written."""
+        seen = int(seen if seen is not None else time.time())
+        tags = json.dumps(sorted(tags)) if tags else None
+        rows = [(data_type, value, seen, seen, source_feed, tags) for value in values]
+        with self._lock, self._conn:
+            self._conn.executemany("""
+                INSERT INTO iocs (type, value, first_seen, last_seen, source_feed, tags) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (type, value) DO UPDATE SET
+                    last_seen = excluded.last_seen,
+                    source_feed = COALESCE(iocs.source_feed, excluded.source_feed),
+                    tags = COALESCE(excluded.tags, iocs.tags)
+            """, rows)
+            self._generation += 1
+            if source_feed is not None:
+                self._conn.executemany("INSERT OR IGNORE INTO ioc_sources (type, value, source_feed) VALUES (?, ?, ?)",
+                                       ((data_type, value, source_feed) for value in values))
+        return len(rows)
+
+    def remove(self, data_type, values, source_feed=None):
+        """
+        Remove indicators of a single type. Returns the number of indicators removed from the store.
+
+        With a `source_feed`, only that feed stops providing the values, and the indicators other feeds still
+        provide are kept.
+        """
+        values = list(values)
+        with self._lock, self._conn:
+            self._generation += 1
+            if source_feed is None:
+                self._conn.executemany("DELETE FROM ioc_sources WHERE type = ? AND value = ?",
+                                       ((data_type, value) for value in values))
+                cursor = self._conn.executemany("DELETE FROM iocs WHERE type = ? AND value = ?",
+                                                ((data_type, value) for value in values))
+                return cursor.rowcount
+            self._conn.executemany("DELETE FROM ioc_sources WHERE type = ? AND value = ? AND source_feed = ?",
+                                   ((data_type, value, source_feed) for value in values))
+            cursor = self._conn.executemany("""
+                DELETE FROM iocs WHERE type = ? AND value = ? AND NOT EXISTS (
+                    SELECT 1 FROM ioc_sources WHERE ioc_sources.type = iocs.type AND ioc_sources.value = iocs.value)
+            """, ((data_type, value) for value in values))
+            removed = cursor.rowcount
+            # The kept indicators now name one of the feeds that still provide them
+            self._conn.executemany("""
+                UPDATE iocs SET source_feed = (
+                    SELECT MIN(source_feed) FROM ioc_sources WHERE ioc_sources.type = iocs.type AND ioc_sources.value = iocs.value)
+                WHERE type = ? AND value = ? AND source_feed = ?
+            """, ((data_type, value, source_feed) for value in values))
+        return removed
+
+    def expire(self, older_than):
+        """Remove the indicators that have not been seen since the `older_than` epoch time."""
+        with self._lock, self._conn:
+            self._generation += 1
+            self._conn.execute("""
+                DELETE FROM ioc_sources WHERE EXISTS (
+                    SELECT 1 FROM iocs WHERE iocs.type = ioc_sources.type AND iocs.value = ioc_sources.value AND last_seen < ?)
+            """, (int(older_than),))
+            cursor = self._conn.execute("DELETE FROM iocs WHERE last_seen < ?", (int(older_than),))
+        self.log.info(f"Expired {cursor.rowcount} indicators from the IOC store.")
+        return cursor.rowcount
+
+    # Readers
+    def contains(self, data_type, value):
+        """Check if an indicator is in the store, or for IP data types, covered by a stored network."""
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM iocs WHERE type = ? AND value = ?", (data_type, value)).fetchone()
+        return row is not None or self._covering_network(data_type, value) is not None
+
+    def lookup(self, data_type, value):
+        """
+        Get an indicator's details, or None if it is not in the store.
+
+        For IP data types, an address without its own entry gets the details of the most specific stored
+        network covering it.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT type, value, first_seen, last_seen, source_feed, tags FROM iocs WHERE type = ? AND value = ?",
+                (data_type, value)).fetchone()
+        if row is None:
+            network = self._covering_network(data_type, value)
+            return self.lookup(data_type, network) if network is not None and network != value else None
+        ioc = self._row_to_dict(row)
+        with self._lock:
+            sources = self._conn.execute("SELECT source_feed FROM ioc_sources WHERE type = ? AND value = ? ORDER BY source_feed",
+                                         (data_type, value)).fetchall()
+        ioc['source_feeds'] = [source[0] for source in sources]
+        return ioc
+
+    def contains_many(self, data_type, values):
+        """
+        Bulk membership query, returns the set of `values` that are in the store.
+
+        For IP data types, the values covered by a stored network are included.
+        """
+        values = list(values)
+        found = set()
+        with self._lock:
+            for start in range(0, len(values), self.CHUNK_SIZE):
+                chunk = values[start:start + self.CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT value FROM iocs WHERE type = ? AND value IN ({placeholders})", [data_type, *chunk])
+                found.update(row[0] for row in rows)
+        if data_type in IP_DATA_TYPES:
+            networks = self._get_networks(data_type)
+            if len(networks):
+                found.update(value for value in values if value not in found and value in networks)
+        return found
+
+    def filter_known(self, data_type, values):
+        """Returns the values that are known indicators, keeping their order."""
+        values = list(values)
+        found = self.contains_many(data_type, values)
+        return [value for value in values if value in found]
+
+    def filter_unknown(self, data_type, values):
+        """Returns the values that are not known indicators, keeping their order."""
+        values = list(values)
+        found = self.contains_many(data_type, values)
+        return [value for value in values if value not in found]
+
+    def values(self, data_type, source_feed=None):
+        """Yield every indicator value of a type, optionally only those from a given feed."""
+        query, params = "SELECT value FROM iocs WHERE type = ?", [data_type]
+        if source_feed is not None:
+            query, params = "SELECT value FROM ioc_sources WHERE type = ? AND source_feed = ?", params + [source_feed]
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        for row in rows:
+            yield row[0]
+
+    def count(self, data_type=None):
+        """Number of indicators in the store, optionally of a single type."""
+        with self._lock:
+            if data_type is None:
+                return self._conn.execute("SELECT COUNT(*) FROM iocs").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM iocs WHERE type = ?", (data_type,)).fetchone()[0]
+
+    # Synchronization state (e.g. MISP watermarks)
+    def get_state(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, key, state):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO sync_state (key, state) VALUES (?, ?)", (key, json.dumps(state)))
+
+    def _get_networks(self, data_type):
+        """The stored networks of an IP data type, as a PrefixMap of network -> stored value."""
+        with self._lock:
+            cached = self._networks.get(data_type)
+            if cached is not None and cached[0] == self._generation:
+                return cached[1]
+            rows = self._conn.execute("SELECT value FROM iocs WHERE type = ? AND value LIKE '%/%'", (data_type,)).fetchall()
+            networks = PrefixMap()
+            for (value,) in rows:
+                try:
+                    networks.add(value, value)
+                except (ValueError, TypeError):
+                    continue
+            self._networks[data_type] = (self._generation, networks)
+            return networks
+
+    def _covering_network(self, data_type, value):
+        """The stored network covering an address, or None (always None for other data types)."""
+        if data_type not in IP_DATA_TYPES:
+            return None
+        return self._get_networks(data_type).longest_match(value)
+
+    def close(self):
+        with self._stores_lock:
+            if self._stores.get(self.db_path) is self:
+                del self._stores[self.db_path]
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _row_to_dict(row):
+        data_type, value, first_seen, last_seen, source_feed, tags = row
+        return {
+            'type': data_type,
+            'value': value,
+            'first_seen': first_seen,
+            'last_seen': last_seen,
+            'source_feed': source_feed,
+            'tags': json.loads(tags) if tags else [],
+        }
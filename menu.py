@@ -9,6 +9,8 @@ class Menu:
         self.current_menu = self.main_menu
         self.menu_stack = []
         self._config_mgr = ConfigurationManager()
+        self._config_mgr.start_integrations() # Initialize the integrations in the background
+        self._config_mgr.start_playbook_triggers() # Launch event driven playbooks as their events happen
         self._playbook_mgr = self._config_mgr.playbook_mgr
         self.current_option = 0 # The currently selected menu option
         self.current_header = self.welcome_header
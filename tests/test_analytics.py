@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from analytics import SlidingWindowCounter, SlidingWindowDistinct, FirewallLogAnalytics
+
+START = datetime(2024, 11, 7, 5, 0, 0)
+
+def make_entry(second, src_ip, dest_port, action='block'):
+    """Build the fields of a FirewallLogEntry used by the aggregates."""
+    return SimpleNamespace(timestamp=START + timedelta(seconds=second), src_ip=src_ip, dest_ip='192.0.2.10',
+                           dest_port=dest_port, action=action)
+
+class TestSlidingWindows(unittest.TestCase):
+
+    def test_counts_expire_with_the_window(self):
+        # Test that counts only cover the buckets in the window, including late events
+        counter = SlidingWindowCounter(window=60, bucket=10)
+        self.assertEqual(counter.add('a', 0), 1)
+        self.assertEqual(counter.add('a', 35), 2)
+        counter.add('b', 40)
+        self.assertEqual(counter.add('a', 5), 3)  # Late, but its bucket is still in the window
+        self.assertEqual(counter.top(1), [('a', 3)])
+        counter.add('b', 75)
+        self.assertEqual((counter.get('a'), counter.get('b'), counter.total), (1, 2, 3))
+        self.assertEqual(counter.add('a', 1), 1)  # Older than the window, not counted
+        counter.advance(200)
+        self.assertEqual((len(counter), counter.total), (0, 0))
+
+    def test_distinct_values(self):
+        # Test that repeated values are counted once, and values seen in several buckets expire with the last one
+        distinct = SlidingWindowDistinct(window=60, bucket=10)
+        for second, port in [(0, 22), (1, 22), (2, 80), (30, 22)]:
+            distinct.add('203.0.113.5', port, second)
+        self.assertEqual(distinct.get('203.0.113.5'), 2)
+        distinct.advance(75)
+        self.assertEqual(distinct.get('203.0.113.5'), 1)
+        self.assertEqual(distinct.over(1), {'203.0.113.5': 1})
+        distinct.advance(100)
+        self.assertEqual(len(distinct), 0)
+
+class TestFirewallLogAnalytics(unittest.TestCase):
+
+    def test_default_aggregates(self):
+        # Test the top blocked sources and ports and the distinct ports of each source
+        analytics = FirewallLogAnalytics(window=300)
+        entries = [make_entry(i, '203.0.113.5', str(1000 + i)) for i in range(20)]
+        entries += [make_entry(i, '198.51.100.9', '22') for i in range(5)]
+        entries += [make_entry(i, '192.0.2.50', '443', action='pass') for i in range(30)]
+        analytics.observe_many(entries)
+        self.assertEqual(analytics.top('blocked_sources', 2), [('203.0.113.5', 20), ('198.51.100.9', 5)])
+        self.assertEqual(analytics.top('blocked_ports', 1), [('22', 5)])
+        self.assertEqual(analytics.over('source_ports', 10), {'203.0.113.5': 20})
+        analytics.advance(entries[0].timestamp.timestamp() + 1000)
+        self.assertEqual(analytics.top('blocked_sources'), [])
+
+    def test_thresholds_fire_once_per_crossing(self):
+        # Test that a threshold callback runs when a key reaches it, and again after it expired and came back
+        analytics = FirewallLogAnalytics(window=60)
+        analytics.add_aggregate('ssh_blocks', 'src_ip', where={'action': 'block', 'dest_port': '22'})
+        fired = []
+        analytics.add_threshold('ssh_blocks', 3, lambda name, key, value, entry: fired.append((key, value, entry.timestamp)))
+        analytics.observe_many(make_entry(i, '203.0.113.5', '22') for i in range(5))
+        self.assertEqual([(key, value) for key, value, _ in fired], [('203.0.113.5', 3)])
+        analytics.observe_many(make_entry(300 + i, '203.0.113.5', '22') for i in range(3))
+        self.assertEqual(len(fired), 2)
+        with self.assertRaises(KeyError):
+            analytics.add_threshold('missing', 1, print)
+
+if __name__ == '__main__':
+    unittest.main()
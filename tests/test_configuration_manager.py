@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
 import unittest
+import os
+import tempfile
+import threading
+import time as clock
+import yaml
 from unittest.mock import patch, MagicMock
-from classes import ConfigurationManager, Log
+from classes import ConfigurationManager, Integration, IntegrationManager, PersistenceManager, Log
 
 class TestConfigurationManager(unittest.TestCase):
 
@@ -52,7 +57,100 @@ class TestConfigurationManager(unittest.TestCase):
         self.config_manager._remove_integration('test_integration')
         self.assertNotIn('test_integration', self.config_manager.enabled_integrations)
 
+    def test_wait_for_integration_does_not_block_on_slow_integrations(self):
+        # Test that a slow MISP initialization does not delay a pfSense-only consumer
+        misp_release = threading.Event()
+        def fake_initialize(integration_name):
+            if integration_name == 'misp':
+                misp_release.wait(5)
+            return f"{integration_name}_obj"
+
+        with patch.object(self.config_manager.integration_mgr, 'initialize_integration', side_effect=fake_initialize):
+            self.config_manager.start_integrations(['misp', 'pfsense'])
+            self.assertEqual(self.config_manager.wait_for_integration('pfsense', timeout=1), 'pfsense_obj')
+            self.assertFalse(self.config_manager.is_integration_ready('misp'))
+            misp_release.set()
+            self.assertEqual(self.config_manager.wait_for_integration('misp', timeout=5), 'misp_obj')
+        self.config_manager.shutdown()
+
+    def test_wait_for_integrations_shares_one_timeout(self):
+        # Test that the timeout bounds the whole wait, rather than the wait for each integration
+        def fake_initialize(integration_name):
+            clock.sleep(0.3)
+            return f"{integration_name}_obj"
+
+        with patch.object(self.config_manager.integration_mgr, 'initialize_integration', side_effect=fake_initialize), \
+                patch.object(self.config_manager, 'wait_for_integration', wraps=self.config_manager.wait_for_integration) as wait:
+            self.assertEqual(self.config_manager.wait_for_integrations(['misp', 'pfsense'], timeout=5),
+                             {'misp': 'misp_obj', 'pfsense': 'pfsense_obj'})
+            timeouts = [call.args[1] for call in wait.call_args_list]
+            self.assertTrue(5 >= timeouts[0] > timeouts[1])
+        self.config_manager.shutdown()
+
+    def test_feeds_are_enabled_concurrently_with_progress(self):
+        # Test that feeds for every accepted data type are enabled in parallel and progress is reported
+        started = threading.Barrier(2, timeout=5)
+        def fake_ensure_feed_enabled(data_type, wait_for_cache, progress):
+            started.wait()  # Both data types must be in flight at the same time
+            progress(data_type, 'caching')
+        misp = MagicMock()
+        misp.ensure_feed_enabled.side_effect = fake_ensure_feed_enabled
+        integration = MagicMock()
+        integration.accepts = ['ip-dst', 'domain', 'ip-dst']
+        progress = MagicMock()
+
+        results = self.config_manager.integration_mgr._enable_feeds_for_integration(misp, integration, progress)
+        self.assertEqual(set(results), {'ip-dst', 'domain'})
+        self.assertEqual(misp.ensure_feed_enabled.call_count, 2)
+        statuses = [call.args for call in progress.call_args_list]
+        self.assertEqual(sum(status[1] == 'caching' for status in statuses), 2)
+        self.assertEqual(statuses[-1][1:], ('done', 2, 2))
+
+    def test_feed_errors_are_reported_as_failed(self):
+        # Test that a feed that can't be enabled is reported as failed instead of done
+        def fake_ensure_feed_enabled(data_type, wait_for_cache, progress):
+            if data_type == 'ip-dst':
+                raise Exception('Error enabling feed firehol_level1: feed not found in MISP')
+        misp = MagicMock()
+        misp.ensure_feed_enabled.side_effect = fake_ensure_feed_enabled
+        integration = MagicMock()
+        integration.accepts = ['ip-dst', 'domain']
+        progress = MagicMock()
+
+        results = self.config_manager.integration_mgr._enable_feeds_for_integration(misp, integration, progress)
+        self.assertIsInstance(results['ip-dst'], Exception)
+        self.assertIsNone(results['domain'])
+        self.assertEqual(sorted(call.args[:2] for call in progress.call_args_list), [('domain', 'done'), ('ip-dst', 'failed')])
+
     # Add more tests for different scenarios and methods...
 
+class TestIntegrationManager(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('classes.Log')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = patch.object(Integration, 'CONFIG_PATH', self.tmp_dir.name)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_save_keeps_integration_specific_settings(self):
+        # Test that saving an integration round-trips the settings that _pack_data doesn't know about
+        path = os.path.join(self.tmp_dir.name, 'pfsense.yaml')
+        settings = {'enabled': True, 'url': 'https://pfsense.example', 'api_key': 'key', 'ssl': False, 'verifycert': False,
+                    'accepts': ['ip-dst'], 'returns': ['ip-dst'], 'playbook_functions': ['block_addresses'],
+                    'block_ttl': 3600, 'apply_delay': 5.0, 'log_retention': None, 'syslog_listener': True}
+        with open(path, 'w') as f:
+            yaml.safe_dump({'pfsense': settings}, f)
+        integration = Integration('pfsense')
+        integration._url = 'https://firewall.example'
+        IntegrationManager().save(integration)
+        PersistenceManager.get_instance().flush(path)
+        with open(path) as f:
+            saved = yaml.safe_load(f)['pfsense']
+        self.assertEqual(saved, dict(settings, url='https://firewall.example'))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import unittest
+import ipaddress
+from indicators import IPSet, PrefixMap, DigestSet, BloomFilter, PrefilteredSet, indicator_set, aggregate_networks, normalize_indicator, normalize_indicators
+
+class TestIPSet(unittest.TestCase):
+
+    def test_membership_with_networks_and_hosts(self):
+        # Test IPv4 and IPv6 membership for hosts inside stored networks
+        ip_set = IPSet(['192.0.2.0/24', '198.51.100.7', '2001:db8::/32'])
+        self.assertIn('192.0.2.55', ip_set)
+        self.assertIn('198.51.100.7', ip_set)
+        self.assertIn('2001:db8::1', ip_set)
+        self.assertIn('192.0.2.128/25', ip_set)
+        self.assertNotIn('198.51.100.8', ip_set)
+        self.assertNotIn('2001:db9::1', ip_set)
+        self.assertNotIn('not-an-ip', ip_set)
+
+    def test_adjacent_ranges_are_merged(self):
+        # Test that adjacent and overlapping entries are stored as a single range
+        ip_set = IPSet(['10.0.0.0/24', '10.0.1.0/24', '10.0.0.5'])
+        self.assertEqual(len(ip_set), 1)
+        self.assertEqual(list(ip_set), [ipaddress.ip_network('10.0.0.0/23')])
+        self.assertEqual(ip_set.num_addresses, 512)
+
+    def test_difference_update_splits_ranges(self):
+        # Test that removing part of a network keeps the rest of it
+        ip_set = IPSet(['10.0.0.0/24'])
+        ip_set.discard('10.0.0.128/25')
+        self.assertIn('10.0.0.5', ip_set)
+        self.assertNotIn('10.0.0.200', ip_set)
+        self.assertEqual(list(ip_set), [ipaddress.ip_network('10.0.0.0/25')])
+
+    def test_aggregate_networks(self):
+        # Test that adjacent IPv4 and IPv6 networks are collapsed and the reduction is reported
+        values = ['10.0.0.0/25', '10.0.0.128/25', '10.0.0.7', '192.0.2.1', '2001:db8::/33', '2001:db8:8000::/33', 'bogus']
+        networks, stats = aggregate_networks(values)
+        self.assertEqual(networks, ['10.0.0.0/24', '192.0.2.1', '2001:db8::/32'])
+        self.assertEqual(stats, {'input': 6, 'invalid': 1, 'output': 3, 'reduction': 50.0})
+
+    def test_prefix_map_longest_match(self):
+        # Test that the most specific network wins, and removed networks fall back to the next one
+        prefixes = PrefixMap([('10.0.0.0/8', 'wide'), ('10.1.0.0/16', 'narrow'), ('10.1.2.3', 'host'), ('2001:db8::/32', 'v6')])
+        self.assertEqual(prefixes.longest_match('10.1.2.3'), 'host')
+        self.assertEqual(prefixes.longest_match('10.1.9.9'), 'narrow')
+        self.assertEqual(prefixes.longest_match('10.9.0.0/16'), 'wide')
+        self.assertEqual(prefixes.match_all('10.1.2.3'), ['host', 'narrow', 'wide'])
+        self.assertEqual(prefixes.longest_match('2001:db8::5'), 'v6')
+        self.assertIsNone(prefixes.longest_match('not-an-ip'))
+        prefixes.discard('10.1.0.0/16', 'narrow')
+        self.assertEqual(prefixes.longest_match('10.1.9.9'), 'wide')
+        self.assertEqual(len(prefixes), 3)
+
+class TestDigestSet(unittest.TestCase):
+
+    def test_membership_is_case_insensitive(self):
+        # Test that hashes of different lengths are stored and matched as binary digests
+        digests = DigestSet(['D41D8CD98F00B204E9800998ECF8427E',
+                             'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'])
+        self.assertIn('d41d8cd98f00b204e9800998ecf8427e', digests)
+        self.assertIn(' E3B0C44298FC1C149AFBF4C8996FB92427AE41E4649B934CA495991B7852B855 ', digests)
+        self.assertNotIn('ff' * 16, digests)
+        self.assertNotIn('not-a-hash', digests)
+        self.assertEqual(len(digests), 2)
+        self.assertEqual(digests.nbytes, 48)
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        # Test that every added item is found and the false positive rate is close to the target
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        bloom.update(f"domain{i}.example" for i in range(1000))
+        self.assertTrue(all(f"domain{i}.example" in bloom for i in range(1000)))
+        false_positives = sum(f"other{i}.example" in bloom for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+    def test_indicator_set_factory(self):
+        # Test that the factory picks the container for the data type and skips invalid values
+        self.assertIsInstance(indicator_set('ip-dst', ['192.0.2.1', 'bogus']), IPSet)
+        hashes = indicator_set('md5', ['D41D8CD98F00B204E9800998ECF8427E', 'bogus'], prefilter=True)
+        self.assertIsInstance(hashes, PrefilteredSet)
+        self.assertIn('d41d8cd98f00b204e9800998ecf8427e', hashes)
+        self.assertEqual(len(hashes), 1)
+        domains = indicator_set('domain', ['evil.example'])
+        self.assertEqual(domains, {'evil.example'})
+
+class TestNormalization(unittest.TestCase):
+
+    def test_values_are_canonicalized(self):
+        # Test the canonical form of each data type and that invalid values are rejected
+        self.assertEqual(normalize_indicator('ip-dst', ' 192.0.2.1/32 '), '192.0.2.1')
+        self.assertEqual(normalize_indicator('ip-dst', '192.0.2.7/24'), '192.0.2.0/24')
+        self.assertEqual(normalize_indicator('ip-src', '2001:DB8:0::1'), '2001:db8::1')
+        self.assertEqual(normalize_indicator('domain', 'Evil.Example.'), 'evil.example')
+        self.assertEqual(normalize_indicator('url', 'HTTP://Evil.Example/Path?Q=1#top'), 'http://evil.example/Path?Q=1')
+        self.assertEqual(normalize_indicator('md5', 'D41D8CD98F00B204E9800998ECF8427E'), 'd41d8cd98f00b204e9800998ecf8427e')
+        self.assertEqual(normalize_indicator('email', 'Bob@Evil.Example'), 'Bob@evil.example')
+        for data_type, value in [('ip-dst', 'bogus'), ('md5', 'abc'), ('url', 'evil.example'), ('domain', ' ')]:
+            with self.assertRaises(ValueError):
+                normalize_indicator(data_type, value)
+
+    def test_duplicates_and_covered_hosts_are_dropped(self):
+        # Test that duplicates, invalid values and hosts inside a listed network are removed, keeping the order
+        values = ['198.51.100.9', '10.0.0.5', '10.0.0.0/24', ' 198.51.100.9', '10.0.0.0/25', 'bogus', '2001:db8::1']
+        self.assertEqual(normalize_indicators('ip-dst', values), ['198.51.100.9', '10.0.0.0/24', '2001:db8::1'])
+        self.assertEqual(normalize_indicators('domain', ['Evil.example', 'evil.example.', 'good.example']),
+                         ['evil.example', 'good.example'])
+
+if __name__ == '__main__':
+    unittest.main()
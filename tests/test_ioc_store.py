@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import tempfile
+from unittest.mock import patch
+from ioc_store import IocStore
+
+class TestIocStore(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('ioc_store.Log')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = IocStore(os.path.join(self.tmp_dir.name, 'data', 'iocs.db'))
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_add_and_lookup(self):
+        # Test that indicators keep their first seen time and feed across updates
+        self.store.add('ip-dst', ['192.0.2.1', '192.0.2.2'], source_feed='firehol_level1', tags=['tlp:white'], seen=100)
+        self.store.add('ip-dst', ['192.0.2.1'], seen=200)
+        ioc = self.store.lookup('ip-dst', '192.0.2.1')
+        self.assertEqual((ioc['first_seen'], ioc['last_seen']), (100, 200))
+        self.assertEqual(ioc['source_feed'], 'firehol_level1')
+        self.assertEqual(ioc['tags'], ['tlp:white'])
+        self.assertTrue(self.store.contains('ip-dst', '192.0.2.2'))
+        self.assertFalse(self.store.contains('domain', '192.0.2.2'))
+        self.assertIsNone(self.store.lookup('ip-dst', '198.51.100.1'))
+
+    def test_bulk_membership(self):
+        # Test bulk membership queries larger than a single SQL statement
+        known = [f"10.0.{i // 256}.{i % 256}" for i in range(1200)]
+        self.store.add('ip-dst', known)
+        candidates = ['198.51.100.1', known[0], known[-1], '198.51.100.2']
+        self.assertEqual(self.store.contains_many('ip-dst', known), set(known))
+        self.assertEqual(self.store.filter_known('ip-dst', candidates), [known[0], known[-1]])
+        self.assertEqual(self.store.filter_unknown('ip-dst', candidates), ['198.51.100.1', '198.51.100.2'])
+
+    def test_addresses_inside_stored_networks_are_known(self):
+        # Test that IP lookups match the stored networks covering an address, not only exact values
+        self.store.add('ip-dst', ['198.51.100.0/24', '192.0.2.7'], source_feed='firehol_level1', seen=100)
+        candidates = ['198.51.100.42', '192.0.2.7', '192.0.2.8', 'not an ip']
+        self.assertEqual(self.store.filter_known('ip-dst', candidates), ['198.51.100.42', '192.0.2.7'])
+        self.assertTrue(self.store.contains('ip-dst', '198.51.100.1'))
+        self.assertFalse(self.store.contains('ip-src', '198.51.100.1'))
+        self.assertEqual(self.store.lookup('ip-dst', '198.51.100.42')['value'], '198.51.100.0/24')
+        self.store.remove('ip-dst', ['198.51.100.0/24'])
+        self.assertEqual(self.store.filter_unknown('ip-dst', candidates), ['198.51.100.42', '192.0.2.8', 'not an ip'])
+
+    def test_indicators_are_kept_while_a_feed_provides_them(self):
+        # Test that a feed dropping a value only removes the indicator once no other feed provides it
+        self.store.add('ip-dst', ['192.0.2.1', '192.0.2.2'], source_feed='firehol_level1')
+        self.store.add('ip-dst', ['192.0.2.1'], source_feed='malsilo.ipv4')
+        self.assertEqual(self.store.remove('ip-dst', ['192.0.2.1', '192.0.2.2'], source_feed='firehol_level1'), 1)
+        ioc = self.store.lookup('ip-dst', '192.0.2.1')
+        self.assertEqual((ioc['source_feed'], ioc['source_feeds']), ('malsilo.ipv4', ['malsilo.ipv4']))
+        self.assertFalse(self.store.contains('ip-dst', '192.0.2.2'))
+        self.assertEqual(list(self.store.values('ip-dst', source_feed='firehol_level1')), [])
+        self.assertEqual(self.store.remove('ip-dst', ['192.0.2.1'], source_feed='malsilo.ipv4'), 1)
+        self.assertEqual(self.store.count(), 0)
+
+    def test_remove_expire_and_state(self):
+        # Test removing and expiring indicators, and storing sync state
+        self.store.add('domain', ['old.example', 'new.example', 'gone.example'], seen=100)
+        self.store.add('domain', ['new.example'], seen=300)
+        self.assertEqual(self.store.remove('domain', ['gone.example']), 1)
+        self.assertEqual(self.store.expire(older_than=200), 1)
+        self.assertEqual(list(self.store.values('domain')), ['new.example'])
+        self.store.set_state('misp_watermarks', {'1:domain': {'timestamp': 300, 'uuids': []}})
+        self.assertEqual(self.store.get_state('misp_watermarks')['1:domain']['timestamp'], 300)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import tempfile
+from unittest.mock import patch, MagicMock
+from ioc_store import IocStore
+from integrations.misp_functions import MispFunction, MispReporter
+
+FEEDS = [
+    {'Feed': {'id': '1', 'name': 'firehol_level1', 'enabled': True}},
+    {'Feed': {'id': '2', 'name': 'malsilo.ipv4', 'enabled': False}},
+    {'Feed': {'id': '3', 'name': 'malsilo.domain', 'enabled': False}},
+]
+
+class TestMispFunction(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('integrations.misp_functions.PyMISP')
+        patcher2 = patch('integrations.misp_functions.Log')
+        self.addCleanup(patcher1.stop)
+        self.addCleanup(patcher2.stop)
+        self.mock_api = patcher1.start().return_value
+        patcher2.start()
+        self.mock_api.feeds.side_effect = lambda: [{'Feed': dict(feed['Feed'])} for feed in FEEDS]
+
+        self.misp_init = MagicMock()
+        self.misp_init.name = 'misp'
+        self.misp_init.params = {'misp': {'feed_cache_ttl': 300}}
+        self.misp = MispFunction(self.misp_init)
+
+    def test_feed_catalogue_is_cached(self):
+        # Test that repeated lookups reuse the cached catalogue and never load the default feeds
+        self.assertTrue(self.misp.check_enabled_by_name('firehol_level1'))
+        self.assertFalse(self.misp.check_enabled_by_name('malsilo.ipv4'))
+        self.assertEqual(self.misp._get_misp_feed_by_id('3')['name'], 'malsilo.domain')
+        self.assertEqual(self.mock_api.feeds.call_count, 1)
+        self.mock_api.load_default_feeds.assert_not_called()
+
+    def test_enabling_a_feed_invalidates_the_cache(self):
+        # Test that the process's own feed changes are visible on the next lookup
+        self.misp.enable_threat_feed('2')
+        self.misp.check_enabled_by_name('malsilo.ipv4')
+        self.assertEqual(self.mock_api.feeds.call_count, 2)
+
+    def test_expired_cache_is_refreshed(self):
+        # Test that the catalogue is downloaded again once the TTL has passed
+        self.misp_init.params = {'misp': {'feed_cache_ttl': 0}}
+        misp = MispFunction(self.misp_init)
+        misp.check_enabled_by_name('firehol_level1')
+        misp.check_enabled_by_name('firehol_level1')
+        self.assertEqual(self.mock_api.feeds.call_count, 4)
+
+    def test_feed_indexes(self):
+        # Test the name, id and data type lookup tables built from the catalogue
+        self.assertEqual(self.misp._get_misp_feed_by_name('malsilo.ipv4')['id'], '2')
+        self.assertEqual(self.misp._get_misp_feed_by_id(3)['name'], 'malsilo.domain')
+        self.assertEqual(self.misp._get_misp_feed_by_name('missing_feed'), {})
+        self.assertEqual([feed['name'] for feed in self.misp.get_feeds_by_data_type('ip-dst')], ['firehol_level1', 'malsilo.ipv4'])
+        self.assertEqual(self.misp.enabled_feeds['firehol_level1']['data_types'], 'ip-dst')
+
+    def test_streamed_event_data_is_filtered_and_paged_by_misp(self):
+        # Test that attribute values are fetched page by page with the filters sent to MISP
+        pages = [
+            {'Attribute': [{'type': 'ip-dst', 'value': '192.0.2.1'}, {'type': 'ip-dst', 'value': '192.0.2.2'}]},
+            {'Attribute': [{'type': 'ip-dst', 'value': '192.0.2.3'}]},
+        ]
+        self.mock_api.get_feed.return_value = {'Feed': {'event_id': '42'}}
+        self.mock_api.search.side_effect = pages
+        self.misp.ATTRIBUTE_PAGE_SIZE = 2
+        values = self.misp.get_event_data_by_type('ip-dst', feed_id='1', stream=True, to_ids=True)
+        self.mock_api.search.assert_not_called()  # Nothing is fetched until the values are consumed
+        self.assertEqual(list(values), ['192.0.2.1', '192.0.2.2', '192.0.2.3'])
+        self.mock_api.get_event.assert_not_called()
+        self.assertEqual(self.mock_api.search.call_count, 2)
+        kwargs = self.mock_api.search.call_args.kwargs
+        self.assertEqual((kwargs['type_attribute'], kwargs['eventid'], kwargs['to_ids']), ('ip-dst', '42', True))
+        self.assertEqual(kwargs['page'], 2)
+
+    def test_streamed_event_data_is_normalized(self):
+        # Test that streamed values are canonicalized and deduplicated unless normalization is turned off
+        self.mock_api.get_feed.return_value = {'Feed': {'event_id': '42'}}
+        page = {'Attribute': [{'value': 'Evil.Example'}, {'value': 'evil.example.'}, {'value': 'good.example'}]}
+        self.mock_api.search.side_effect = [page, page]
+        self.assertEqual(list(self.misp.get_event_data_by_type('domain', feed_id='1', stream=True)), ['evil.example', 'good.example'])
+        self.assertEqual(len(list(self.misp.get_event_data_by_type('domain', feed_id='1', stream=True, normalize=False))), 3)
+
+    def test_sync_only_fetches_changes_since_the_watermark(self):
+        # Test that the second sync asks MISP for changes since the watermark and reports removals
+        self.mock_api.get_feed.return_value = {'Feed': {'event_id': '42'}}
+        self.mock_api.search.side_effect = [
+            {'Attribute': [
+                {'uuid': 'a', 'value': '192.0.2.1', 'timestamp': '100', 'to_ids': True},
+                {'uuid': 'b', 'value': '192.0.2.2', 'timestamp': '200', 'to_ids': True},
+            ]},
+            {'Attribute': [
+                {'uuid': 'b', 'value': '192.0.2.2', 'timestamp': '200', 'to_ids': True},
+                {'uuid': 'c', 'value': '192.0.2.3', 'timestamp': '300', 'to_ids': True},
+                {'uuid': 'a', 'value': '192.0.2.1', 'timestamp': '300', 'to_ids': True, 'deleted': True},
+            ]},
+            {'Attribute': []},  # No other attribute provides the deleted value
+        ]
+        self.assertEqual(self.misp.sync_event_data_by_type('ip-dst', feed_id='1'), (['192.0.2.1', '192.0.2.2'], []))
+        self.assertIsNone(self.mock_api.search.call_args.kwargs['timestamp'])
+        self.assertEqual(self.misp.sync_event_data_by_type('ip-dst', feed_id='1'), (['192.0.2.3'], ['192.0.2.1']))
+        self.assertEqual(self.mock_api.search.call_args_list[1].kwargs['timestamp'], 200)
+        self.assertEqual(self.misp.watermarks, {'1:ip-dst': {'timestamp': 300, 'uuids': ['a', 'c']}})
+
+    def test_sync_keeps_values_provided_by_unchanged_attributes(self):
+        # Test that deleting one of two attributes with the same value doesn't report the value as removed
+        self.mock_api.get_feed.return_value = {'Feed': {'event_id': '42'}}
+        self.mock_api.search.side_effect = [
+            {'Attribute': [
+                {'uuid': 'a', 'value': '192.0.2.1', 'timestamp': '100', 'to_ids': True},
+                {'uuid': 'b', 'value': '192.0.2.1', 'timestamp': '100', 'to_ids': True},
+                {'uuid': 'c', 'value': '192.0.2.2', 'timestamp': '100', 'to_ids': True},
+            ]},
+            {'Attribute': [
+                {'uuid': 'a', 'value': '192.0.2.1', 'timestamp': '200', 'to_ids': True, 'deleted': True},
+                {'uuid': 'c', 'value': '192.0.2.2', 'timestamp': '200', 'to_ids': False},
+            ]},
+            {'Attribute': [{'uuid': 'b', 'value': '192.0.2.1', 'timestamp': '100', 'to_ids': True}]},
+        ]
+        self.misp.sync_event_data_by_type('ip-dst', feed_id='1', to_ids=True)
+        self.assertEqual(self.misp.sync_event_data_by_type('ip-dst', feed_id='1', to_ids=True), ([], ['192.0.2.2']))
+        kwargs = self.mock_api.search.call_args.kwargs
+        self.assertEqual((kwargs['value'], kwargs['to_ids']), (['192.0.2.1', '192.0.2.2'], True))
+
+    @patch('integrations.misp_functions.time.sleep')
+    def test_wait_for_feed_cache_polls_until_cached(self, mock_sleep):
+        # Test that ensure_feed_enabled can wait for the caching job by polling the cache timestamp
+        self.mock_api.get_feed.side_effect = [
+            {'Feed': {'cache_timestamp': False}},
+            {'Feed': {'cache_timestamp': False}},
+            {'Feed': {'cache_timestamp': '1700000000'}},
+        ]
+        progress = MagicMock()
+        self.misp.FEEDS_BY_DATA_TYPE = {'domain': ['malsilo.domain']}
+        self.misp.ensure_feed_enabled('domain', wait_for_cache=True, progress=progress)
+        self.mock_api.cache_feed.assert_called_once_with('3')
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertEqual([call.args[1] for call in progress.call_args_list], ['enabling', 'caching', 'cached'])
+
+    def test_feeds_that_cannot_be_enabled_raise(self):
+        # Test that a missing feed or a failed enable is an error rather than a returned message
+        self.misp.FEEDS_BY_DATA_TYPE = {'domain': ['malsilo.domain'], 'url': ['missing_feed']}
+        with self.assertRaises(Exception):
+            self.misp.ensure_feed_enabled('url')
+        self.mock_api.enable_feed.side_effect = Exception('MISP unavailable')
+        with self.assertRaises(Exception):
+            self.misp.ensure_feed_enabled('domain')
+
+    def test_enabled_feeds_do_not_modify_the_cache(self):
+        # Test that get_enabled_feeds copies the feed metadata instead of editing the cached catalogue
+        self.assertEqual(self.misp.enabled_feeds['firehol_level1']['feed_id'], '1')
+        self.assertEqual(self.misp._get_misp_feed_by_name('firehol_level1')['id'], '1')
+
+    @patch('ioc_store.Log')
+    def test_sync_iocs_fills_the_local_store(self, mock_log):
+        # Test that the enabled feeds of a data type are synchronized into the store that lookups read from
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.misp.ioc_store_path = os.path.join(tmp_dir.name, 'iocs.db')
+        self.addCleanup(self.misp.ioc_store.close)
+        self.mock_api.get_feed.return_value = {'Feed': {'event_id': '42'}}
+        self.mock_api.search.return_value = {'Attribute': [
+            {'uuid': 'a', 'value': '192.0.2.1', 'timestamp': '100', 'to_ids': True},
+            {'uuid': 'b', 'value': '192.0.2.2', 'timestamp': '200', 'to_ids': True},
+        ]}
+        self.assertEqual(self.misp.sync_iocs(['ip-dst', 'domain']), {'ip-dst': [2, 0]})
+        self.assertIs(self.misp.ioc_store, IocStore.for_path(self.misp.ioc_store_path))
+        self.assertEqual(self.misp.lookup_iocs('ip-dst', ['198.51.100.1', '192.0.2.2', '192.0.2.1']), ['192.0.2.2', '192.0.2.1'])
+        self.assertEqual(self.misp.lookup_ioc('ip-dst', '192.0.2.1')['source_feed'], 'firehol_level1')
+        self.assertEqual(self.misp.ioc_store.get_state('misp_watermarks')['1:ip-dst']['timestamp'], 200)
+
+    @patch('ioc_store.Log')
+    def test_synced_values_are_normalized(self, mock_log):
+        # Test that variants of a value are stored once in canonical form and removed once none of them is provided
+        store = IocStore(':memory:')
+        self.addCleanup(store.close)
+        self.mock_api.get_feed.return_value = {'Feed': {'event_id': '42'}}
+        self.mock_api.search.side_effect = [
+            {'Attribute': [
+                {'uuid': 'a', 'value': '192.0.2.1/32', 'timestamp': '100', 'to_ids': True},
+                {'uuid': 'b', 'value': ' 192.0.2.1', 'timestamp': '100', 'to_ids': True},
+                {'uuid': 'c', 'value': '198.51.100.7/24', 'timestamp': '100', 'to_ids': True},
+                {'uuid': 'd', 'value': 'not an address', 'timestamp': '100', 'to_ids': True},
+            ]},
+            {'Attribute': [
+                {'uuid': 'a', 'value': '192.0.2.1/32', 'timestamp': '200', 'to_ids': True, 'deleted': True},
+                {'uuid': 'c', 'value': '198.51.100.7/24', 'timestamp': '200', 'to_ids': True, 'deleted': True},
+            ]},
+            {'Attribute': [{'uuid': 'b', 'value': ' 192.0.2.1', 'timestamp': '100', 'to_ids': True}]},
+        ]
+        self.assertEqual(self.misp.sync_to_store(store, 'ip-dst', feed_id='1'), (2, 0))
+        self.assertEqual(set(store.values('ip-dst')), {'192.0.2.1', '198.51.100.0/24'})
+        self.assertEqual(self.misp.sync_to_store(store, 'ip-dst', feed_id='1'), (0, 1))
+        self.assertEqual(self.mock_api.search.call_args.kwargs['value'], ['192.0.2.1', '192.0.2.1/32', '198.51.100.0/24', '198.51.100.7/24'])
+        self.assertEqual(set(store.values('ip-dst')), {'192.0.2.1'})
+
+class TestMispReporter(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('integrations.misp_functions.Log')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.mock_api = MagicMock()
+        self.mock_api.add_event.return_value.id = '7'
+        self.reporter = MispReporter(self.mock_api, max_batch_size=2, max_latency=60)
+
+    def test_attributes_are_sent_in_batches(self):
+        # Test that the first batch creates the event and later batches are added to it in one call
+        for value in ['192.0.2.1', '192.0.2.2', '192.0.2.3']:
+            self.reporter.add_attribute('ip-dst', value)
+        self.mock_api.add_event.assert_called_once()
+        self.mock_api.add_attribute.assert_not_called()
+        self.assertEqual(self.reporter.pending, 1)
+        self.reporter.flush()
+        event_id, batch = self.mock_api.add_attribute.call_args.args
+        self.assertEqual((event_id, len(batch)), ('7', 1))
+        self.assertEqual(self.reporter.pending, 0)
+
+    def test_sightings_are_grouped_by_source(self):
+        # Test that sightings from one source are sent together
+        self.reporter.max_batch_size = 10
+        for value in ['192.0.2.1', '192.0.2.2']:
+            self.reporter.add_sighting(value, source='pfsense')
+        self.reporter.flush()
+        self.mock_api.add_sighting.assert_called_once_with({'values': ['192.0.2.1', '192.0.2.2'], 'source': 'pfsense', 'type': 0})
+
+    def test_failed_batches_are_retried(self):
+        # Test that a failed flush keeps the items in the buffer
+        self.mock_api.add_event.side_effect = Exception('MISP unavailable')
+        self.reporter.add_attribute('ip-dst', '192.0.2.1')
+        self.reporter.flush()
+        self.assertEqual(self.reporter.pending, 1)
+
+    def test_failing_reports_back_off_and_are_bounded(self):
+        # Test that after a failure adds no longer flush, the retries back off and the oldest items are dropped
+        self.mock_api.add_event.side_effect = Exception('MISP unavailable')
+        self.reporter.max_buffer_size = 3
+        self.reporter.add_sighting('192.0.2.9')
+        for value in ['192.0.2.1', '192.0.2.2', '192.0.2.3', '192.0.2.4']:
+            self.reporter.add_attribute('ip-dst', value)
+        self.assertEqual(self.mock_api.add_event.call_count, 1)
+        self.assertEqual((self.reporter.pending, self.reporter.dropped), (3, 2))
+        self.assertEqual([attribute['value'] for attribute in self.reporter._attributes], ['192.0.2.2', '192.0.2.3', '192.0.2.4'])
+        self.assertEqual(self.reporter._debouncer.delay, 60)
+        self.reporter.flush()
+        self.assertEqual(self.reporter._debouncer.delay, 120)
+        self.mock_api.add_event.side_effect = None
+        self.reporter.flush()
+        self.assertEqual(self.reporter.pending, 0)
+        self.assertEqual(self.reporter._debouncer.delay, 60)
+
+if __name__ == '__main__':
+    unittest.main()
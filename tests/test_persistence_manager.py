@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import tempfile
+import time
+import yaml
+from unittest.mock import patch
+from classes import PersistenceManager
+
+class TestPersistenceManager(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'test.yaml')
+        self.persistence = PersistenceManager(delay=0.05, max_latency=1)
+
+    def tearDown(self):
+        self.persistence.flush()
+        self.tmp_dir.cleanup()
+
+    def test_rapid_saves_are_merged_into_one_write(self):
+        # Test that several saves to the same file result in a single write of the latest data
+        with patch('classes.os.replace', wraps=os.replace) as mock_replace:
+            for i in range(10):
+                self.persistence.save(self.path, {'Playbook': {'revision': i}})
+            self.persistence.flush()
+        self.assertEqual(mock_replace.call_count, 1)
+        with open(self.path) as f:
+            self.assertEqual(yaml.safe_load(f), {'Playbook': {'revision': 9}})
+
+    def test_saves_are_written_in_the_background(self):
+        # Test that queued saves reach the disk without an explicit flush
+        self.persistence.save(self.path, {'misp': {'enabled': True}})
+        deadline = time.monotonic() + 5
+        while not os.path.exists(self.path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(self.persistence.pending, [])
+
+    def test_unchanged_files_are_not_rewritten(self):
+        # Test that writing the same content twice only touches the disk once
+        self.assertTrue(self.persistence.write_now(self.path, {'pfsense': {'enabled': True}}))
+        self.assertFalse(self.persistence.write_now(self.path, {'pfsense': {'enabled': True}}))
+        # No temporary files are left behind
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['test.yaml'])
+
+    def test_queued_files_exist_and_are_listed(self):
+        # Test that a file whose write is still queued is reported as existing and is written before listing
+        self.persistence._debouncer.delay = 60  # Keep the write queued
+        self.persistence.save(self.path, {'Playbook': {'name': 'test'}})
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(self.persistence.exists(self.path))
+        self.assertFalse(self.persistence.exists(os.path.join(self.tmp_dir.name, 'other.yaml')))
+        self.persistence.flush_directory(self.tmp_dir.name)
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['test.yaml'])
+
+if __name__ == '__main__':
+    unittest.main()
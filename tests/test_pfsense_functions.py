@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+
+import unittest
+import requests
+from unittest.mock import patch, MagicMock
+import threading
+import tempfile
+import socket
+import time as clock
+from datetime import date, datetime, time
+from classes import PersistenceManager
+from analytics import FirewallLogAnalytics
+from integrations.pfsense_functions import PfsenseFunction, PfsenseLog, FirewallLogStore, ApplyCoordinator, BlockExpiryScheduler, FirewallRule, FirewallRuleIndex, SyslogListener, iter_firewall_logs, log_time_key, parse_syslog_timestamp, syslog_to_log_line
+
+def make_rule(tracker, address, descr='PySOAR', port=None, updated=1):
+    """Build a firewall rule as returned by the pfSense API."""
+    destination = {'port': port} if port else {'any': True}
+    return {
+        'id': tracker, 'tracker': tracker, 'type': 'block', 'interface': 'wan', 'descr': descr,
+        'source': {'address': address}, 'destination': destination,
+        'updated': {'time': updated, 'username': 'api'}, 'created': {'time': 1, 'username': 'api'},
+    }
+
+class TestPfsenseFunction(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('integrations.pfsense_functions.Log')
+        patcher2 = patch.dict(ApplyCoordinator._coordinators, clear=True)
+        self.addCleanup(patcher1.stop)
+        self.addCleanup(patcher2.stop)
+        patcher1.start()
+        patcher2.start()
+        pfsense_init = MagicMock(url='https://pfsense.example', api_key='key', ssl=False, verifycert=False)
+        pfsense_init.name = 'pfsense'
+        pfsense_init.params = {'pfsense': {'block_mode': 'rule'}}
+        self.pfsense_init = pfsense_init
+        self.pfsense = PfsenseFunction(pfsense_init)
+        self.rules = []
+        self.pfsense.get = MagicMock(side_effect=lambda endpoint: (200, 200, 0, 'Success', list(self.rules)))
+        self.pfsense.post = MagicMock(return_value=(200, 200, 0, 'Success', {'applied': True}))
+
+    def test_add_firewall_rule_aggregates_sources(self):
+        # Test that adjacent sources are collapsed into one rule before anything is sent to pfSense
+        def post(endpoint, data):
+            if endpoint == 'api/v1/firewall/rule':
+                self.rules.append(make_rule(len(self.rules) + 1, data['src'], data['descr']))
+            return (200, 200, 0, 'Success', {'applied': True})
+        self.pfsense.post.side_effect = post
+        self.pfsense.add_firewall_rule(src=['10.0.0.0/25', '10.0.0.128/25', '10.0.0.5', 'bogus'], descr='PySOAR')
+        rule_posts = [call for call in self.pfsense.post.call_args_list if call.args[0] == 'api/v1/firewall/rule']
+        self.assertEqual(len(rule_posts), 1)
+        self.assertEqual(rule_posts[0].kwargs['data']['src'], '10.0.0.0/24')
+        self.assertEqual(rule_posts[0].kwargs['data']['type'], 'block')
+        # The rules don't reload the filter themselves, a single apply is scheduled for all of them
+        self.assertFalse(rule_posts[0].kwargs['data']['apply'])
+        self.assertTrue(self.pfsense.apply_coordinator.pending)
+
+    def test_rule_cache_refresh_only_parses_changed_rules(self):
+        # Test that unchanged rules keep their cached objects and changed or removed rules are replaced
+        self.rules[:] = [make_rule(1, '10.0.0.1'), make_rule(2, '10.0.0.2'), make_rule(3, '10.0.0.3')]
+        first, second, third = self.pfsense.rules
+        self.rules[:] = [make_rule(1, '10.0.0.1'), make_rule(2, '10.0.0.9', updated=2), make_rule(4, '10.0.0.4')]
+        self.pfsense.update_firewall_rule_cache()
+        self.assertIs(self.pfsense.rules[0], first)
+        self.assertIsNot(self.pfsense.rules[1], second)
+        self.assertIs(self.pfsense.get_firewall_rule_by_ip('10.0.0.9'), self.pfsense.rules[1])
+        self.assertIsNone(self.pfsense.get_firewall_rule_by_ip('10.0.0.2'))
+        self.assertIsNone(self.pfsense.get_firewall_rule_by_tracker(3))
+        self.assertEqual(self.pfsense.get_firewall_rule_by_tracker(4).source_address, '10.0.0.4')
+
+    def test_mutations_update_the_cache_without_a_refresh(self):
+        # Test that created and deleted rules are applied to the cache from the API responses
+        self.rules[:] = [make_rule(1, '10.0.0.1', descr='existing')]
+        self.pfsense.post.side_effect = lambda endpoint, data: (200, 200, 0, 'Success', make_rule(7, data['src'], data['descr']))
+        self.pfsense.delete = MagicMock(return_value=(200, 200, 0, 'Success', {}))
+        self.pfsense.add_firewall_rule(src='192.0.2.1', descr='new rule')
+        self.assertEqual(self.pfsense.get_firewall_rule_by_ip('192.0.2.1').tracker, 7)
+        self.assertTrue(self.pfsense.delete_firewall_rule(7))
+        self.assertIsNone(self.pfsense.get_firewall_rule_by_ip('192.0.2.1'))
+        self.assertEqual(self.pfsense.get.call_count, 1)  # Only the initial load
+
+    def test_reconcile_rules(self):
+        # Test that rule mode only deletes and creates the rules that differ, with one apply
+        self.rules[:] = [make_rule(1, '10.0.0.1', descr='PySOAR Block'), make_rule(2, '10.0.0.2', descr='PySOAR Block'),
+                         make_rule(3, '10.0.0.3', descr='other')]
+        self.pfsense.delete = MagicMock(return_value=(200, 200, 0, 'Success', {}))
+        self.pfsense.post.side_effect = lambda endpoint, data: (200, 200, 0, 'Success', make_rule(9, data['src'], data['descr']) if endpoint.endswith('rule') else {'applied': True})
+        report = self.pfsense.reconcile_blocklist(['10.0.0.1', '10.0.0.4'])
+        self.assertEqual((report['add'], report['remove'], report['api_calls']), (['10.0.0.4'], ['10.0.0.2'], 3))
+        self.pfsense.delete.assert_called_once_with('api/v1/firewall/rule', data={'tracker': 2, 'apply': False})
+        self.assertEqual([call.args[0] for call in self.pfsense.post.call_args_list], ['api/v1/firewall/rule', 'api/v1/firewall/apply'])
+        self.assertEqual(self.pfsense.get_firewall_rule_by_ip('10.0.0.4').tracker, 9)
+
+    def test_applies_are_coalesced(self):
+        # Test that changes from several instances of the same pfSense are applied together
+        other = PfsenseFunction(self.pfsense_init)
+        other.post = self.pfsense.post
+        self.assertIs(other.apply_coordinator, self.pfsense.apply_coordinator)
+        for pfsense in (self.pfsense, other, self.pfsense):
+            pfsense.apply_changes()
+        self.assertTrue(self.pfsense.apply_coordinator.pending)
+        self.pfsense.flush_changes()
+        self.assertFalse(self.pfsense.apply_coordinator.pending)
+        self.pfsense.post.assert_called_once_with('api/v1/firewall/apply', data={'async': True})
+        self.assertTrue(self.pfsense.flush_changes())  # Nothing left to apply
+        self.assertEqual(self.pfsense.post.call_count, 1)
+
+    def test_failed_apply_is_retried(self):
+        # Test that an apply rejected by pfSense stays pending instead of waiting for the next change
+        del self.pfsense.post  # Send the requests through _make_request
+        self.pfsense._api = MagicMock()
+        self.pfsense._api.post.return_value = MagicMock(ok=False, status_code=503, reason='Service Unavailable', text='')
+        self.assertIsNone(self.pfsense.apply_changes())
+        self.assertFalse(self.pfsense.flush_changes())
+        self.assertTrue(self.pfsense.apply_coordinator.pending)
+        for error in (requests.exceptions.RequestException('unreachable'), RuntimeError('unexpected')):
+            self.pfsense._api.post.side_effect = error
+            self.assertFalse(self.pfsense.flush_changes())
+            self.assertTrue(self.pfsense.apply_coordinator.pending)
+        self.pfsense._api.post.side_effect = None
+        self.pfsense._api.post.return_value = MagicMock(ok=True, json=MagicMock(return_value={'code': 200, 'data': {'applied': True}}))
+        self.assertTrue(self.pfsense.flush_changes())
+        self.assertFalse(self.pfsense.apply_coordinator.pending)
+
+    def test_apply_runs_after_the_debounce_window(self):
+        # Test that the background apply runs once without an explicit flush
+        applied = threading.Event()
+        self.pfsense.post.side_effect = lambda endpoint, data: applied.set() or (200, 200, 0, 'Success', {'applied': True})
+        self.pfsense.apply_coordinator._debouncer.delay = 0.05
+        self.pfsense.apply_changes()
+        self.pfsense.apply_changes()
+        self.assertTrue(applied.wait(2))
+        self.assertEqual(self.pfsense.apply_coordinator.applied, 1)
+
+class TestFirewallRuleIndex(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('integrations.pfsense_functions.Log')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.rules = [FirewallRule(make_rule(1, '10.0.0.0/8', 'wide')),
+                      FirewallRule(make_rule(2, '10.1.0.0/16', 'narrow', port='443')),
+                      FirewallRule(make_rule(3, 'PySOAR_Block', 'alias'))]
+        self.index = FirewallRuleIndex(self.rules)
+
+    def test_lookups(self):
+        # Test the tracker, description, port and network lookups, keeping the rule list order
+        self.assertIs(self.index.get_by_tracker('2'), self.rules[1])
+        self.assertIs(self.index.get_by_description('alias'), self.rules[2])
+        self.assertIs(self.index.get_by_port(443), self.rules[1])
+        self.assertIs(self.index.get_by_ip('10.1.2.3'), self.rules[0])
+        self.assertIs(self.index.get_by_ip('10.1.0.0/24'), self.rules[0])
+        self.assertIsNone(self.index.get_by_ip('192.0.2.1'))
+
+    def test_remove(self):
+        # Test that removed rules are no longer found
+        self.index.remove(self.rules[0])
+        self.assertIs(self.index.get_by_ip('10.1.2.3'), self.rules[1])
+        self.assertIsNone(self.index.get_by_ip('10.2.0.1'))
+        self.assertIsNone(self.index.get_by_tracker(1))
+        self.assertEqual(len(self.index), 2)
+
+class TestFirewallRule(unittest.TestCase):
+
+    def test_fields_are_decoded_from_the_rule_data(self):
+        # Test that the slotted rule reads nested fields lazily and parses its networks once
+        rule = FirewallRule(make_rule(5, '192.0.2.0/24', descr='blocked', port='443'))
+        self.assertFalse(hasattr(rule, '__dict__'))
+        self.assertEqual((rule.tracker, rule.description, rule.source_address), (5, 'blocked', '192.0.2.0/24'))
+        self.assertEqual(rule.destination_port, '443')
+        self.assertIsNone(rule.source_port)
+        self.assertEqual(rule.networks, ((4, 0xC0000200, 0xC00002FF),))
+        formatted = rule.format_rule()
+        self.assertEqual((formatted['source'], formatted['destination']), ({'address': '192.0.2.0/24'}, {'port': '443'}))
+        self.assertEqual(formatted['updated'], {'time': 1, 'username': 'api'})
+        self.assertEqual(FirewallRule(make_rule(6, 'PySOAR_Block')).networks, ())
+
+class TestAliasBlocking(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('integrations.pfsense_functions.Log')
+        patcher2 = patch.dict(ApplyCoordinator._coordinators, clear=True)
+        self.addCleanup(patcher1.stop)
+        self.addCleanup(patcher2.stop)
+        patcher1.start()
+        patcher2.start()
+        pfsense_init = MagicMock(url='https://pfsense.example', api_key='key', ssl=False, verifycert=False)
+        pfsense_init.name = 'pfsense'
+        pfsense_init.params = {'pfsense': {'block_mode': 'alias', 'alias_shard_size': 3}}
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        for patcher in (patch.object(BlockExpiryScheduler, 'SIDECAR_DIR', self.tmp_dir.name),
+                        patch.dict(BlockExpiryScheduler._schedulers, clear=True),
+                        patch.dict(ApplyCoordinator._coordinators, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pfsense = PfsenseFunction(pfsense_init)
+        # Write the queued expiry times before the temporary directory is removed
+        self.addCleanup(PersistenceManager.get_instance().flush)
+        self.pfsense.ALIAS_CHUNK_SIZE = 2
+        self.responses = {
+            'api/v1/firewall/alias': [{'name': 'PySOAR_Block_0', 'type': 'network', 'address': '192.0.2.1 192.0.2.3'}],
+            'api/v1/firewall/rule': [],
+        }
+        self.pfsense.get = MagicMock(side_effect=lambda endpoint: (200, 200, 0, 'Success', self.responses[endpoint]))
+        self.pfsense.post = MagicMock(return_value=(200, 200, 0, 'Success', {'applied': True}))
+        self.pfsense.put = MagicMock(return_value=(200, 200, 0, 'Success', {}))
+        self.pfsense.delete = MagicMock(return_value=(200, 200, 0, 'Success', {}))
+
+    def calls(self, mock, endpoint):
+        return [call.kwargs['data'] for call in mock.call_args_list if call.args[0] == endpoint]
+
+    def test_addresses_are_added_to_shards_in_chunks(self):
+        # Test that new addresses fill the existing shard, then new shards, with one rule and one apply
+        added = self.pfsense.add_firewall_rule(src=['192.0.2.1', '198.51.100.1', '198.51.100.3', '198.51.100.5', '198.51.100.7', '198.51.100.9'])
+        self.assertEqual(added, 5)
+        self.assertEqual(self.calls(self.pfsense.post, 'api/v1/firewall/alias/entry')[0]['address'], ['198.51.100.1'])
+        created = self.calls(self.pfsense.post, 'api/v1/firewall/alias')
+        self.assertEqual([alias['name'] for alias in created], ['PySOAR_Block_1', 'PySOAR_Block_2', 'PySOAR_Block'])
+        self.assertEqual(created[-1]['address'], ['PySOAR_Block_0', 'PySOAR_Block_1', 'PySOAR_Block_2'])
+        rules = self.calls(self.pfsense.post, 'api/v1/firewall/rule')
+        self.assertEqual((len(rules), rules[0]['src']), (1, 'PySOAR_Block'))
+        self.assertTrue(self.pfsense.flush_changes())
+        self.assertEqual(len(self.calls(self.pfsense.post, 'api/v1/firewall/apply')), 1)
+        self.assertTrue(self.pfsense.is_address_blocked('198.51.100.9'))
+
+    def test_failed_alias_calls_are_not_cached(self):
+        # Test that the aliases are read again after a failed call, instead of caching entries pfSense refused
+        def post(endpoint, data):
+            if endpoint == 'api/v1/firewall/alias/entry':
+                return (400, 400, 1, 'Bad request', {})
+            return (200, 200, 0, 'Success', {'applied': True})
+        self.pfsense.post.side_effect = post
+        self.assertEqual(self.pfsense.block_addresses(['198.51.100.1']), 0)
+        self.assertEqual(self.pfsense.get_blocked_addresses(), ['192.0.2.1', '192.0.2.3'])
+        self.pfsense.delete.return_value = (500, 500, 1, 'Error', {})
+        self.assertEqual(self.pfsense.unblock_addresses(['192.0.2.3']), 0)
+        self.assertTrue(self.pfsense.is_address_blocked('192.0.2.3'))
+        self.assertEqual([call.args[0] for call in self.pfsense.get.call_args_list].count('api/v1/firewall/alias'), 3)
+
+    def test_narrowed_blocks_get_their_own_rule(self):
+        # Test that a block limited to a port can't go to the block list aliases, which block every port
+        def post(endpoint, data):
+            if endpoint == 'api/v1/firewall/rule':
+                self.responses[endpoint].append(make_rule(len(self.responses[endpoint]) + 1, data['src'], data['descr']))
+            return (200, 200, 0, 'Success', {'applied': True})
+        self.pfsense.post.side_effect = post
+        self.pfsense.add_firewall_rule(src=['198.51.100.1'], dst_port='22', descr='SSH block')
+        self.assertEqual(self.calls(self.pfsense.post, 'api/v1/firewall/alias/entry'), [])
+        rules = self.calls(self.pfsense.post, 'api/v1/firewall/rule')
+        self.assertEqual([(rule['src'], rule['dstport']) for rule in rules], [('198.51.100.1', '22')])
+        self.pfsense.log.error.assert_called_once()
+
+    def test_unblock_removes_stored_entries(self):
+        # Test that only entries stored in the aliases are removed
+        self.assertEqual(self.pfsense.unblock_addresses(['192.0.2.3', '203.0.113.1']), 1)
+        self.assertEqual(self.calls(self.pfsense.delete, 'api/v1/firewall/alias/entry'),
+                         [{'name': 'PySOAR_Block_0', 'address': ['192.0.2.3'], 'apply': False}])
+        self.assertEqual(self.pfsense.get_blocked_addresses(), ['192.0.2.1'])
+
+    def test_unblock_removes_covered_entries_and_survives_failed_requests(self):
+        # Test that a host stored next to a covering network is removed too, and that a failed request is reported
+        self.responses['api/v1/firewall/alias'][0]['address'] = '192.0.2.0/24 192.0.2.3'
+        self.assertEqual(self.pfsense.unblock_addresses(['192.0.2.3', '192.0.2.0/24']), 2)
+        self.assertEqual(self.pfsense.get_blocked_addresses(), [])
+        self.pfsense.read_aliases()
+        self.pfsense.delete.return_value = None
+        self.assertEqual(self.pfsense.unblock_addresses(['192.0.2.3']), 0)
+        self.pfsense.get.side_effect = None
+        self.pfsense.get.return_value = None
+        self.assertEqual(self.pfsense.unblock_addresses(['192.0.2.3']), 0)
+        self.assertEqual(self.pfsense.get_blocked_addresses(), ['192.0.2.0/24', '192.0.2.3'])
+
+    def test_reconcile_only_sends_the_difference(self):
+        # Test that a dry run changes nothing, and the real run adds and removes only the changed entries
+        desired = ['192.0.2.1', '198.51.100.0/25', '198.51.100.128/25']
+        report = self.pfsense.reconcile_blocklist(desired, dry_run=True)
+        self.assertEqual((report['add'], report['remove'], report['unchanged']), (['198.51.100.0/24'], ['192.0.2.3'], 1))
+        self.assertGreater(report['saved_api_calls'], 0)
+        self.pfsense.post.assert_not_called()
+        self.pfsense.delete.assert_not_called()
+
+        report = self.pfsense.reconcile_blocklist(desired)
+        self.assertEqual(self.calls(self.pfsense.delete, 'api/v1/firewall/alias/entry'),
+                         [{'name': 'PySOAR_Block_0', 'address': ['192.0.2.3'], 'apply': False}])
+        self.assertEqual(self.calls(self.pfsense.post, 'api/v1/firewall/alias/entry')[0]['address'], ['198.51.100.0/24'])
+        self.assertEqual(len(self.calls(self.pfsense.post, 'api/v1/firewall/apply')), 1)
+        self.assertEqual(sorted(self.pfsense.get_blocked_addresses()), ['192.0.2.1', '198.51.100.0/24'])
+
+    def test_blocks_expire_in_one_batch(self):
+        # Test that expired entries are removed together and the expiry times survive a restart
+        self.pfsense.block_addresses(['198.51.100.1', '198.51.100.3'], ttl=60)
+        self.pfsense.block_addresses(['198.51.100.5'], ttl=3600)
+        expiry = self.pfsense.expiry
+        self.assertEqual(expiry.pending, 3)
+        expiry.persistence.flush(expiry.path)
+        restarted = BlockExpiryScheduler(self.pfsense)
+        self.assertEqual(restarted.expires_at('198.51.100.5'), expiry.expires_at('198.51.100.5'))
+
+        removed = expiry.remove_expired(now=expiry._now() + 120)
+        self.assertEqual(sorted(removed), ['198.51.100.1', '198.51.100.3'])
+        deletes = self.calls(self.pfsense.delete, 'api/v1/firewall/alias/entry')
+        self.assertEqual(sorted(address for delete in deletes for address in delete['address']), ['198.51.100.1', '198.51.100.3'])
+        self.pfsense.flush_changes()
+        self.assertEqual(len(self.calls(self.pfsense.post, 'api/v1/firewall/apply')), 1)
+        self.assertEqual(expiry.pending, 1)
+        self.assertIn('198.51.100.5', self.pfsense.get_blocked_addresses())
+
+    def test_expiring_block_rules(self):
+        # Test that failed blocks never expire, covered hosts get their own removal and failed removals are retried
+        self.pfsense.block_mode = 'rule'
+        self.pfsense.post.return_value = (400, 400, 1, 'Bad request', {})
+        with self.assertRaises(Exception):
+            self.pfsense.add_firewall_rule(src=['198.51.100.1'], ttl=60)
+        expiry = self.pfsense.expiry
+        self.assertEqual(expiry.pending, 0)
+
+        self.responses['api/v1/firewall/rule'] = [make_rule(1, '198.51.100.7'), make_rule(2, '198.51.100.0/24')]
+        self.pfsense.read_firewall_rule()
+        expiry.schedule(['198.51.100.7', '198.51.100.0/24'], 60)
+        self.pfsense.delete.side_effect = lambda endpoint, data: None if data['tracker'] == 1 else (200, 200, 0, 'Success', {})
+        self.assertEqual(sorted(expiry.remove_expired(now=expiry._now() + 120)), ['198.51.100.0/24', '198.51.100.7'])
+        self.assertEqual(sorted(data['tracker'] for data in self.calls(self.pfsense.delete, 'api/v1/firewall/rule')), [1, 2])
+        self.assertEqual(expiry.pending, 1)
+        self.assertIsNotNone(expiry.expires_at('198.51.100.7'))
+
+FIREWALL_LOGS = [
+    "Nov  7 05:55:22 pfSense filterlog[5523]: 5,,,1000000103,vmx0,match,block,in,4,0x0,,64,54321,0,DF,6,tcp,60,203.0.113.5,192.0.2.10,51514,22,0,S,1234567890,,64240,,mss",
+    "Nov  7 05:55:23 pfSense filterlog[5523]: 7,,,1000000105,vmx0,match,pass,out,6,0x00,0x00000,255,udp,17,64,fe80::1,ff02::1,546,547,64",
+    "Nov  7 05:55:24 pfSense filterlog[5523]: 5,,,1000000103,vmx0,match,block,in,4,0x0,,64,0,0,none,1,icmp,84,198.51.100.9,192.0.2.10,request,1,1",
+    "Nov  7 05:55:25 pfSense dhcpd[812]: DHCPACK on 192.0.2.50 to 00:11:22:33:44:55",
+    "Nov  8 06:00:00 pfSense filterlog[5523]: garbage",
+    "Nov  9 12:00:00 pfSense filterlog[5523]: 5,,,1000000103,vmx0,match,block,in,4,0x0,,64,54321,0,DF,6,tcp,60,203.0.113.6,192.0.2.10,51515,443,0,S,1,,64240,,mss",
+]
+
+class TestFirewallLogs(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('integrations.pfsense_functions.Log')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_entries_are_parsed(self):
+        # Test IPv4, IPv6 and portless entries, and that other processes and malformed lines are skipped
+        entries = list(iter_firewall_logs(FIREWALL_LOGS, today=date(2024, 12, 1)))
+        self.assertEqual(len(entries), 4)
+        tcp, udp, icmp = entries[:3]
+        self.assertEqual(tcp.timestamp, datetime(2024, 11, 7, 5, 55, 22))
+        self.assertEqual((tcp.action, tcp.tracker, tcp.proto, tcp.src_ip, tcp.dest_ip, tcp.src_port, tcp.dest_port),
+                         ('block', '1000000103', 'tcp', '203.0.113.5', '192.0.2.10', '51514', '22'))
+        self.assertEqual((udp.ip_version, udp.proto, udp.src_ip, udp.dest_ip, udp.dest_port), ('6', 'udp', 'fe80::1', 'ff02::1', '547'))
+        self.assertEqual((icmp.proto, icmp.src_ip, icmp.src_port), ('icmp', '198.51.100.9', None))
+        self.assertEqual((tcp['date'], tcp['time']), (date(2024, 11, 7), time(5, 55, 22)))
+        self.assertFalse(hasattr(tcp, '__dict__'))
+
+    def test_timestamps_without_a_year_are_never_in_the_future(self):
+        # Test that a December entry read in January belongs to the previous year
+        entry = next(iter_firewall_logs([FIREWALL_LOGS[0].replace('Nov  7', 'Dec 31')], today=date(2025, 1, 1)))
+        self.assertEqual(entry.timestamp.year, 2024)
+        # The cached timestamps follow the current date when it changes
+        for year in (2025, 2026):
+            now = datetime(year, 1, 1)
+            with patch('integrations.pfsense_functions.datetime', MagicMock(wraps=datetime, now=MagicMock(return_value=now))):
+                self.assertEqual(parse_syslog_timestamp('Dec 31 23:59:59').year, year - 1)
+
+    def test_logs_by_datetime_range(self):
+        # Test that the range filter uses the parsed timestamps
+        log_mgr = PfsenseLog()
+        log_mgr.gather_firewall_logs({'data': FIREWALL_LOGS})
+        year = log_mgr.firewall_logs[0].timestamp.year
+        entries = log_mgr.get_firewall_logs_by_datetimerange(date(year, 11, 7), date(year, 11, 8), start_time=time(5, 55, 23))
+        self.assertEqual([entry.src_ip for entry in entries], ['fe80::1', '198.51.100.9'])
+
+    def test_store_range_queries(self):
+        # Test that ranges are found by time, including late entries, and columns are decoded from the slice
+        entries = list(iter_firewall_logs(FIREWALL_LOGS, today=date(2024, 12, 1)))
+        store = FirewallLogStore(entries[1:])
+        store.append(entries[0])
+        self.assertEqual([entry.src_ip for entry in store], ['203.0.113.5', 'fe80::1', '198.51.100.9', '203.0.113.6'])
+        self.assertEqual(store[0].timestamp, datetime(2024, 11, 7, 5, 55, 22))
+        window = store.last(minutes=1, now=datetime(2024, 11, 7, 5, 56))
+        self.assertEqual(len(window), 3)
+        self.assertEqual(window.column('action'), ['block', 'pass', 'block'])
+        self.assertEqual(window.count_by('src_ip')['198.51.100.9'], 1)
+        self.assertEqual([entry.proto for entry in window.where(action='block', dest_ip='192.0.2.10')], ['tcp', 'icmp'])
+        self.assertEqual(window.where(action='reject'), [])
+        self.assertEqual(window[1:].column('proto'), ['udp', 'icmp'])
+        self.assertEqual(len(store.since(datetime(2024, 11, 9))), 1)
+        self.assertFalse(store.between(datetime(2024, 11, 10), datetime(2024, 11, 11)))
+
+    def test_slices_keep_their_entries_when_the_store_changes(self):
+        # Test that expiring, merging late entries and appending don't change a slice taken before
+        entries = list(iter_firewall_logs(FIREWALL_LOGS, today=date(2024, 12, 1)))
+        store = FirewallLogStore(entries[1:3])
+        window = store.last(minutes=1, now=datetime(2024, 11, 7, 5, 56))
+        before = [entry.src_ip for entry in window]
+        store.expire(log_time_key(datetime(2024, 11, 8)))
+        self.assertEqual(len(store), 0)
+        store.extend([entries[3], entries[0]])
+        self.assertEqual([entry.src_ip for entry in window], before)
+        self.assertEqual(window.column('src_ip'), before)
+        self.assertEqual(window[1:].column('src_ip'), before[1:])
+
+    def test_tailing_only_parses_new_lines(self):
+        # Test that repeated downloads only add the lines after the cursor, even once old lines are rotated out
+        log_mgr = PfsenseLog()
+        self.assertEqual(log_mgr.tail_logs('firewall', {'data': FIREWALL_LOGS[:2]}), 2)
+        self.assertEqual(log_mgr.tail_logs('firewall', {'data': FIREWALL_LOGS[:2]}), 0)
+        with patch('integrations.pfsense_functions.iter_firewall_logs', wraps=iter_firewall_logs) as parser:
+            self.assertEqual(log_mgr.tail_logs('firewall', {'data': FIREWALL_LOGS[:4]}), 2)
+        self.assertEqual(parser.call_args.args[0], FIREWALL_LOGS[2:4])
+        self.assertEqual(len(log_mgr.firewall_logs), 3)
+        # The cursor's line is gone, the lines newer than it are read instead
+        self.assertEqual(log_mgr.tail_logs('firewall', {'data': FIREWALL_LOGS[4:]}), 2)
+        self.assertEqual(len(log_mgr.firewall_logs), 4)
+        log_mgr.tail_logs('system', FIREWALL_LOGS[3:5])
+        self.assertEqual(log_mgr.system_logs, FIREWALL_LOGS[3:5])
+
+    def test_analytics_are_fed_by_new_lines(self):
+        # Test that only the new lines are added to the aggregates, and reading the log again starts over
+        log_mgr = PfsenseLog(analytics=FirewallLogAnalytics(window=10 ** 9))
+        log_mgr.tail_logs('firewall', FIREWALL_LOGS[:3])
+        log_mgr.tail_logs('firewall', FIREWALL_LOGS)
+        self.assertEqual(log_mgr.analytics.get('blocked_sources', '203.0.113.5'), 1)
+        self.assertEqual(sum(count for _, count in log_mgr.analytics.top('blocked_sources')), 3)
+        log_mgr.gather_firewall_logs(FIREWALL_LOGS[:1])
+        self.assertEqual(log_mgr.analytics.top('blocked_sources'), [('203.0.113.5', 1)])
+
+    def test_retention(self):
+        # Test that cached lines older than the retention period are dropped
+        log_mgr = PfsenseLog()
+        log_mgr.tail_logs('firewall', FIREWALL_LOGS)
+        log_mgr.tail_logs('dhcp', FIREWALL_LOGS)
+        log_mgr.retention = 3600
+        year = log_mgr.firewall_logs[0].timestamp.year
+        now = datetime(year, 11, 9, 12, 30)
+        self.assertEqual(log_mgr.expire_logs('firewall', now=now), 3)
+        self.assertEqual([entry.src_ip for entry in log_mgr.firewall_logs], ['203.0.113.6'])
+        self.assertEqual(log_mgr.expire_logs('dhcp', now=now), 5)
+        self.assertEqual(log_mgr.dhcp_logs, FIREWALL_LOGS[5:])
+
+    def test_pushed_lines_are_expired(self):
+        # Test that the lines pushed by the syslog listener are dropped after the retention period too
+        log_mgr = PfsenseLog(retention=3600)
+        self.assertEqual(log_mgr.ingest_firewall_logs(FIREWALL_LOGS), 4)
+        self.assertEqual(len(log_mgr.firewall_logs), 0)  # Older than the retention period
+        recent = datetime.now().strftime('%b %d %H:%M:%S')
+        log_mgr.ingest_firewall_logs([FIREWALL_LOGS[0].replace('Nov  7 05:55:22', recent)])
+        log_mgr.ingest_firewall_logs(FIREWALL_LOGS)  # Not checked again until EXPIRE_INTERVAL has passed
+        self.assertEqual(len(log_mgr.firewall_logs), 5)
+        log_mgr._next_expiry = 0
+        log_mgr.ingest_firewall_logs([])
+        self.assertEqual([entry.src_ip for entry in log_mgr.firewall_logs], ['203.0.113.5'])
+
+    def test_update_log_cache_interval(self):
+        # Test that the log is not downloaded again within the polling interval
+        pfsense_init = MagicMock(url='https://pfsense.example', api_key='key', ssl=False, verifycert=False)
+        pfsense_init.name = 'pfsense'
+        pfsense_init.params = {'pfsense': {'log_retention': None}}
+        with patch.dict(ApplyCoordinator._coordinators, clear=True):
+            pfsense = PfsenseFunction(pfsense_init)
+        pfsense.get = MagicMock(return_value=(200, 200, 0, 'Success', {'data': FIREWALL_LOGS}))
+        self.assertEqual(len(pfsense.get_firewall_logs()), 4)
+        self.assertEqual(pfsense.update_log_cache('firewall', interval=60), 0)
+        self.assertEqual(pfsense.update_log_cache('firewall'), 0)
+        self.assertEqual(pfsense.get.call_count, 2)
+
+class TestSyslogListener(unittest.TestCase):
+    FILTERLOG = "5,,,1000000103,vmx0,match,block,in,4,0x0,,64,54321,0,DF,6,tcp,60,203.0.113.{},192.0.2.10,51514,22,0,S,1,,64240,,mss"
+
+    def setUp(self):
+        patcher = patch('integrations.pfsense_functions.Log')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.log_mgr = PfsenseLog()
+
+    def wait_for(self, listener, count):
+        deadline = clock.monotonic() + 5
+        while listener.ingested < count and clock.monotonic() < deadline:
+            clock.sleep(0.01)
+
+    def test_messages_are_converted_to_log_lines(self):
+        # Test the RFC 5424 and BSD formats, with and without a hostname
+        self.assertEqual(syslog_to_log_line("<134>1 2024-11-07T05:55:22.123456-05:00 fw.example filterlog 5523 - - 5,,,1"),
+                         "2024-11-07T05:55:22.123456-05:00 fw.example filterlog[5523]: 5,,,1")
+        self.assertEqual(syslog_to_log_line("<134>Nov  7 05:55:22 filterlog[5523]: 5,,,1\n", '192.0.2.1'),
+                         "Nov  7 05:55:22 192.0.2.1 filterlog[5523]: 5,,,1")
+        self.assertEqual(syslog_to_log_line("<134>Nov  7 05:55:22 fw filterlog[5523]: 5,,,1"), "Nov  7 05:55:22 fw filterlog[5523]: 5,,,1")
+        self.assertIsNone(syslog_to_log_line("garbage"))
+
+    def test_udp_messages_are_parsed_in_batches(self):
+        # Test that datagrams from a local sender end up in the firewall log store
+        listener = SyslogListener(self.log_mgr, '127.0.0.1', 0, batch_size=50)
+        listener.start()
+        self.addCleanup(listener.stop)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        for i in range(200):
+            sender.sendto(f"<134>Nov  7 05:55:22 filterlog[5523]: {self.FILTERLOG.format(i % 250)}".encode(), listener.address)
+        sender.sendto(b"<30>Nov  7 05:55:22 dhcpd[812]: DHCPACK", listener.address)
+        self.wait_for(listener, 200)
+        self.assertEqual(listener.ingested, 200)
+        self.assertEqual(len(self.log_mgr.firewall_logs), 200)
+        self.assertEqual(self.log_mgr.firewall_logs[0].hostname, '127.0.0.1')
+        self.assertGreater(listener.batches, 1)
+
+    def test_tcp_framing(self):
+        # Test newline and octet counting framing on the same connection
+        listener = SyslogListener(self.log_mgr, '127.0.0.1', 0, protocol='tcp')
+        listener.start()
+        self.addCleanup(listener.stop)
+        message = f"<134>1 2024-11-07T05:55:22Z fw filterlog 5523 - - {self.FILTERLOG.format(2)}".encode()
+        with socket.create_connection(listener.address) as sender:
+            sender.sendall(f"<134>Nov  7 05:55:22 fw filterlog[5523]: {self.FILTERLOG.format(1)}\n".encode())
+            sender.sendall(str(len(message)).encode() + b' ' + message)
+        self.wait_for(listener, 2)
+        self.assertEqual(sorted(entry.src_ip for entry in self.log_mgr.firewall_logs),
+                         ['203.0.113.1', '203.0.113.2'])
+
+    def test_listeners_are_registered_once_bound(self):
+        # Test that a listener that couldn't bind isn't shared, and that a shared listener's settings are checked
+        patcher = patch.dict(SyslogListener._listeners, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        taken = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(taken.close)
+        taken.bind(('127.0.0.1', 0))
+        port = taken.getsockname()[1]
+        with self.assertRaises(OSError):
+            SyslogListener.for_address(self.log_mgr, '127.0.0.1', port)
+        self.assertEqual(SyslogListener._listeners, {})
+        taken.close()
+        listener = SyslogListener.for_address(self.log_mgr, '127.0.0.1', port)
+        self.addCleanup(listener.stop)
+        self.assertIs(SyslogListener.for_address(PfsenseLog(), '127.0.0.1', port, queue_size=10), listener)
+        listener.log.warning.assert_called_once()
+        with self.assertRaises(ValueError):
+            SyslogListener.for_address(self.log_mgr, '127.0.0.1', port, protocol='tcp')
+
+    def test_drop_policies(self):
+        # Test which message gives when the queue is full
+        listener = SyslogListener(self.log_mgr, queue_size=2, drop_policy='drop_newest')
+        self.assertEqual([listener.put(message) for message in (b'1', b'2', b'3')], [True, True, False])
+        self.assertEqual([message for message, _ in listener._queue], [b'1', b'2'])
+        listener = SyslogListener(self.log_mgr, queue_size=2, drop_policy='drop_oldest')
+        for message in (b'1', b'2', b'3'):
+            listener.put(message)
+        self.assertEqual([message for message, _ in listener._queue], [b'2', b'3'])
+        self.assertEqual(listener.stats['dropped'], 1)
+        with self.assertRaises(ValueError):
+            SyslogListener(self.log_mgr, drop_policy='explode')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import unittest
+import threading
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+from analytics import FirewallLogAnalytics
+from classes import EventMatcher, PlaybookFunction, PlaybookTriggerManager
+
+def make_entry(src_ip, dest_port, action='block'):
+    """Build the fields of a FirewallLogEntry used by the triggers."""
+    return SimpleNamespace(timestamp=datetime(2024, 11, 7, 5, 0, 0), src_ip=src_ip, dest_ip='192.0.2.10',
+                           dest_port=dest_port, action=action)
+
+class TestEventMatcher(unittest.TestCase):
+
+    def test_every_field_must_match(self):
+        # Test that a predicate matches only when all of its fields match, and that lists match any of their values
+        matcher = EventMatcher()
+        matcher.add('ssh_blocks', {'action': 'block', 'dest_port': 22})
+        matcher.add('web_blocks', {'action': 'block', 'dest_port': ['80', '443']})
+        matcher.add('all_passes', {'action': 'pass'})
+        self.assertEqual(matcher.match(make_entry('203.0.113.5', '22')), ['ssh_blocks'])
+        self.assertEqual(matcher.match({'action': 'block', 'dest_port': '443'}), ['web_blocks'])
+        self.assertEqual(matcher.match(make_entry('203.0.113.5', '22', action='pass')), ['all_passes'])
+        self.assertEqual(matcher.match(make_entry('203.0.113.5', '25')), [])
+
+    def test_remove(self):
+        # Test that removing a key drops all of its predicates and nothing else
+        matcher = EventMatcher()
+        matcher.add('ssh_blocks', {'dest_port': '22'})
+        matcher.add('ssh_blocks', {'dest_port': '2222'})
+        matcher.add('everything', {})
+        matcher.remove('ssh_blocks')
+        self.assertEqual(matcher.match(make_entry('203.0.113.5', '22')), ['everything'])
+        self.assertEqual(len(matcher), 1)
+
+    def test_match_while_predicates_change(self):
+        # Test that matching stays consistent while another thread adds and removes predicates
+        matcher = EventMatcher()
+        matcher.add('ssh_blocks', {'dest_port': '22'})
+        errors = []
+        def churn():
+            for i in range(2000):
+                matcher.add(f"playbook{i}", {'dest_port': str(i), 'action': 'block'})
+                matcher.remove(f"playbook{i}")
+        thread = threading.Thread(target=churn)
+        thread.start()
+        while thread.is_alive():
+            try:
+                self.assertIn('ssh_blocks', matcher.match(make_entry('203.0.113.5', '22')))
+            except (RuntimeError, KeyError) as e:
+                errors.append(e)
+        thread.join()
+        self.assertEqual(errors, [])
+
+class TestPlaybookTriggerManager(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('classes.Log')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.launched = []
+        self.done = threading.Event()
+        self.playbook_mgr = MagicMock()
+        self.playbook_mgr.launch_playbook.side_effect = self.launch
+        self.triggers = PlaybookTriggerManager(self.playbook_mgr, MagicMock())
+        self.addCleanup(self.triggers.stop)
+
+    def launch(self, playbook_name, config_mgr, shared_data=None):
+        self.launched.append((playbook_name, shared_data))
+        self.done.set()
+
+    def test_event_triggers_launch_playbooks(self):
+        # Test that a matching log event launches the playbook with the event as its shared data
+        self.triggers.arm('ssh_blocks', {'type': 'event', 'match': {'action': 'block', 'dest_port': '22'}})
+        log_mgr = MagicMock(spec=['add_event_listener'])
+        self.triggers.attach(SimpleNamespace(log_mgr=log_mgr, analytics=None))
+        dispatch = log_mgr.add_event_listener.call_args.args[0]
+        self.assertEqual(dispatch([make_entry('203.0.113.5', '80'), make_entry('203.0.113.5', '22')]), 1)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.launched[0][0], 'ssh_blocks')
+        self.assertEqual(self.launched[0][1]['event'].dest_port, '22')
+
+    def test_threshold_triggers_launch_playbooks(self):
+        # Test that a threshold crossing in the analytics launches the playbook once, with the key that crossed it
+        analytics = FirewallLogAnalytics(window=10 ** 9)
+        self.triggers.attach(SimpleNamespace(analytics=analytics))
+        self.triggers.arm('port_scan', {'type': 'threshold', 'aggregate': 'source_ports', 'threshold': 3})
+        analytics.observe_many(make_entry('203.0.113.5', str(port)) for port in range(5))
+        self.assertTrue(self.done.wait(5))
+        self.triggers.stop()
+        self.assertEqual([(name, data['key'], data['value']) for name, data in self.launched], [('port_scan', '203.0.113.5', 3)])
+        self.triggers.disarm('port_scan')
+        self.assertEqual(analytics._thresholds['source_ports'], [])
+
+    def test_logs_are_polled_without_a_syslog_listener(self):
+        # Test that the firewall logs of an integration without a syslog listener are downloaded until the triggers stop
+        polled = threading.Event()
+        integration = SimpleNamespace(log_mgr=MagicMock(spec=['add_event_listener']), analytics=None, syslog_listener=None,
+                                      log_poll_interval=0.01, update_log_cache=MagicMock(side_effect=lambda *args: polled.set()))
+        self.triggers.attach(integration)
+        self.assertTrue(polled.wait(5))
+        integration.update_log_cache.assert_called_with('firewall', 0.01)
+        self.triggers.stop()
+        for poller in self.triggers._pollers:
+            poller.join(5)
+            self.assertFalse(poller.is_alive())
+        pushed = SimpleNamespace(log_mgr=MagicMock(spec=['add_event_listener']), analytics=None, syslog_listener=object(),
+                                 update_log_cache=MagicMock())
+        self.triggers.attach(pushed)
+        self.assertEqual(len(self.triggers._pollers), 1)
+
+    def test_queued_playbooks_are_not_queued_twice(self):
+        # Test that triggers firing while a playbook runs queue a single follow-up run, without blocking other playbooks
+        release = threading.Event()
+        started = threading.Event()
+        def launch(playbook_name, config_mgr, shared_data=None):
+            self.launched.append((playbook_name, shared_data))
+            if playbook_name == 'slow':
+                started.set()
+                release.wait(5)
+            else:
+                self.done.set()
+        self.playbook_mgr.launch_playbook.side_effect = launch
+        self.assertTrue(self.triggers.fire('slow', 1))
+        self.assertTrue(started.wait(5))
+        self.assertTrue(self.triggers.fire('slow', 2))
+        self.assertFalse(self.triggers.fire('slow', 3))
+        self.assertTrue(self.triggers.fire('fast'))
+        self.assertTrue(self.done.wait(5))  # Runs while the slow playbook is still running
+        release.set()
+        self.triggers.stop()
+        self.assertEqual([data for name, data in self.launched if name == 'slow'], [1, 2])
+        self.assertEqual(self.triggers.fired, 3)
+
+    def test_trigger_is_saved_with_the_function(self):
+        # Test that event and threshold conditions survive saving the playbook function
+        trigger = {'type': 'threshold', 'aggregate': 'blocked_sources', 'threshold': 100}
+        self.assertEqual(PlaybookFunction.from_dict({'function': 'block_addresses', 'trigger': trigger}).to_dict()['trigger'], trigger)
+        with self.assertRaises(ValueError):
+            self.triggers.arm('broken', {'type': 'threshold'})
+
+if __name__ == '__main__':
+    unittest.main()